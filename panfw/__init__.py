@@ -0,0 +1,6 @@
+"""
+Package:      panfw
+
+Description:
+Shared building blocks for the PAN-OS firewall scripts in this repository.
+"""
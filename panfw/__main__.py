@@ -0,0 +1,5 @@
+import sys
+
+from panfw.cli import main
+
+sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Module:       panfw/aio.py
+
+Description:
+asyncio helpers around the blocking pan-os-python / PooledTransport calls.
+run_op() runs one op command as a coroutine, fan_out() runs op commands
+across the fleet with a global concurrency limit, a per-device limit (small
+branch management planes do not like parallel API sessions), a timeout per
+command and cancellation, and yields the results in completion order so the
+caller can act on fast devices while slow ones are still answering.
+"""
+
+import time
+import asyncio
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from panfw.transport import xml_op
+
+app_log = logging.getLogger('root')
+
+OpResult = namedtuple('OpResult', ['fw', 'cmd', 'ok', 'response', 'elapsed', 'error'])
+
+
+async def run_op(fw, xml_cmd, transport=None, timeout=None, executor=None):
+    """Runs an XML op command on fw without blocking the event loop.
+
+    Arguments:
+        fw {Firewall} -- Target firewall
+        xml_cmd {str} -- Op command as XML
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+        timeout {float} -- Seconds before asyncio.TimeoutError is raised
+        executor {Executor} -- Thread pool for the blocking call (loop default if None)
+
+    Returns:
+        bytes -- The XML response
+    """
+    loop = asyncio.get_running_loop()
+    call = loop.run_in_executor(executor, xml_op, fw, xml_cmd, transport)
+    return await asyncio.wait_for(call, timeout)
+
+
+async def fan_out(cmds, fws, limit=64, per_device_limit=1, timeout=30, transport=None):
+    """Runs every command on every firewall and yields OpResults as they complete.
+
+    Closing the generator (aclose()) cancels everything that has not been
+    started yet. Leaving an async for loop early does not close it by itself
+    (only its garbage collection does), a consumer that may break out or
+    raise iterates inside contextlib.aclosing() (Python 3.10+) or calls
+    aclose() in a finally block:
+
+        async with contextlib.aclosing(fan_out(cmd, fw_objs)) as results:
+            async for result in results:
+                ...
+
+    A command that timed out keeps its fleet and device slot until its
+    worker thread returns (the blocking call cannot be interrupted), so a
+    slow device never gets more than per_device_limit requests at a time.
+
+    Arguments:
+        cmds {str|list} -- One XML op command or a list of them
+        fws {list} -- Target firewalls
+
+    Keyword Arguments:
+        limit {int} -- Commands in flight across the fleet
+        per_device_limit {int} -- Commands in flight per firewall
+        timeout {float} -- Seconds per command
+        transport {PooledTransport} -- Optional pooled transport
+
+    Yields:
+        OpResult -- (fw, cmd, ok, response, elapsed, error)
+    """
+    if isinstance(cmds, str):
+        cmds = [cmds]
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, int(limit)))
+    fleet_slots = asyncio.Semaphore(limit)
+    device_slots = dict()
+
+    async def run_one(fw, cmd):
+        slots = device_slots.setdefault(fw.hostname, asyncio.Semaphore(per_device_limit))
+        # The device slot first: a command waiting for its busy firewall does
+        # not hold a fleet slot that a command to another firewall could use
+        await slots.acquire()
+        try:
+            await fleet_slots.acquire()
+        except BaseException:
+            slots.release()
+            raise
+
+        def release(_):
+            fleet_slots.release()
+            slots.release()
+
+        start_time = time.time()
+        call = loop.run_in_executor(executor, xml_op, fw, cmd, transport)
+        # A timeout (or cancellation) does not stop the worker thread, which
+        # still talks to the device: the slots are only given back when the
+        # call really finished, so the limits also hold after a timeout
+        call.add_done_callback(release)
+        try:
+            response = await asyncio.wait_for(asyncio.shield(call), timeout)
+            return OpResult(fw, cmd, True, response, time.time() - start_time, None)
+        except asyncio.TimeoutError:
+            return OpResult(fw, cmd, False, None, time.time() - start_time, 'timed out')
+        except Exception as e:
+            return OpResult(fw, cmd, False, None, time.time() - start_time, repr(e))
+
+    pending = set(asyncio.ensure_future(run_one(fw, cmd)) for fw in fws for cmd in cmds)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        executor.shutdown(wait=False)
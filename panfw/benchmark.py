@@ -0,0 +1,334 @@
+"""
+Module:       panfw/benchmark.py
+
+Description:
+Load benchmark of the scripts against the offline simulator
+(python3 -m panfw benchmark). It starts a simulated fleet (see
+panfw/simulator.py), builds a Runtime for it exactly like the scripts do and
+measures three phases:
+
+    initialize      Firewall objects, API keys (--keygen) and HA peers
+    ha-discovery    show high-availability state on every HA pair
+    sweep N         one run of every task over the whole fleet
+
+For every phase it reports the wall time, the XML API requests per second
+the simulator answered, the p50 / p99 latency of a single device and the
+failed devices, and at the end the peak RSS of the process (and of the
+shard workers with execution_mode: processes).
+
+With --json the report is also written to a file. A later run compares
+itself against such a file with --baseline and exits with 1 when the sweep
+throughput dropped or the p99 latency grew by more than --tolerance, e.g.
+in a CI job before a deployment.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from panfw.simulator import (add_fleet_arguments, simulator_from_args,
+                             SIM_USERNAME, SIM_PASSWORD)
+
+app_log = logging.getLogger('root')
+
+DEFAULT_TASKS = ('satellite-reset',)
+
+
+def percentile(values, q):
+    """Nearest rank percentile (q in 0..100) of values, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident set size in MB of a process (default: this one)."""
+    if pid is None:
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def phase_report(name, wall, requests, results=None, latencies=None):
+    """Returns the report entry of one phase.
+
+    Arguments:
+        name {str} -- Phase name
+        wall {float} -- Wall time in seconds
+        requests {int} -- XML API requests answered by the simulator during the phase
+
+    Keyword Arguments:
+        results {list} -- FirewallResult per device, their elapsed times are the latencies
+        latencies {list} -- Per-device latencies in seconds (without results)
+    """
+    results = results or list()
+    if latencies is None:
+        latencies = [res.elapsed for res in results if res.ok]
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 1)
+
+    return {'phase': name,
+            'wall_seconds': round(wall, 3),
+            'requests': requests,
+            'requests_per_second': round(requests / wall, 1) if wall > 0 else None,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'devices': len(results) or len(latencies),
+            'failed': sum(1 for res in results if not res.ok)}
+
+
+def sweep_summary(sweeps):
+    """Sums up the sweep phases: mean wall time and throughput, worst p50 / p99."""
+    if not sweeps:
+        return None
+
+    def worst(key):
+        values = [phase[key] for phase in sweeps if phase[key] is not None]
+        return max(values) if values else None
+
+    wall = sum(phase['wall_seconds'] for phase in sweeps)
+    requests = sum(phase['requests'] for phase in sweeps)
+    return {'sweeps': len(sweeps),
+            'wall_seconds': round(wall / len(sweeps), 3),
+            'requests_per_second': round(requests / wall, 1) if wall > 0 else None,
+            'p50_ms': worst('p50_ms'),
+            'p99_ms': worst('p99_ms'),
+            'failed': sum(phase['failed'] for phase in sweeps)}
+
+
+def benchmark_config(sim, args, workdir):
+    """Returns the config.yml dict of a benchmark run against sim."""
+    cfgdict = {'log_path': os.path.join(workdir, 'logs'),
+               'execution_mode': args.mode,
+               'max_workers': args.max_workers,
+               'parallel_init': True,
+               'non_interactive': True,
+               'pooled_transport': args.pooled_transport,
+               'firewall_timeout': args.timeout,
+               'firewalls': sim.firewalls(api_keys=not args.keygen)}
+    if args.shards:
+        cfgdict['shards'] = args.shards
+    if args.keygen:
+        import yaml
+        cfgdict['credentials_file'] = os.path.join(workdir, 'credentials.yml')
+        with open(cfgdict['credentials_file'], 'w') as cred_file:
+            yaml.safe_dump({'default': {'username': SIM_USERNAME, 'password': SIM_PASSWORD}},
+                           cred_file)
+    if 'rule-reorder' in args.tasks:
+        # Reverse order: the first sweep moves every rule, the later ones none
+        order_file = os.path.join(workdir, 'rule-order.txt')
+        with open(order_file, 'w') as outfile:
+            outfile.write('\n'.join(f'rule-{i}' for i in reversed(range(args.rules))) + '\n')
+        cfgdict['rule_reorder'] = {'vsys': 'vsys1', 'rule_type': 'security',
+                                   'target_order_file': order_file, 'commit': True}
+    for setting in args.set or list():
+        import yaml
+        key, _, value = setting.partition('=')
+        cfgdict[key.strip()] = yaml.safe_load(value)
+    return cfgdict
+
+
+def run_benchmark(sim, cfgdict, tasks, sweeps, workdir):
+    """Runs the phases against a started simulator.
+
+    Arguments:
+        sim {Simulator} -- Started simulator
+        cfgdict {dict} -- Config of the run (see benchmark_config)
+        tasks {list} -- Task names run in every sweep
+        sweeps {int} -- Number of sweeps
+        workdir {str} -- Directory of the config file written by keygen
+
+    Returns:
+        tuple -- Report entry per phase, peak RSS dict
+    """
+    # Imported here so the simulator processes are forked before pan-os-python is loaded
+    from panfw.core import Runtime
+
+    phases = list()
+    runtime = Runtime(cfgdict, tasks, config_file=os.path.join(workdir, 'config.yml'))
+    try:
+        requests = sim.stats()[0]
+        start_time = time.time()
+        fw_objs = runtime.initialize()
+        phases.append(phase_report('initialize', time.time() - start_time,
+                                   sim.stats()[0] - requests,
+                                   latencies=list()))
+        phases[-1]['devices'] = len(fw_objs)
+        phases[-1]['failed'] = len(cfgdict['firewalls']) - len(fw_objs)
+
+        ha_pairs = [fw for fw in fw_objs if fw.ha_peer is not None]
+        if ha_pairs:
+            def discover(fw):
+                call_start = time.time()
+                runtime.ha_cache.discover(fw)
+                return time.time() - call_start
+
+            requests = sim.stats()[0]
+            start_time = time.time()
+            with ThreadPoolExecutor(max_workers=cfgdict['max_workers']) as pool:
+                latencies = list(pool.map(discover, ha_pairs))
+            phases.append(phase_report('ha-discovery', time.time() - start_time,
+                                       sim.stats()[0] - requests, latencies=latencies))
+
+        for sweep in range(1, sweeps + 1):
+            for task in runtime.tasks.values():
+                requests = sim.stats()[0]
+                start_time = time.time()
+                results = task.run_all([fw for fw in fw_objs if task.applies_to(fw.hostname)])
+                for res in results:
+                    runtime.record(task.name, res)
+                runtime.planner.drain()
+                if runtime.executor.mode == 'processes':
+                    runtime.executor.drain()
+                phases.append(phase_report(f'sweep {sweep} ({task.name})', time.time() - start_time,
+                                           sim.stats()[0] - requests, results=results))
+
+        rss = {'benchmark_mb': round(peak_rss_mb(), 1)}
+        if hasattr(runtime.executor, 'pids'):
+            workers = [peak_rss_mb(pid) for pid in runtime.executor.pids()]
+            workers = [value for value in workers if value is not None]
+            if workers:
+                rss['shard_workers_mb'] = round(sum(workers), 1)
+                rss['largest_shard_worker_mb'] = round(max(workers), 1)
+    finally:
+        runtime.close()
+    return phases, rss
+
+
+def compare(report, baseline, tolerance):
+    """Returns the regressions of report against a baseline report (a list of messages)."""
+    current, previous = report.get('sweep'), baseline.get('sweep')
+    if not current or not previous:
+        return list()
+    regressions = list()
+    if previous['requests_per_second'] and current['requests_per_second'] is not None and \
+            current['requests_per_second'] < previous['requests_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput dropped from {previous['requests_per_second']} to "
+                           f"{current['requests_per_second']} requests/s")
+    if previous['p99_ms'] and current['p99_ms'] is not None and \
+            current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+        regressions.append(f"p99 latency grew from {previous['p99_ms']} to {current['p99_ms']} ms")
+    return regressions
+
+
+def print_report(report):
+    def cell(value):
+        return '-' if value is None else value
+
+    print(f"\nBenchmark of {report['devices']} simulated devices, execution_mode "
+          f"{report['config']['execution_mode']}, max_workers {report['config']['max_workers']}, "
+          f"latency {report['config']['latency_ms']} ms\n")
+    print(f"{'phase':<32}{'wall s':>9}{'requests':>10}{'req/s':>10}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'failed':>8}")
+    for phase in report['phases']:
+        print(f"{phase['phase']:<32}{phase['wall_seconds']:>9}{phase['requests']:>10}"
+              f"{cell(phase['requests_per_second']):>10}{cell(phase['p50_ms']):>9}"
+              f"{cell(phase['p99_ms']):>9}{phase['failed']:>8}")
+    sweep = report['sweep']
+    if sweep:
+        print(f"\nSweeps: {sweep['wall_seconds']} s mean wall time, "
+              f"{cell(sweep['requests_per_second'])} requests/s, p50 {cell(sweep['p50_ms'])} ms, "
+              f"p99 {cell(sweep['p99_ms'])} ms, {sweep['failed']} failed")
+    rss = report['peak_rss']
+    line = f"Peak RSS: {rss['benchmark_mb']} MB"
+    if 'shard_workers_mb' in rss:
+        line += (f", shard workers {rss['shard_workers_mb']} MB in total "
+                 f"(largest {rss['largest_shard_worker_mb']} MB)")
+    print(line)
+
+
+def main(argv=None):
+    """python3 -m panfw benchmark: runs the phases against a simulated fleet."""
+    parser = argparse.ArgumentParser(prog='python3 -m panfw benchmark',
+                                     description='Load benchmark against the offline simulator')
+    add_fleet_arguments(parser)
+    parser.add_argument('--mode', default='threads',
+                        choices=('serial', 'threads', 'asyncio', 'processes'),
+                        help='execution_mode of the run (default threads)')
+    parser.add_argument('--max-workers', type=int, default=64)
+    parser.add_argument('--shards', type=int, help='Shard workers with --mode processes')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='firewall_timeout of the run in seconds')
+    parser.add_argument('--sweeps', type=int, default=3)
+    parser.add_argument('--tasks', default=','.join(DEFAULT_TASKS),
+                        help='Comma separated tasks run in every sweep (default satellite-reset)')
+    parser.add_argument('--pooled-transport', action='store_true',
+                        help='Use the pooled keep-alive transport')
+    parser.add_argument('--keygen', action='store_true',
+                        help='Leave the API keys out, initialize generates them')
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE',
+                        help='Any other config.yml key of the run, e.g. --set log_queue=true')
+    parser.add_argument('--json', metavar='FILE', help='Write the report to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Report of an earlier run, exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed regression against the baseline (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+    args.tasks = [task.strip() for task in args.tasks.split(',') if task.strip()]
+    if 'rule-reorder' in args.tasks and not args.rules:
+        args.rules = 100
+
+    workdir = tempfile.mkdtemp(prefix='panfw-benchmark-')
+    sim = simulator_from_args(args)
+    try:
+        sim.start()
+    except (ValueError, OSError) as e:
+        print(f'Could not start the simulator: {e}')
+        shutil.rmtree(workdir, ignore_errors=True)
+        return 1
+    try:
+        cfgdict = benchmark_config(sim, args, workdir)
+        from panfw.core import setup_logging
+        setup_logging(cfgdict, console=False)
+        print(f"Benchmark log: {os.path.join(cfgdict['log_path'], 'ngfw-control-script.log')}")
+        phases, rss = run_benchmark(sim, cfgdict, args.tasks, args.sweeps, workdir)
+    finally:
+        sim.stop()
+
+    report = {'time': time.time(),
+              'devices': args.devices,
+              'config': {'execution_mode': args.mode, 'max_workers': args.max_workers,
+                         'pooled_transport': args.pooled_transport, 'tasks': args.tasks,
+                         'latency_ms': args.latency, 'error_rate': args.error_rate,
+                         'ha_fraction': args.ha_fraction, 'slow_fraction': args.slow_fraction},
+              'phases': phases,
+              'sweep': sweep_summary([phase for phase in phases
+                                      if phase['phase'].startswith('sweep')]),
+              'peak_rss': rss}
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+        print(f'Report written to {args.json}')
+
+    if args.baseline:
+        try:
+            with open(args.baseline) as infile:
+                baseline = json.load(infile)
+        except (OSError, ValueError) as e:
+            print(f'Could not read the baseline {args.baseline}: {e}')
+            return 1
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"REGRESSION against {args.baseline}: {'; '.join(regressions)}")
+            return 1
+        print(f'No regression against {args.baseline} (tolerance {args.tolerance:.0%})')
+    return 0
@@ -0,0 +1,178 @@
+"""
+Module:       panfw/bootstrap.py
+
+Description:
+Parallel, non-interactive start-up path for the firewall fleet. API keys are
+resolved for all firewalls at once (config.yml, environment, an API key file
+or a batch credentials file), missing keys are generated concurrently, HA
+peers are attached and config.yml is written a single time at the end.
+Cold start is bounded by the slowest device instead of the sum of all.
+"""
+
+import os
+import re
+import sys
+import getpass
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+app_log = logging.getLogger('root')
+
+# Per firewall variable, e.g. PANFW_API_KEY_192_168_1_1 for 192.168.1.1
+API_KEY_ENV_PREFIX = 'PANFW_API_KEY_'
+# Fleet wide fallback key
+API_KEY_ENV = 'PANFW_API_KEY'
+
+
+def env_var_name(fw_addr):
+    """Returns the environment variable holding the API key of fw_addr."""
+    return API_KEY_ENV_PREFIX + re.sub(r'[^0-9A-Za-z]', '_', fw_addr).upper()
+
+
+def load_yaml_file(path):
+    """Loads an optional YAML file, returns an empty dict when it is not set or missing."""
+    if not path:
+        return dict()
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        app_log.warning(f"File {path} referenced in config.yml does not exist")
+        return dict()
+    import yaml
+    with open(path, 'r') as ymlfile:
+        return yaml.safe_load(ymlfile) or dict()
+
+
+def resolve_api_key(fw_addr, fw_cfg, api_keys):
+    """Looks up an existing API key without talking to the firewall.
+
+    Arguments:
+        fw_addr {str} -- Firewall address as used in config.yml
+        fw_cfg {dict} -- The firewall's entry in config.yml
+        api_keys {dict} -- Contents of api_key_file (hostname: api_key)
+
+    Returns:
+        str -- API key or None when it still has to be generated
+    """
+    for api_key in (fw_cfg.get('api_key'),
+                    os.environ.get(env_var_name(fw_addr)),
+                    api_keys.get(fw_addr),
+                    os.environ.get(API_KEY_ENV)):
+        if api_key:
+            return api_key
+    return None
+
+
+def resolve_credentials(fw_addr, credentials, interactive):
+    """Returns (username, password) for API key generation.
+
+    Arguments:
+        fw_addr {str} -- Firewall address as used in config.yml
+        credentials {dict} -- Contents of credentials_file. Entries are keyed
+                              by firewall address with a 'default' fallback.
+        interactive {bool} -- Prompt on the terminal when nothing was found
+
+    Returns:
+        tuple -- (username, password) or (None, None)
+    """
+    entry = credentials.get(fw_addr) or credentials.get('default')
+    if entry and entry.get('username') and entry.get('password'):
+        return entry['username'], entry['password']
+    if interactive:
+        print(f"Please enter the username and password for API access to {fw_addr}.")
+        username = input("Enter username: ")
+        password = getpass.getpass()
+        return username, password
+    return None, None
+
+
+def initialize_fleet(cfgdict, fw_factory, save_func, max_workers=32, interactive=None,
+                     hostnames=None):
+    """Builds the Firewall objects of all firewalls in config.yml concurrently.
+
+    Arguments:
+        cfgdict {dict} -- Parsed config.yml, updated in place with new API keys
+        fw_factory {callable} -- Firewall class (or compatible factory)
+        save_func {callable} -- Called once with cfgdict when keys were generated
+
+    Keyword Arguments:
+        max_workers {int} -- Number of firewalls initialized at the same time
+        interactive {bool} -- Allow prompting for credentials. Defaults to
+                              True only when stdin is a terminal and
+                              non_interactive is not set in config.yml.
+        hostnames {list} -- Only initialize these firewalls (default: all).
+                            config.yml is still written as a whole.
+
+    Returns:
+        list -- Firewall objects with HA peers attached
+    """
+    fw_dict = cfgdict['firewalls']
+    if interactive is None:
+        interactive = sys.stdin.isatty() and not cfgdict.get('non_interactive')
+    api_keys = load_yaml_file(cfgdict.get('api_key_file'))
+    credentials = load_yaml_file(cfgdict.get('credentials_file'))
+    verify = cfgdict.get('verify_connectivity', False)
+
+    # Resolve what can be resolved locally first, then ask for the rest in one
+    # go so that prompts never interleave with the parallel work below.
+    plans = dict()
+    for fw_addr, fw_cfg in fw_dict.items():
+        if hostnames is not None and fw_addr not in hostnames:
+            continue
+        fw_cfg = fw_cfg or dict()
+        api_key = resolve_api_key(fw_addr, fw_cfg, api_keys)
+        username = password = None
+        if api_key is None:
+            username, password = resolve_credentials(fw_addr, credentials, interactive)
+            if username is None:
+                app_log.error(
+                    f"No API key or credentials found for firewall {fw_addr}, skipping it")
+                continue
+        plans[fw_addr] = (api_key, username, password)
+
+    def init_one(fw_addr):
+        api_key, username, password = plans[fw_addr]
+        fw_cfg = fw_dict[fw_addr] or dict()
+        # Management API port, only passed on when it is not the default
+        port_args = {'port': fw_cfg['port']} if fw_cfg.get('port') else dict()
+        generated = False
+        if api_key is None:
+            fw_obj = fw_factory(fw_addr, api_username=username,
+                                api_password=password, timeout=5, **port_args)
+            api_key = fw_obj.api_key
+            generated = True
+            app_log.info(
+                f"API Key generated for firewall {fw_addr} for username {username}")
+        else:
+            fw_obj = fw_factory(fw_addr, api_key=api_key, timeout=5, **port_args)
+        ha_peer_ip = fw_cfg.get('ha_peer_ip')
+        if ha_peer_ip:
+            fw_obj.set_ha_peers(fw_factory(ha_peer_ip, api_key=api_key, timeout=5, **port_args))
+        if verify:
+            for member in fw_obj.ha_pair():
+                try:
+                    member.refresh_system_info()
+                except Exception as e:
+                    app_log.warning(f"Firewall {member.hostname} is not reachable: {e}")
+        return fw_obj, api_key, generated
+
+    fw_objs = list()
+    config_dirty = False
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = [(fw_addr, pool.submit(init_one, fw_addr)) for fw_addr in plans]
+        for fw_addr, future in futures:
+            try:
+                fw_obj, api_key, generated = future.result()
+            except Exception as e:
+                app_log.error(f"Could not initialize connection to {fw_addr}: {e}")
+                continue
+            fw_objs.append(fw_obj)
+            if generated:
+                if fw_dict[fw_addr] is None:
+                    fw_dict[fw_addr] = dict()
+                fw_dict[fw_addr]['api_key'] = api_key
+                config_dirty = True
+
+    if config_dirty:
+        save_func(cfgdict)
+        app_log.info("config.yml updated with newly generated API keys")
+    return fw_objs
@@ -0,0 +1,86 @@
+"""
+Module:       panfw/cli.py
+
+Description:
+Single entry point for the scripts of this repository:
+
+    python3 -m panfw <command> [-debug]
+
+The task commands run a single built-in task, 'run' runs the tasks listed
+under tasks: in config.yml together in one process (see panfw/core.py).
+'simulate' and 'benchmark' run the offline load tests (see
+panfw/simulator.py and panfw/benchmark.py).
+Only the standard library is imported before a command runs, so listing the
+commands or compiling the config snapshot is instant, and the runtime
+imports what it needs when it needs it (see panfw/startup.py).
+"""
+
+import sys
+
+# command: (task, description)
+COMMANDS = {
+    'satellite-reset': ('satellite-reset',
+                        'Check GP satellite connections and recover broken ones'),
+    'api-interaction': ('api-interaction',
+                        'Generic per-firewall API interaction template'),
+    'rule-reorder': ('rule-reorder',
+                     'Reorder security rules on Panorama or firewalls'),
+    'run': (None,
+            'Run the tasks listed under tasks: in config.yml in one process'),
+    'compile-config': (None,
+                       'Validate config.yml and store the snapshot used with config_cache'),
+    'history': (None,
+                'Show the health history of the fleet (history_db, see --help)'),
+    'simulate': (None,
+                 'Serve a simulated fleet on loopback addresses (see --help)'),
+    'benchmark': (None,
+                  'Measure sweeps against the simulator, compare with a baseline'),
+}
+
+
+def usage():
+    lines = ["Usage: python3 -m panfw <command> [-debug]", "", "Commands:"]
+    lines.extend(f"  {name:<18}{description}" for name, (_, description) in COMMANDS.items())
+    return '\n'.join(lines)
+
+
+def compile_config(config_file='config.yml'):
+    """Writes the config snapshot regardless of config_cache, e.g. from a deployment job."""
+    from panfw.config import read_config, write_cache, cache_path
+    try:
+        cfg = read_config(config_file)
+    except (OSError, ValueError) as e:
+        print(f"Config file '{config_file}' not found or couldn't be loaded: {e}")
+        return 1
+    write_cache(config_file, cfg)
+    print(f"Config snapshot written to {cache_path(config_file)}")
+    if not cfg.get('config_cache'):
+        print("Note: set config_cache: true in config.yml, else the scripts remove the snapshot")
+    return 0
+
+
+def main(argv=None):
+    """Runs a command, returns the exit code."""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help', 'help'):
+        print(usage())
+        return 0
+    command, args = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"Unknown command '{command}'\n\n{usage()}")
+        return 2
+    if command == 'compile-config':
+        # Flags such as -debug are not the path of the config file
+        return compile_config(*[arg for arg in args if not arg.startswith('-')][:1])
+    if command == 'history':
+        from panfw.history import main as history
+        return history(args)
+    if command == 'simulate':
+        from panfw.simulator import main as simulate
+        return simulate(args)
+    if command == 'benchmark':
+        from panfw.benchmark import main as benchmark
+        return benchmark(args)
+    from panfw.core import main as run_tasks
+    task = COMMANDS[command][0]
+    return run_tasks([task] if task else None)
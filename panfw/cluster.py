@@ -0,0 +1,216 @@
+"""
+Module:       panfw/cluster.py
+
+Description:
+Coordination of several daemon instances (nodes) through a small SQLite
+database on shared storage. Every node writes a heartbeat; the firewalls are
+partitioned across the live nodes by rendezvous hashing, so when a node stops
+heartbeating only its firewalls move to the remaining nodes. Disruptive
+actions (satellite reconnect, restart, commit) take a lease on the device
+first, so only one node acts on a device, even right after a rebalance.
+
+SQLite locking relies on the file locks of the shared file system. Use a
+local path when all nodes run on one host, and NFS / SMB mounts with working
+locks otherwise.
+"""
+
+import time
+import socket
+import sqlite3
+import logging
+import threading
+
+from panfw.sharding import stable_hash
+
+app_log = logging.getLogger('root')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, heartbeat REAL, started REAL)',
+    'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)',
+)
+
+
+def rendezvous_owner(key, nodes):
+    """Returns the node of nodes that owns key (highest random weight)."""
+    return max(nodes, key=lambda node: stable_hash(f'{node}|{key}'), default=None)
+
+
+class ClusterCoordinator(object):
+    """Membership, partitioning and per-device leases of one node."""
+
+    def __init__(self, path, node_id=None, heartbeat_interval=10, node_ttl=30, lease_ttl=300):
+        """
+        Arguments:
+            path {str} -- SQLite database shared by all nodes
+
+        Keyword Arguments:
+            node_id {str} -- Unique name of this node (default: host name)
+            heartbeat_interval {float} -- Seconds between heartbeats
+            node_ttl {float} -- A node without heartbeat for this long is
+                                considered dead and its firewalls move
+            lease_ttl {float} -- Default seconds a device stays reserved for
+                                 the node that ran a disruptive action on it
+        """
+        self.path = path
+        self.node_id = node_id or socket.gethostname()
+        self.heartbeat_interval = heartbeat_interval
+        self.node_ttl = node_ttl
+        self.lease_ttl = lease_ttl
+        self._nodes = [self.node_id]
+        self._stop = threading.Event()
+        self._thread = None
+        with self._connect() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    @classmethod
+    def from_config(cls, cfgdict):
+        """Build the coordinator from the cluster_* keys of config.yml.
+
+        Returns:
+            ClusterCoordinator -- or None when cluster_db is not set
+        """
+        if not cfgdict.get('cluster_db'):
+            return None
+        return cls(cfgdict['cluster_db'], node_id=cfgdict.get('cluster_node_id'),
+                   heartbeat_interval=cfgdict.get('cluster_heartbeat') or 10,
+                   node_ttl=cfgdict.get('cluster_node_ttl') or 30,
+                   lease_ttl=cfgdict.get('cluster_lease_ttl') or 300)
+
+    def _connect(self):
+        # A short lived connection per call, safe across threads and processes
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute('PRAGMA busy_timeout = 10000')
+        return _Transaction(db)
+
+    # Membership
+
+    def heartbeat(self):
+        """Records this node as alive and refreshes the list of live nodes.
+
+        Returns:
+            list -- Live node ids, sorted
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO nodes (node_id, heartbeat, started) VALUES (?, ?, ?)',
+                       (self.node_id, now, now))
+            db.execute('UPDATE nodes SET heartbeat = ? WHERE node_id = ?', (now, self.node_id))
+            nodes = sorted(row[0] for row in db.execute(
+                'SELECT node_id FROM nodes WHERE heartbeat >= ?', (now - self.node_ttl,)))
+        if nodes != self._nodes:
+            app_log.info(f"Cluster nodes changed: {', '.join(self._nodes)} -> {', '.join(nodes)}")
+        self._nodes = nodes
+        return nodes
+
+    def nodes(self):
+        """Live nodes as of the last heartbeat."""
+        return list(self._nodes)
+
+    def owner_of(self, hostname):
+        """Node responsible for polling a firewall."""
+        return rendezvous_owner(hostname, self._nodes)
+
+    def owns(self, hostname):
+        """True when this node is responsible for polling a firewall."""
+        return self.owner_of(hostname) == self.node_id
+
+    def assigned(self, hostnames):
+        """Returns the hostnames this node is responsible for."""
+        return [hostname for hostname in hostnames if self.owns(hostname)]
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                # Keep the last view, leases fail closed while the database is away
+                app_log.error(f"Cluster heartbeat to {self.path} failed: {e}")
+
+    def start(self):
+        """Joins the cluster and keeps heartbeating on a background thread."""
+        self.heartbeat()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='cluster-heartbeat', daemon=True)
+            self._thread.start()
+        app_log.info(f"Node {self.node_id} joined the cluster, live nodes: {', '.join(self._nodes)}")
+
+    def stop(self):
+        """Leaves the cluster, the other nodes take over right away."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        try:
+            with self._connect() as db:
+                # Leases are kept until they expire, a device this node just
+                # restarted must not be restarted again by the next owner
+                db.execute('DELETE FROM nodes WHERE node_id = ?', (self.node_id,))
+        except sqlite3.Error as e:
+            app_log.error(f"Could not leave the cluster: {e}")
+
+    # Leases
+
+    def acquire(self, name, ttl):
+        """Takes (or extends) the lease name for ttl seconds.
+
+        Returns:
+            Boolean -- True when this node holds the lease
+        """
+        now = time.time()
+        try:
+            with self._connect() as db:
+                row = db.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+                if row is not None and row[0] != self.node_id and row[1] > now:
+                    return False
+                db.execute('INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)',
+                           (name, self.node_id, now + ttl))
+                return True
+        except sqlite3.Error as e:
+            app_log.error(f"Could not acquire lease {name}: {e}")
+            return False
+
+    def release(self, name):
+        """Gives up the lease name if this node holds it."""
+        with self._connect() as db:
+            db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, self.node_id))
+
+    def try_action(self, hostname, action, ttl=None):
+        """Guards a disruptive action on a device.
+
+        One lease per device covers all disruptive actions, so two nodes never
+        reconnect, restart or commit the same device within ttl seconds.
+
+        Arguments:
+            hostname {str} -- Firewall the action runs on
+            action {str} -- Name of the action, for the log
+
+        Keyword Arguments:
+            ttl {float} -- Seconds the device stays reserved for this node
+                           (default lease_ttl)
+
+        Returns:
+            Boolean -- True when this node may run the action
+        """
+        if self.acquire(f'device:{hostname}', self.lease_ttl if ttl is None else ttl):
+            return True
+        app_log.info(f"Skipping {action} on {hostname}, another node holds its lease")
+        return False
+
+
+class _Transaction(object):
+    """Runs the statements of a with block in one immediate transaction."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.db.close()
@@ -0,0 +1,156 @@
+"""
+Module:       panfw/config.py
+
+Description:
+Loading and saving of config.yml, shared by the scripts. With config_cache
+enabled the validated config is also kept as a pickled snapshot next to
+config.yml ('.config.yml.cache'), tagged with the modification time and
+size of the YAML file. As long as config.yml is unchanged, later runs load
+the snapshot and skip importing PyYAML and parsing the file, which is most
+of the config loading time of a large fleet. The snapshot holds the same
+API keys as config.yml and is only read when it belongs to the current user.
+"""
+
+import os
+import sys
+import pickle
+import logging
+
+from panfw.executor import EXECUTION_MODES
+from panfw.startup import startup_timer
+
+app_log = logging.getLogger('root')
+
+CACHE_VERSION = 1
+
+
+def validate_config(cfg):
+    """Checks a parsed config.yml, raises ValueError describing the first problem."""
+    if not isinstance(cfg, dict):
+        raise ValueError("config.yml must be a mapping")
+    firewalls = cfg.get('firewalls')
+    if not isinstance(firewalls, dict) or not firewalls:
+        raise ValueError("'firewalls' must be a non-empty mapping of firewall addresses")
+    for hostname, fw_cfg in firewalls.items():
+        if fw_cfg is not None and not isinstance(fw_cfg, dict):
+            raise ValueError(f"Entry of firewall {hostname} must be a mapping")
+        interval = (fw_cfg or dict()).get('check_interval')
+        if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+            raise ValueError(f"check_interval of firewall {hostname} must be a positive number")
+    interval = cfg.get('check_interval')
+    if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+        raise ValueError("check_interval must be a positive number")
+    mode = cfg.get('execution_mode')
+    if mode is not None and mode not in EXECUTION_MODES + ('processes',):
+        raise ValueError(f"Unknown execution_mode '{mode}'")
+    if cfg.get('push_http_port'):
+        from panfw.receiver import check_config
+        check_config(cfg)
+    return cfg
+
+
+def read_config(config_file='config.yml'):
+    """Parses and validates a YAML config file.
+
+    Raises:
+        OSError -- The file could not be read
+        ValueError -- The file is not valid YAML or not a valid config
+
+    Returns:
+        dict -- The config
+    """
+    import yaml
+    with open(config_file, 'r') as ymlfile:
+        try:
+            cfg = yaml.safe_load(ymlfile)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e))
+    return validate_config(cfg)
+
+
+def cache_path(config_file):
+    """Returns the path of the config snapshot of config_file."""
+    head, tail = os.path.split(config_file)
+    return os.path.join(head, f'.{tail}.cache')
+
+
+def _signature(config_file):
+    stat = os.stat(config_file)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_cache(config_file):
+    """Returns the config snapshot of config_file, or None when there is no
+    snapshot or config.yml changed since it was taken.
+    """
+    path = cache_path(config_file)
+    try:
+        if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+            app_log.warning(f"Ignoring {path}, it does not belong to the current user")
+            return None
+        with open(path, 'rb') as cachefile:
+            snapshot = pickle.load(cachefile)
+        if snapshot.get('version') != CACHE_VERSION or snapshot.get('signature') != _signature(config_file):
+            return None
+        return snapshot['config']
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        app_log.warning(f"Ignoring unreadable config snapshot {path}: {e}")
+        return None
+
+
+def write_cache(config_file, cfg):
+    """Stores the snapshot of the validated config of config_file."""
+    path = cache_path(config_file)
+    tmp_path = f'{path}.tmp'
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as cachefile:
+            pickle.dump({'version': CACHE_VERSION, 'signature': _signature(config_file),
+                         'config': cfg}, cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        app_log.warning(f"Could not write config snapshot {path}: {e}")
+
+
+def remove_cache(config_file):
+    try:
+        os.remove(cache_path(config_file))
+    except OSError:
+        pass
+
+
+def load_config(config_file='config.yml'):
+    """Loads config.yml, from its snapshot when config_cache is enabled and
+    the file did not change. Exits when the config cannot be loaded.
+
+    Keyword Arguments:
+        config_file {str} -- Path of the YAML config
+
+    Returns:
+        dict -- The config
+    """
+    try:
+        cfg = read_cache(config_file)
+        if cfg is not None:
+            startup_timer.mark('config (cached)')
+            return cfg
+        cfg = read_config(config_file)
+    except (OSError, ValueError) as e:
+        print(f"Config file '{config_file}' not found or couldn't be loaded: {e}")
+        sys.exit(1)
+    if cfg.get('config_cache'):
+        write_cache(config_file, cfg)
+    else:
+        remove_cache(config_file)
+    startup_timer.mark('config')
+    return cfg
+
+
+def save_config(cfgdict, config_file='config.yml'):
+    """Writes cfgdict back to config.yml (the snapshot is refreshed on the next load)."""
+    import yaml
+    with open(config_file, 'w') as outfile:
+        yaml.dump(cfgdict, outfile, default_flow_style=False)
+    return
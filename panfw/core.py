@@ -0,0 +1,575 @@
+"""
+Module:       panfw/core.py
+
+Description:
+Shared runtime of the scripts. A Runtime loads config.yml once, sets up
+logging and builds the components every task uses: one set of Firewall
+objects (behind the rate limit / circuit breaker), the pooled transport, the
+HA active member cache, the cluster coordinator, the health history, the
+action planner and the worker pool.
+
+The per-firewall logic lives in tasks (subclasses of Task, see panfw/tasks).
+Several tasks can run in one daemon process on a single schedule, so a
+management plane gets one client and one set of connections instead of one
+per script. Built-in tasks are referenced by name (TASKS), own tasks as
+'package.module:ClassName'.
+"""
+
+import os
+import sys
+import time
+import getpass
+import logging
+import importlib
+import logging.handlers as lh
+
+from panfw.startup import startup_timer, LazyImport
+from panfw.config import load_config, save_config
+from panfw.executor import FleetExecutor, FirewallResult, summarize
+from panfw.hacache import HAStateCache
+from panfw.throttle import DeviceGuard, guard_firewalls
+from panfw.metrics import MetricsExporter, metrics, observe_result
+from panfw.planner import ActionPlanner
+from panfw.logpipe import make_formatter, install_queue
+
+# The optional components (sharding, cluster, history, pooled transport,
+# daemon scheduler, config reload, push receiver, parallel start-up) are
+# imported where the config enables them: a plain one-shot run loads neither
+# multiprocessing nor sqlite3 nor ssl before pan-os-python does.
+
+app_log = logging.getLogger('root')
+
+# pan-os-python is the slowest import by far, it is only imported when the
+# first Firewall object is created
+Firewall = LazyImport('panos.firewall', 'Firewall', 'pan-os-python')
+
+# Built-in tasks, name: 'module:class'
+TASKS = {
+    'satellite-reset': 'panfw.tasks.satellite_reset:SatelliteResetTask',
+    'rule-reorder': 'panfw.tasks.rule_reorder:RuleReorderTask',
+    'api-interaction': 'panfw.tasks.api_interaction:ApiInteractionTask',
+}
+
+LOG_FILE_NAME = 'ngfw-control-script.log'
+LOG_ROTATION_SIZE = 10 * 1024 * 1024  # Size in bytes (This is 10 MB)
+
+
+def get_config_param(dictpath, param):
+    if not param in dictpath.keys():
+        return None
+    else:
+        return dictpath[param]
+    return None
+
+
+def setup_logging(cfgdict, debug=False, console=True):
+    """Logs to a rotating file below log_path and to the console, in the
+    log_format of config.yml (text or json). With log_queue the handlers run
+    on a listener thread (see panfw/logpipe.py), except for execution_mode:
+    processes, whose shard workers are forked before any thread starts.
+
+    Arguments:
+        cfgdict {dict} -- Parsed config.yml
+
+    Keyword Arguments:
+        debug {bool} -- Log debug messages (-debug on the command line)
+        console {bool} -- Also log to the console (the benchmark only logs to the file)
+    """
+    log_path = get_config_param(cfgdict, 'log_path') or './logs'
+    if not os.path.exists(log_path):
+        os.mkdir(log_path)
+    log_formatter = make_formatter(get_config_param(cfgdict, 'log_format') or 'text')
+
+    file_handler = lh.RotatingFileHandler(
+        os.path.join(log_path, LOG_FILE_NAME), maxBytes=LOG_ROTATION_SIZE, backupCount=3)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(logging.INFO)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+    console_handler.setLevel(logging.DEBUG)
+
+    app_log.setLevel(logging.DEBUG if debug else logging.INFO)
+    app_log.addHandler(file_handler)
+    if console:
+        app_log.addHandler(console_handler)
+    if get_config_param(cfgdict, 'log_queue') and \
+            get_config_param(cfgdict, 'execution_mode') != 'processes':
+        install_queue(app_log)
+    return app_log
+
+
+def get_credentials(fw_addr):
+    app_log.info(
+        f"API Key for firewall {fw_addr} is not defined in config.yml")
+    print("Please enter the username and password for the user for the API access.")
+    print("Configuration file (config.yml) will be updated automatically once the API Key is created.")
+    username = input("Enter username: ")
+    password = getpass.getpass()
+    return username, password
+
+
+def gen_api_key(fw_addr, username='', password=''):
+    if not (len(username) or len(password)):
+        username, password = get_credentials(fw_addr)
+        try:
+            fw_obj = Firewall(fw_addr,
+                              api_username=username,
+                              api_password=password)
+            if fw_obj.api_key:
+                app_log.info(
+                    f"API Key generated for firewall {fw_addr} for username {username}")
+                return fw_obj, fw_obj.api_key
+        except BaseException as e:
+            app_log.error("Error generating API Key")
+            app_log.exception(f"Got exception in gen_api_key: {e}")
+            exit(1)
+
+
+def load_task(spec):
+    """Returns the Task class of a built-in task name or a 'module:ClassName' spec."""
+    if isinstance(spec, type):
+        return spec
+    path = TASKS.get(spec, spec)
+    if ':' not in path:
+        raise ValueError(
+            f"Unknown task '{spec}', expected one of {', '.join(TASKS)} or 'module:ClassName'")
+    module_name, class_name = path.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class Task(object):
+    """Base class of the per-firewall logic run by a Runtime.
+
+    Subclasses set name and implement run(fw). State that is built from the
+    config belongs in setup(), which runs again in a shard worker process
+    after it moved over to its own state files (execution_mode: processes).
+    Shared components are reached through self.runtime (cfgdict, ha_cache,
+    transport, cluster, executor, history); always go through the runtime instead of
+    keeping references, the runtime swaps them on config reload and in shard
+    workers.
+    """
+
+    name = None
+    # Run right away on a firewall that pushed a matching log event (see push_syslog_port)
+    event_triggered = False
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.setup()
+
+    def setup(self):
+        """Builds the state of the task from self.runtime.cfgdict."""
+
+    def applies_to(self, hostname):
+        """True when the task runs on a firewall. A tasks list in the firewall
+        entry limits the firewall to the tasks named there.
+        """
+        tasks = get_config_param(self.runtime.firewall_config(hostname), 'tasks')
+        return tasks is None or self.name in tasks
+
+    def interval(self, hostname):
+        """Daemon mode interval of the task on a firewall: check_interval of the
+        firewall entry, else task_intervals of config.yml, else the scheduler
+        default (the global check_interval).
+        """
+        return get_config_param(self.runtime.firewall_config(hostname), 'check_interval') or \
+            (get_config_param(self.runtime.cfgdict, 'task_intervals') or dict()).get(self.name)
+
+    def run(self, fw):
+        """Runs the task once on a firewall (or HA pair), returns its result."""
+        raise NotImplementedError
+
+    def healthy(self, res):
+        """True when a FirewallResult shows nothing to watch closely, False when
+        it does. Used by adaptive_polling to stretch or reset the interval;
+        None (the default) keeps the interval as configured.
+        """
+        return None
+
+    def run_all(self, fw_objs):
+        """Runs the task once on every firewall in fw_objs.
+
+        Returns:
+            list -- FirewallResult per firewall
+        """
+        return self.runtime.executor.run(fw_objs, TaskCall(self.name))
+
+    def close(self):
+        """Releases what the task opened itself."""
+
+
+class TaskCall(object):
+    """Per-firewall call of a task by name. It is picklable, so it can be sent
+    to shard worker processes, which look the task up in their own runtime.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, fw):
+        return Runtime.active.tasks[self.name].run(fw)
+
+    def __eq__(self, other):
+        return isinstance(other, TaskCall) and other.name == self.name
+
+    def __hash__(self):
+        return hash((TaskCall, self.name))
+
+    def __repr__(self):
+        return f'TaskCall({self.name!r})'
+
+
+class Runtime(object):
+    """Config, shared components and tasks of one process."""
+
+    # Runtime of this process, used by TaskCall
+    active = None
+
+    def __init__(self, cfgdict, tasks, config_file='config.yml'):
+        """
+        Arguments:
+            cfgdict {dict} -- Parsed config.yml
+            tasks {list} -- Task classes or specs (see load_task)
+
+        Keyword Arguments:
+            config_file {str} -- Where generated API keys are saved
+        """
+        self.cfgdict = cfgdict
+        self.config_file = config_file
+        # Rate limit and circuit breaker per management plane (see device_guard)
+        self.device_guard = DeviceGuard.from_config(cfgdict)
+        # Check results, gateway states and actions per device (None without history_db)
+        self.history = None
+        if get_config_param(cfgdict, 'history_db'):
+            from panfw.history import HealthHistory
+            self.history = HealthHistory.from_config(cfgdict)
+        # Last known active member of every HA pair (see ha_cache_ttl)
+        self.ha_cache = HAStateCache.from_config(cfgdict, self.history)
+        # Partitioning and device leases across daemon nodes (None without cluster_db)
+        self.cluster = None
+        if get_config_param(cfgdict, 'cluster_db'):
+            from panfw.cluster import ClusterCoordinator
+            self.cluster = ClusterCoordinator.from_config(cfgdict)
+        # Reconnects, restarts and rule moves of the tasks, batched per cycle (see dry_run)
+        self.planner = self.make_planner()
+        # Keep-alive HTTPS sessions for op commands (None uses pan-os-python, see pooled_transport)
+        self.transport = None
+        if get_config_param(cfgdict, 'pooled_transport'):
+            from panfw.transport import PooledTransport
+            self.transport = PooledTransport.from_config(cfgdict, guard=self.device_guard)
+        # Worker pool of the per-firewall calls (see execution_mode), one
+        # worker process per shard of the fleet for execution_mode: processes
+        if get_config_param(cfgdict, 'execution_mode') == 'processes':
+            from panfw.sharding import ShardedExecutor
+            self.executor = ShardedExecutor.from_config(cfgdict, self.init_shard)
+        else:
+            self.executor = FleetExecutor.from_config(cfgdict)
+        # /metrics endpoint and JSON file (None without metrics_port / metrics_file)
+        self.metrics = MetricsExporter.from_config(cfgdict)
+        metrics.gauge_callback('panfw_queue_depth', self.executor.pending)
+        self.scheduler = None
+        # Syslog / HTTP receiver of pushed log events (daemon mode, see push_syslog_port)
+        self.receiver = None
+        self.fw_objs = dict()
+        Runtime.active = self
+        self.tasks = dict()
+        for spec in tasks:
+            task = load_task(spec)(self)
+            self.tasks[task.name] = task
+        if self.executor.mode == 'processes':
+            # Forked before this process starts any thread (see panfw/sharding.py)
+            self.executor.start(get_config_param(cfgdict, 'firewalls') or ())
+
+    @classmethod
+    def from_config(cls, tasks=None, config_file='config.yml', argv=None):
+        """Loads config.yml, sets up logging and builds the runtime.
+
+        Keyword Arguments:
+            tasks {list} -- Task classes or specs, default the tasks list of config.yml
+            config_file {str} -- Path of config.yml
+            argv {list} -- Command line flags (default sys.argv), -debug enables debug logging
+
+        Returns:
+            Runtime -- The runtime
+        """
+        startup_timer.mark('imports')
+        cfgdict = load_config(config_file)
+        setup_logging(cfgdict, '-debug' in (sys.argv if argv is None else argv))
+        tasks = tasks or get_config_param(cfgdict, 'tasks')
+        if not tasks:
+            app_log.error(f"No tasks to run, list them under tasks: in {config_file}")
+            sys.exit(1)
+        runtime = cls(cfgdict, tasks, config_file)
+        startup_timer.mark('logging and components')
+        return runtime
+
+    def make_planner(self):
+        """Builds the action planner of the current config, sites come from the
+        site key of the firewall entries.
+        """
+        return ActionPlanner.from_config(
+            self.cfgdict, cluster=self.cluster, history=self.history,
+            site_of=lambda hostname: get_config_param(self.firewall_config(hostname), 'site'))
+
+    def firewall_config(self, hostname):
+        """The firewall's entry in config.yml (an empty dict when it has none)."""
+        return self.cfgdict['firewalls'].get(hostname) or dict()
+
+    def save_config(self, cfgdict):
+        save_config(cfgdict, self.config_file)
+
+    def initialize(self, cfgdict=None, hostnames=None):
+        """Builds the Firewall objects of config.yml.
+
+        Keyword Arguments:
+            cfgdict {dict} -- Config to use (default the runtime's)
+            hostnames {list} -- Only initialize these firewalls (default: all)
+
+        Returns:
+            list -- Firewall objects
+        """
+        cfgdict = self.cfgdict if cfgdict is None else cfgdict
+        if get_config_param(cfgdict, 'parallel_init'):
+            from panfw.bootstrap import initialize_fleet
+            # Resolve keys, HA peers and connectivity for all firewalls at once
+            return guard_firewalls(initialize_fleet(cfgdict, Firewall, self.save_config,
+                                                    max_workers=get_config_param(cfgdict, 'max_workers') or 32,
+                                                    hostnames=hostnames),
+                                   self.device_guard)
+
+        fw_dict = cfgdict['firewalls']
+        fw_objs = list()
+
+        # Check for API Keys in Config
+        config_dirty = 0
+        for fw in fw_dict.keys():
+            if hostnames is not None and fw not in hostnames:
+                continue
+            app_log.info(f"Connecting to firewall {fw}")
+            try:
+                if ('api_key' not in fw_dict[fw].keys()) or (fw_dict[fw]['api_key'] == None) or (fw_dict[fw]['api_key'] == ''):
+                    fw_obj, api_key = gen_api_key(fw)
+                    fw_dict[fw]['api_key'] = api_key
+                    config_dirty = 1
+                else:
+                    fw_obj = Firewall(
+                        fw, api_key=fw_dict[fw]['api_key'], timeout=5)
+                if get_config_param(fw_dict[fw], 'port'):
+                    fw_obj.port = fw_dict[fw]['port']
+
+                if get_config_param(fw_dict[fw], 'ha_peer_ip') != None:
+                    fw2 = fw_dict[fw]['ha_peer_ip']
+                    fw_obj_ha = Firewall(fw2, api_key=fw_dict[fw]['api_key'])
+                    if get_config_param(fw_dict[fw], 'port'):
+                        fw_obj_ha.port = fw_dict[fw]['port']
+                    fw_obj.set_ha_peers(fw_obj_ha)
+
+                fw_objs.append(fw_obj)
+
+                if config_dirty:
+                    cfgdict['firewalls'] = fw_dict
+                    self.save_config(cfgdict)
+            except BaseException as e:
+                app_log.error(
+                    f"Could not initialize conneciton to {fw}: {e}")
+
+        return guard_firewalls(fw_objs, self.device_guard)
+
+    def init_shard(self, shard, hostnames):
+        """Initializes the firewalls of one shard in its worker process
+        (execution_mode: processes). The first call moves this process over to
+        the state files of the shard.
+
+        Arguments:
+            shard {int} -- Shard number
+            hostnames {list} -- Firewalls of the shard to initialize
+
+        Returns:
+            list -- Firewall objects
+        """
+        from panfw.sharding import shard_config
+        if self.cfgdict.get('shard') != shard:
+            self.cfgdict = shard_config(self.cfgdict, shard)
+            self.ha_cache = HAStateCache.from_config(self.cfgdict, self.history)
+            # The worker plans for its own firewalls, in one-shot runs the
+            # plan runs when the parent drains the workers after the sweep
+            window = self.planner.window
+            self.planner = self.make_planner()
+            self.planner.window = window
+            for task in self.tasks.values():
+                task.setup()
+        return self.initialize(shard_config(self.cfgdict, shard, hostnames))
+
+    def run_once(self):
+        """Runs every task once on the firewalls it applies to.
+
+        Returns:
+            dict -- task name: list of FirewallResult
+        """
+        fw_objs = self.initialize()
+        startup_timer.mark('firewalls')
+        startup_timer.report()
+        # The actions of a task are planned over its whole sweep
+        self.planner.window = None
+        results = dict()
+        for task in self.tasks.values():
+            start_time = time.time()
+            results[task.name] = task.run_all(
+                [fw for fw in fw_objs if task.applies_to(fw.hostname)])
+            elapsed = time.time() - start_time
+            for res in results[task.name]:
+                self.record(task.name, res)
+            self.planner.drain()
+            if self.executor.mode == 'processes':
+                self.executor.drain()
+            metrics.set('panfw_cycle_duration_seconds', elapsed, task=task.name)
+            app_log.info(
+                f'Process completed ({task.name}) in {elapsed:.2f} seconds: '
+                f'{summarize(results[task.name])}.')
+        return results
+
+    def record(self, name, res):
+        """Records the FirewallResult of a task in the metrics and the health history."""
+        observe_result(name, res)
+        if self.history is not None and not (res.error or '').startswith('busy'):
+            shard = self.executor.ring.shard_of(res.hostname) \
+                if self.executor.mode == 'processes' else None
+            self.history.record_check(name, res, shard)
+
+    def schedule(self, hostname):
+        """Adds or updates the daemon jobs of a firewall, one per task that applies to it."""
+        for task in self.tasks.values():
+            key = (task.name, hostname)
+            if not task.applies_to(hostname):
+                self.scheduler.remove(key)
+            elif key in self.scheduler:
+                self.scheduler.set_interval(key, task.interval(hostname))
+            else:
+                self.scheduler.add(key, task.interval(hostname))
+
+    def on_event(self, hostname, event):
+        """Runs the event triggered tasks of a firewall right away (called by
+        the receiver thread for a pushed log event).
+        """
+        if hostname not in self.fw_objs or self.scheduler is None:
+            return
+        for task in self.tasks.values():
+            if task.event_triggered and task.applies_to(hostname):
+                self.scheduler.trigger((task.name, hostname))
+
+    def unschedule(self, hostname):
+        """Drops the daemon jobs of a firewall."""
+        for name in self.tasks:
+            self.scheduler.remove((name, hostname))
+
+    def run_daemon(self):
+        """Daemon mode: every (task, firewall) job runs on its own fixed-rate
+        schedule with jitter (see Task.interval), and jobs that keep failing
+        are backed off.
+        """
+        from panfw.scheduler import Scheduler
+        from panfw.reload import ConfigWatcher, apply_config
+        from panfw.receiver import EventReceiver
+
+        self.fw_objs = {fw.hostname: fw for fw in self.initialize()}
+        startup_timer.mark('firewalls')
+        startup_timer.report()
+        self.scheduler = Scheduler.from_config(self.cfgdict)
+        for hostname in self.fw_objs:
+            self.schedule(hostname)
+        app_log.info(
+            f"Scheduled {len(self.scheduler)} jobs of {', '.join(self.tasks)} on "
+            f"{len(self.fw_objs)} firewalls in daemon mode.")
+        if self.cluster is not None:
+            self.cluster.start()
+        if self.metrics is not None:
+            metrics.gauge_callback('panfw_scheduled_jobs', lambda: len(self.scheduler))
+            metrics.gauge_callback('panfw_stretched_jobs', self.scheduler.stretched)
+            self.metrics.start()
+        self.receiver = EventReceiver.from_config(self.cfgdict, self.on_event)
+        if self.receiver is not None:
+            self.receiver.start()
+
+        def dispatch(key, done):
+            name, hostname = key
+            if self.cluster is not None and not self.cluster.owns(hostname):
+                # Polled by another node, looked at again on the next tick
+                done(FirewallResult(hostname, True, None, 0.0, None))
+                return
+
+            def finish(res):
+                self.record(name, res)
+                done(res, self.tasks[name].healthy(res) if name in self.tasks else None)
+
+            self.executor.submit(self.fw_objs[hostname], TaskCall(name), finish)
+
+        # Pick up edits of config.yml without a restart (see config_reload)
+        watcher = ConfigWatcher.from_config(self.cfgdict, self.config_file)
+
+        def reload_config():
+            new_cfg = watcher.poll()
+            if new_cfg is not None:
+                self.scheduler.configure(new_cfg)
+                apply_config(self.cfgdict, new_cfg, self.fw_objs,
+                             lambda hostnames: self.initialize(hostnames=hostnames),
+                             self.schedule, self.unschedule,
+                             on_remove=self.ha_cache.invalidate, executor=self.executor)
+                if self.receiver is not None:
+                    self.receiver.set_fleet(self.cfgdict)
+
+        # The metrics file is written once per check_interval
+        next_write = [time.monotonic() + self.scheduler.default_interval]
+
+        def tick():
+            if watcher is not None:
+                reload_config()
+            if self.metrics is not None and time.monotonic() >= next_write[0]:
+                self.metrics.write()
+                next_write[0] = time.monotonic() + self.scheduler.default_interval
+
+        self.scheduler.run(dispatch, tick=tick)
+
+    def close(self):
+        """Leaves the cluster and releases workers and connections."""
+        if self.receiver is not None:
+            self.receiver.stop()
+        if self.cluster is not None:
+            self.cluster.stop()
+        # Planned actions run before the workers go away, shard workers run
+        # theirs in executor.shutdown(). Checks that were still running when
+        # the threads were released are covered by planner.close()
+        self.planner.drain()
+        self.executor.shutdown()
+        self.planner.close()
+        for task in self.tasks.values():
+            task.close()
+        if self.transport is not None:
+            self.transport.close()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.history is not None:
+            self.history.close()
+
+
+def main(tasks=None, config_file='config.yml'):
+    """Runs tasks once, or forever with daemon_mode: true in config.yml.
+
+    Keyword Arguments:
+        tasks {list} -- Task classes or specs, default the tasks list of config.yml
+        config_file {str} -- Path of config.yml
+
+    Returns:
+        int -- Exit code
+    """
+    runtime = Runtime.from_config(tasks, config_file)
+    if get_config_param(runtime.cfgdict, 'daemon_mode'):
+        try:
+            runtime.run_daemon()
+        except KeyboardInterrupt as kbi:
+            app_log.warning("Ctrl+C pressed. Gracefully exiting.")
+            runtime.close()
+    else:
+        runtime.run_once()
+        runtime.close()
+    return 0
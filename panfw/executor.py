@@ -0,0 +1,307 @@
+"""
+Module:       panfw/executor.py
+
+Description:
+Runs the per-firewall body of a script's main() for every firewall in the
+fleet, either one after another (serial) or on a bounded worker pool
+(threads / asyncio). Every firewall is timed on its own and one slow or
+unreachable device never delays the result of the others: firewall_timeout
+counts from the moment a worker starts on a firewall, not from the start of
+the sweep, so firewalls queued behind max_workers busy workers are not
+reported as timed out.
+"""
+
+import math
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from panfw.logpipe import log_fields
+
+app_log = logging.getLogger('root')
+
+EXECUTION_MODES = ('serial', 'threads', 'asyncio')
+
+FirewallResult = namedtuple(
+    'FirewallResult', ['hostname', 'ok', 'result', 'elapsed', 'error'])
+
+# Seconds between two looks at firewalls still waiting for a free worker
+QUEUE_POLL = 0.05
+
+
+class FleetExecutor(object):
+    """Bounded worker pool that runs one task per firewall.
+
+    The pool is kept between calls to run() so daemon mode does not pay for
+    thread start-up on every sweep. A firewall whose task from a previous
+    sweep is still running is reported as busy instead of being queued a
+    second time, so a hung device can hold at most one worker per
+    per-firewall function.
+    """
+
+    def __init__(self, mode='serial', max_workers=16, timeout=None):
+        """
+        Arguments:
+            mode {str} -- One of 'serial', 'threads' or 'asyncio'
+            max_workers {int} -- Upper bound of concurrently polled firewalls
+            timeout {float} -- Seconds to wait for a single firewall, from
+                               the moment a worker starts on it, before
+                               reporting it as timed out (None waits forever)
+        """
+        if mode not in EXECUTION_MODES:
+            raise ValueError(
+                f"Unknown execution_mode '{mode}', expected one of {EXECUTION_MODES}")
+        self.mode = mode
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self._pool = None
+        self._pending = dict()
+
+    @classmethod
+    def from_config(cls, cfgdict):
+        """Build an executor from the top level keys of config.yml.
+
+        Arguments:
+            cfgdict {dict} -- Parsed config.yml
+
+        Returns:
+            FleetExecutor -- Configured executor
+        """
+        return cls(mode=cfgdict.get('execution_mode') or 'serial',
+                   max_workers=cfgdict.get('max_workers') or 16,
+                   timeout=cfgdict.get('firewall_timeout'))
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def run(self, fw_objs, func):
+        """Run func(fw) for every firewall and collect the results.
+
+        Arguments:
+            fw_objs {list} -- Firewall objects to work on
+            func {callable} -- Per-firewall body, called with one Firewall
+
+        Returns:
+            list -- FirewallResult per firewall, in the order of fw_objs
+        """
+        if self.mode == 'threads':
+            results = self._run_threads(fw_objs, func)
+        elif self.mode == 'asyncio':
+            results = self._run_asyncio(fw_objs, func)
+        else:
+            results = [_timed_call(fw, func) for fw in fw_objs]
+        for res in results:
+            log_result(res, getattr(func, 'name', None))
+        return results
+
+    def _submit(self, fw, func, on_start=None):
+        """Submit a timed task unless the firewall is still busy with func."""
+        previous = self._pending.get((fw.hostname, func))
+        if previous is not None and not previous.done():
+            return None
+        call = _Call(fw, func, on_start)
+        future = self._get_pool().submit(call)
+        future.call = call
+        self._pending[(fw.hostname, func)] = future
+        return future
+
+    def _queue_deadline(self, count):
+        """Latest start of the last of count queued firewalls when every call
+        before it takes the full timeout. A firewall that has not started by
+        then waits for workers held by hung firewalls.
+        """
+        return time.time() + self.timeout * math.ceil(count / self.max_workers)
+
+    def _deadline(self, future, queue_deadline):
+        start_time = future.call.start_time
+        return queue_deadline if start_time is None else start_time + self.timeout
+
+    def _expire(self, future, now, queue_deadline):
+        """True when the firewall of future ran out of time. A firewall still
+        in the queue is cancelled, it is not reported busy on the next sweep.
+        """
+        if now < self._deadline(future, queue_deadline):
+            return False
+        if future.call.start_time is None:
+            # Fails when a worker picked it up just now, its clock starts then
+            return future.cancel()
+        return True
+
+    def _timed_out(self, fw, future):
+        if future.cancelled():
+            return FirewallResult(
+                fw.hostname, False, None, 0.0, 'timed out waiting for a free worker')
+        return FirewallResult(
+            fw.hostname, False, None, time.time() - future.call.start_time, 'timed out')
+
+    def pending(self):
+        """Number of per-firewall calls submitted and not finished yet."""
+        return sum(1 for future in list(self._pending.values()) if not future.done())
+
+    def submit(self, fw, func, callback, on_start=None):
+        """Run func(fw) without waiting for it, used by the daemon scheduler.
+
+        Arguments:
+            fw {Firewall} -- Firewall to work on
+            func {callable} -- Per-firewall body, called with one Firewall
+            callback {callable} -- Called with the FirewallResult once done
+
+        Keyword Arguments:
+            on_start {callable} -- Called without arguments when a worker
+                                   starts on the firewall
+        """
+        def finish(res):
+            log_result(res, getattr(func, 'name', None))
+            callback(res)
+
+        if self.mode == 'serial':
+            finish(_Call(fw, func, on_start)())
+            return
+        future = self._submit(fw, func, on_start)
+        if future is None:
+            finish(FirewallResult(fw.hostname, False, None, 0.0, 'busy with previous cycle'))
+        else:
+            future.add_done_callback(lambda f: finish(f.result()))
+
+    def _run_threads(self, fw_objs, func):
+        futures = [(fw, self._submit(fw, func)) for fw in fw_objs]
+        waiting = {f for fw, f in futures if f is not None}
+        timed_out = set()
+        if self.timeout is None:
+            wait(waiting)
+            waiting = set()
+        else:
+            queue_deadline = self._queue_deadline(len(waiting))
+        while waiting:
+            now = time.time()
+            for future in list(waiting):
+                if future.done():
+                    waiting.discard(future)
+                elif self._expire(future, now, queue_deadline):
+                    waiting.discard(future)
+                    timed_out.add(future)
+            if not waiting:
+                break
+            # Until the next deadline, or a short while when a queued
+            # firewall may start (its deadline is not known before)
+            timeout = min(self._deadline(future, queue_deadline) for future in waiting) - now
+            if any(future.call.start_time is None for future in waiting):
+                timeout = min(timeout, QUEUE_POLL)
+            done, _ = wait(waiting, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            waiting -= done
+        results = list()
+        for fw, future in futures:
+            if future is None:
+                results.append(FirewallResult(
+                    fw.hostname, False, None, 0.0, 'busy with previous cycle'))
+            elif future in timed_out:
+                results.append(self._timed_out(fw, future))
+            else:
+                results.append(future.result())
+        return results
+
+    def _run_asyncio(self, fw_objs, func):
+        # asyncio is imported here, it is a noticeable share of the start-up
+        # time and only this mode needs it
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._gather(loop, fw_objs, func))
+        finally:
+            loop.close()
+
+    async def _gather(self, loop, fw_objs, func):
+        import asyncio
+
+        futures = [(fw, self._submit(fw, func)) for fw in fw_objs]
+        if self.timeout is not None:
+            queue_deadline = self._queue_deadline(sum(1 for _, f in futures if f is not None))
+
+        async def run_one(fw, future):
+            if future is None:
+                return FirewallResult(
+                    fw.hostname, False, None, 0.0, 'busy with previous cycle')
+            wrapped = asyncio.wrap_future(future, loop=loop)
+            if self.timeout is None:
+                return await wrapped
+            while True:
+                now = time.time()
+                if self._expire(future, now, queue_deadline):
+                    # Detaches the call from this loop, it is closed after the sweep
+                    wrapped.cancel()
+                    return self._timed_out(fw, future)
+                timeout = self._deadline(future, queue_deadline) - now
+                if future.call.start_time is None:
+                    timeout = min(timeout, QUEUE_POLL)
+                done, _ = await asyncio.wait({wrapped}, timeout=max(timeout, 0))
+                if done:
+                    return wrapped.result()
+
+        return await asyncio.gather(*[run_one(fw, future) for fw, future in futures])
+
+    def shutdown(self):
+        """Release the worker threads without waiting for hung firewalls."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        self._pending.clear()
+
+
+class _Call(object):
+    """_timed_call of one firewall on the pool, remembers when a worker
+    started on it (None while it is queued).
+    """
+
+    def __init__(self, fw, func, on_start=None):
+        self.fw = fw
+        self.func = func
+        self.on_start = on_start
+        self.start_time = None
+
+    def __call__(self):
+        self.start_time = time.time()
+        if self.on_start is not None:
+            self.on_start()
+        return _timed_call(self.fw, self.func)
+
+
+def _timed_call(fw, func):
+    """Call func(fw) and turn the outcome into a FirewallResult."""
+    start_time = time.time()
+    try:
+        result = func(fw)
+        return FirewallResult(fw.hostname, True, result, time.time() - start_time, None)
+    except Exception as e:
+        app_log.exception(f"Unhandled error while working on firewall {fw.hostname}")
+        return FirewallResult(fw.hostname, False, None, time.time() - start_time, repr(e))
+
+
+def log_result(res, task=None):
+    """Log the time and outcome of a single firewall (task is the name of a
+    panfw.core.TaskCall, for the structured log fields).
+    """
+    fields = log_fields(task=task, firewall=res.hostname, latency=round(res.elapsed, 3),
+                        result=res.result, error=res.error)
+    if res.ok:
+        app_log.info(
+            f"Firewall {res.hostname} finished in {res.elapsed:.2f} seconds with result {res.result}",
+            extra=fields)
+    else:
+        app_log.warning(
+            f"Firewall {res.hostname} failed after {res.elapsed:.2f} seconds: {res.error}",
+            extra=fields)
+
+
+def summarize(results):
+    """Return a one line summary of a sweep for the daemon loop log."""
+    failed = [res.hostname for res in results if not res.ok]
+    slowest = max(results, key=lambda res: res.elapsed, default=None)
+    summary = f"{len(results) - len(failed)}/{len(results)} firewalls succeeded"
+    if slowest is not None:
+        summary += f", slowest was {slowest.hostname} ({slowest.elapsed:.2f} seconds)"
+    if failed:
+        summary += f", failed: {', '.join(failed)}"
+    return summary
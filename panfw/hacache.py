@@ -0,0 +1,154 @@
+"""
+Module:       panfw/hacache.py
+
+Description:
+Cache of the active member of every HA pair. HA discovery costs an extra
+'show high-availability state' round trip to both members, while failovers
+are rare, so the last known active member is reused until its TTL expires
+or an API call to it fails. The cache is optionally persisted to a JSON file
+so a restarted daemon does not have to rediscover the whole fleet.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from panfw.metrics import metrics
+
+app_log = logging.getLogger('root')
+
+
+class HAStateCache(object):
+    """Last known active member per HA pair, with TTL and failover invalidation."""
+
+    def __init__(self, ttl=300, path=None, history=None):
+        """
+        Arguments:
+            ttl {float} -- Seconds a discovered active member is trusted
+            path {str} -- Optional JSON file the cache is persisted to
+            history {HealthHistory} -- Optional history store, records every
+                                       discovery and keeps the cache without a file
+        """
+        self.ttl = ttl
+        self.path = path
+        self.history = history
+        self._lock = threading.Lock()
+        self._entries = dict()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError) as e:
+                app_log.warning(f"Ignoring unreadable HA cache file {path}: {e}")
+        elif not path and history is not None:
+            self._entries = history.load_state('ha')
+
+    @classmethod
+    def from_config(cls, cfgdict, history=None):
+        """Build the cache from ha_cache_ttl / ha_cache_file in config.yml."""
+        ttl = cfgdict.get('ha_cache_ttl')
+        return cls(ttl=300 if ttl is None else ttl, path=cfgdict.get('ha_cache_file'),
+                   history=history)
+
+    @staticmethod
+    def pair_key(fw):
+        """Returns the cache key of the HA pair fw belongs to."""
+        return '|'.join(sorted(member.hostname for member in fw.ha_pair()))
+
+    def active(self, fw):
+        """Returns the active member of fw's HA pair.
+
+        Standalone firewalls are returned as is. For HA pairs the cached active
+        member is used while it is fresh, otherwise the pair is rediscovered.
+
+        Arguments:
+            fw {Firewall} -- Firewall as returned by initialize_fw_objs()
+
+        Returns:
+            Firewall -- fw or fw.ha_peer
+        """
+        if fw.ha_peer is None:
+            return fw
+        key = self.pair_key(fw)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.time() - entry['updated'] < self.ttl:
+            for member in fw.ha_pair():
+                if member.hostname == entry['active']:
+                    member.activate()
+                    return member
+        return self.discover(fw)
+
+    def discover(self, fw):
+        """Asks the pair which member is active and stores the answer."""
+        start_time = time.time()
+        fw.refresh_ha_active()
+        fw_active = fw.active()
+        metrics.observe('panfw_ha_discovery_seconds', time.time() - start_time)
+        app_log.info(
+            f"HA enabled on firewall. Active firewall is {fw_active.hostname} "
+            f"(discovered in {time.time() - start_time:.2f} seconds)")
+        entry = {'active': fw_active.hostname, 'updated': time.time()}
+        with self._lock:
+            self._entries[self.pair_key(fw)] = entry
+        if self.history is not None:
+            self.history.record_ha(self.pair_key(fw), fw_active.hostname)
+            self.history.put_state('ha', self.pair_key(fw), entry)
+        self.save()
+        return fw_active
+
+    def invalidate(self, fw):
+        """Forgets the active member of fw's HA pair."""
+        if fw.ha_peer is None:
+            return
+        with self._lock:
+            removed = self._entries.pop(self.pair_key(fw), None)
+        if removed is not None:
+            app_log.debug(f"HA cache entry of {self.pair_key(fw)} invalidated")
+            if self.history is not None:
+                self.history.put_state('ha', self.pair_key(fw), None)
+            self.save()
+
+    def call(self, fw, func):
+        """Runs func(active_member) and follows a failover within one retry.
+
+        When the call to the cached active member raises, the entry is
+        invalidated and the pair rediscovered. If a different member turned
+        active the call is repeated once on it, otherwise the error is raised.
+
+        Arguments:
+            fw {Firewall} -- Firewall as returned by initialize_fw_objs()
+            func {callable} -- Called with the active Firewall
+
+        Returns:
+            The return value of func
+        """
+        fw_active = self.active(fw)
+        try:
+            return func(fw_active)
+        except Exception:
+            if fw.ha_peer is None:
+                raise
+            self.invalidate(fw)
+            try:
+                fw_new = self.discover(fw)
+            except Exception:
+                app_log.warning(f"HA rediscovery failed for {self.pair_key(fw)}")
+                fw_new = fw_active
+            if fw_new is fw_active:
+                raise
+            app_log.warning(
+                f"HA failover detected, retrying on {fw_new.hostname}")
+            return func(fw_new)
+
+    def save(self):
+        """Writes the cache to its JSON file (if one is configured)."""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self._entries, cache_file)
+            os.replace(tmp_path, self.path)
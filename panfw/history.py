@@ -0,0 +1,354 @@
+"""
+Module:       panfw/history.py
+
+Description:
+Health history of the fleet in a local SQLite database (history_db in
+config.yml). Every check result with its latency, the state of every GP
+satellite gateway, the active member found by every HA discovery and every
+action taken (reconnect, restart, rule moves) is kept, so the history of a
+device can be queried (python3 -m panfw history) instead of grepping the
+rotating logs.
+
+Writes are buffered in memory and written in one transaction per cycle
+(history_flush_interval seconds or history_batch_size rows, whichever comes
+first), the database runs in WAL mode so queries never block the daemon.
+The same database keeps the satellite failure counters and the HA active
+members, a restarted daemon resumes from them without the JSON state files.
+Rows older than history_retention_days are pruned once an hour.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import weakref
+
+app_log = logging.getLogger('root')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS checks (time REAL, task TEXT, firewall TEXT, ok INTEGER, '
+    'latency REAL, result TEXT, error TEXT, shard INTEGER)',
+    'CREATE INDEX IF NOT EXISTS checks_firewall ON checks (firewall, time)',
+    'CREATE INDEX IF NOT EXISTS checks_time ON checks (time)',
+    'CREATE TABLE IF NOT EXISTS gateways (time REAL, firewall TEXT, gateway TEXT, '
+    'connected INTEGER, state TEXT, failures INTEGER)',
+    'CREATE INDEX IF NOT EXISTS gateways_firewall ON gateways (firewall, time)',
+    'CREATE TABLE IF NOT EXISTS ha (time REAL, pair TEXT, active TEXT)',
+    'CREATE TABLE IF NOT EXISTS actions (time REAL, task TEXT, firewall TEXT, action TEXT, '
+    'gateway TEXT, detail TEXT)',
+    'CREATE INDEX IF NOT EXISTS actions_time ON actions (time)',
+    'CREATE TABLE IF NOT EXISTS state (kind TEXT, key TEXT, value TEXT, updated REAL, '
+    'PRIMARY KEY (kind, key))',
+)
+
+# table: columns, in the order of the buffered rows
+TABLES = {
+    'checks': ('time', 'task', 'firewall', 'ok', 'latency', 'result', 'error', 'shard'),
+    'gateways': ('time', 'firewall', 'gateway', 'connected', 'state', 'failures'),
+    'ha': ('time', 'pair', 'active'),
+    'actions': ('time', 'task', 'firewall', 'action', 'gateway', 'detail'),
+}
+
+# Seconds between two prunes of old rows
+PRUNE_INTERVAL = 3600
+
+# Stores of this process, flushed by flush_all() before a shard worker exits
+_stores = weakref.WeakSet()
+
+
+def flush_all():
+    """Writes the buffered rows of every store of this process."""
+    for store in list(_stores):
+        store.flush()
+
+
+def _after_fork():
+    # A forked shard worker starts with its own connection, lock and flush
+    # thread and without the rows its parent has still to write
+    for store in list(_stores):
+        store._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class HealthHistory(object):
+    """Buffered writer (and reader) of the health history database."""
+
+    def __init__(self, path, flush_interval=5, batch_size=500, retention_days=30):
+        """
+        Arguments:
+            path {str} -- SQLite database file
+
+        Keyword Arguments:
+            flush_interval {float} -- Seconds between two writes of the buffered rows
+            batch_size {int} -- Buffered rows that trigger a write right away
+            retention_days {float} -- Days rows are kept (0 keeps them forever)
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, int(batch_size))
+        self.retention_days = retention_days
+        self._pruned = 0.0
+        self._reset()
+        with self._write_lock:
+            self._connect()
+        _stores.add(self)
+
+    def _reset(self):
+        # _lock guards the buffers, _write_lock the connection, so recording
+        # never waits for the disk
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._rows = {table: list() for table in TABLES}
+        self._state = dict()
+        self._pending = 0
+        self._db = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_config(cls, cfgdict):
+        """Build the store from the history_* keys of config.yml.
+
+        Returns:
+            HealthHistory -- or None when history_db is not set
+        """
+        if not cfgdict.get('history_db'):
+            return None
+        retention = cfgdict.get('history_retention_days')
+        return cls(cfgdict['history_db'],
+                   flush_interval=cfgdict.get('history_flush_interval') or 5,
+                   batch_size=cfgdict.get('history_batch_size') or 500,
+                   retention_days=30 if retention is None else retention)
+
+    def _connect(self):
+        # Called with the write lock held
+        if self._db is not None:
+            return self._db
+        self._db = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('PRAGMA busy_timeout = 10000')
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        return self._db
+
+    # Writing
+
+    def _add(self, table, row):
+        with self._lock:
+            self._rows[table].append(row)
+            self._pending += 1
+            full = self._pending >= self.batch_size
+            self._start_flusher()
+        if full:
+            self.flush()
+
+    def _start_flusher(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='history-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def record_check(self, task, res, shard=None):
+        """Records one FirewallResult of a task."""
+        result = None
+        if res.result is not None:
+            result = json.dumps(res.result, default=str)
+        self._add('checks', (time.time(), task, res.hostname, int(bool(res.ok)),
+                             round(res.elapsed, 4), result, res.error, shard))
+
+    def record_gateway(self, firewall, gateway, connected, state=None, failures=None):
+        """Records one GP satellite gateway status and its state machine state."""
+        self._add('gateways', (time.time(), firewall, gateway, int(bool(connected)),
+                               state, failures))
+
+    def record_ha(self, pair, active):
+        """Records the active member found by an HA discovery."""
+        self._add('ha', (time.time(), pair, active))
+
+    def record_action(self, task, firewall, action, gateway=None, detail=None):
+        """Records an action taken on a device (reconnect, restart, rule moves, ...)."""
+        self._add('actions', (time.time(), task, firewall, action, gateway, detail))
+
+    def put_state(self, kind, key, value):
+        """Stores the state of a device for a restarted daemon (None deletes it).
+        Written with the next batch.
+        """
+        with self._lock:
+            self._state[(kind, key)] = value
+            self._pending += 1
+            self._start_flusher()
+
+    def flush(self):
+        """Writes the buffered rows in one transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            rows, self._rows = self._rows, {table: list() for table in TABLES}
+            state, self._state = self._state, dict()
+            self._pending = 0
+        with self._write_lock:
+            try:
+                db = self._connect()
+                now = time.time()
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    for table, table_rows in rows.items():
+                        if table_rows:
+                            columns = TABLES[table]
+                            db.executemany(
+                                f"INSERT INTO {table} ({', '.join(columns)}) "
+                                f"VALUES ({', '.join('?' * len(columns))})", table_rows)
+                    for (kind, key), value in state.items():
+                        if value is None:
+                            db.execute('DELETE FROM state WHERE kind = ? AND key = ?', (kind, key))
+                        else:
+                            db.execute('INSERT OR REPLACE INTO state (kind, key, value, updated) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       (kind, key, json.dumps(value), now))
+                    if self.retention_days and now - self._pruned >= PRUNE_INTERVAL:
+                        self._prune(db, now - self.retention_days * 86400)
+                        self._pruned = now
+                    db.execute('COMMIT')
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                # The rows of this batch are lost, the next batch tries again
+                app_log.error(f"Could not write {sum(len(r) for r in rows.values()) + len(state)} "
+                              f"rows to the history database {self.path}: {e}")
+
+    @staticmethod
+    def _prune(db, before):
+        for table in TABLES:
+            db.execute(f'DELETE FROM {table} WHERE time < ?', (before,))
+
+    def close(self):
+        """Writes the buffered rows and stops the flush thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._thread = None
+        self.flush()
+        with self._write_lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+
+    # Reading
+
+    def _query(self, sql, args=()):
+        self.flush()
+        with self._write_lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    def load_state(self, kind):
+        """Returns key: value of the states of one kind (e.g. 'satellite', 'ha')."""
+        return {key: json.loads(value) for key, value in self._query(
+            'SELECT key, value FROM state WHERE kind = ?', (kind,))}
+
+    def summary(self, since=0):
+        """Per firewall and task since a time: checks, failures, mean and max
+        latency and the time of the last check, most failures first.
+        """
+        return self._query(
+            'SELECT firewall, task, COUNT(*), COUNT(*) - SUM(ok), AVG(latency), MAX(latency), '
+            'MAX(time) FROM checks WHERE time >= ? GROUP BY firewall, task '
+            'ORDER BY COUNT(*) - SUM(ok) DESC, AVG(latency) DESC', (since,))
+
+    def checks(self, firewall=None, since=0, limit=100):
+        """Latest check results (time, task, firewall, ok, latency, result, error)."""
+        return self._query(
+            'SELECT time, task, firewall, ok, latency, result, error FROM checks '
+            'WHERE time >= ? AND (? IS NULL OR firewall = ?) ORDER BY time DESC LIMIT ?',
+            (since, firewall, firewall, limit))
+
+    def gateways(self, firewall=None, since=0, limit=100):
+        """Latest gateway statuses (time, firewall, gateway, connected, state, failures)."""
+        return self._query(
+            'SELECT time, firewall, gateway, connected, state, failures FROM gateways '
+            'WHERE time >= ? AND (? IS NULL OR firewall = ?) ORDER BY time DESC LIMIT ?',
+            (since, firewall, firewall, limit))
+
+    def actions(self, firewall=None, since=0, limit=100):
+        """Latest actions (time, task, firewall, action, gateway, detail)."""
+        return self._query(
+            'SELECT time, task, firewall, action, gateway, detail FROM actions '
+            'WHERE time >= ? AND (? IS NULL OR firewall = ?) ORDER BY time DESC LIMIT ?',
+            (since, firewall, firewall, limit))
+
+
+def parse_age(value):
+    """Seconds of an age like '90', '30m', '12h' or '7d'."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def main(argv=None):
+    """python3 -m panfw history: prints the health history of the fleet."""
+    parser = argparse.ArgumentParser(prog='python3 -m panfw history',
+                                     description='Health history of the fleet')
+    parser.add_argument('--config', default='config.yml', help='config.yml with history_db')
+    parser.add_argument('--db', help='History database (default: history_db of the config)')
+    parser.add_argument('--firewall', help='Only this firewall')
+    parser.add_argument('--since', default='24h', help="Age of the oldest row, e.g. 30m, 12h, 7d")
+    parser.add_argument('--limit', type=int, default=50)
+    view = parser.add_mutually_exclusive_group()
+    view.add_argument('--checks', action='store_true', help='Latest check results')
+    view.add_argument('--gateways', action='store_true', help='Latest GP gateway statuses')
+    view.add_argument('--actions', action='store_true', help='Latest actions taken')
+    args = parser.parse_args(argv)
+
+    path = args.db
+    if path is None:
+        from panfw.config import read_config
+        try:
+            path = read_config(args.config).get('history_db')
+        except (OSError, ValueError) as e:
+            print(f"Config file '{args.config}' not found or couldn't be loaded: {e}")
+            return 1
+    if not path or not os.path.exists(path):
+        print(f"No history database {path or '(history_db is not set)'}")
+        return 1
+    history = HealthHistory(path)
+    since = time.time() - parse_age(args.since)
+    if args.checks:
+        for row in history.checks(args.firewall, since, args.limit):
+            print(f"{_format_time(row[0])}  {row[1]:<16} {row[2]:<20} "
+                  f"{'ok    ' if row[3] else 'FAILED'} {row[4]:>8.3f}s  {row[6] or row[5] or ''}")
+    elif args.gateways:
+        for row in history.gateways(args.firewall, since, args.limit):
+            print(f"{_format_time(row[0])}  {row[1]:<20} {row[2]:<16} "
+                  f"{'up  ' if row[3] else 'DOWN'}  {row[4] or ''} ({row[5] or 0} failures)")
+    elif args.actions:
+        for row in history.actions(args.firewall, since, args.limit):
+            print(f"{_format_time(row[0])}  {row[1]:<16} {row[2]:<20} {row[3]:<10} "
+                  f"{row[4] or ''} {row[5] or ''}")
+    else:
+        print(f"{'firewall':<20} {'task':<16} {'checks':>7} {'failed':>7} {'mean s':>8} "
+              f"{'max s':>8}  last check")
+        rows = [row for row in history.summary(since)
+                if args.firewall is None or row[0] == args.firewall]
+        for row in rows[:args.limit]:
+            print(f"{row[0]:<20} {row[1]:<16} {row[2]:>7} {row[3]:>7} {row[4]:>8.3f} "
+                  f"{row[5]:>8.3f}  {_format_time(row[6])}")
+    history.close()
+    return 0
@@ -0,0 +1,101 @@
+"""
+Module:       panfw/logpipe.py
+
+Description:
+Logging pipeline of the scripts. With log_queue: true the log file and
+console handlers run on a QueueListener thread: a logging call on a polling
+thread only puts the record on an in-memory queue, formatting and disk I/O
+happen off the critical path. With log_format: json every line is a JSON
+object, and the structured fields passed by the call sites (firewall,
+gateway, latency, result, ...) become keys of their own, ready for log
+aggregation.
+
+Call sites attach the fields with extra=log_fields(...), e.g.
+app_log.info('...', extra=log_fields(firewall=fw.hostname, latency=0.12)).
+"""
+
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers as lh
+
+app_log = logging.getLogger('root')
+
+LOG_FORMATS = ('text', 'json')
+
+# Structured fields of a log record that are written as JSON keys
+LOG_FIELDS = ('task', 'firewall', 'gateway', 'command', 'latency', 'result', 'error', 'shard')
+
+
+def log_fields(**fields):
+    """Returns the extra= argument of a logging call with the structured
+    fields that are not None.
+    """
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line: time, level, message, the
+    LOG_FIELDS that are set on the record and the exception, if any.
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        local = time.localtime(record.created)
+        return time.strftime('%Y-%m-%dT%H:%M:%S', local) + \
+            f'.{int(record.msecs):03d}' + time.strftime('%z', local)
+
+
+def make_formatter(log_format='text'):
+    """Returns the formatter of the log handlers for log_format (text or json)."""
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown log_format '{log_format}', expected one of {LOG_FORMATS}")
+    if log_format == 'json':
+        return JsonFormatter()
+    return logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+
+
+class LocalQueueHandler(lh.QueueHandler):
+    """QueueHandler for a queue within this process. The record is queued as
+    is, the message is only formatted on the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def install_queue(logger):
+    """Moves the handlers of logger behind a queue. A QueueListener thread runs
+    the handlers (respecting their levels); the listener is stopped, and the
+    queue drained, when the interpreter exits.
+
+    Arguments:
+        logger {Logger} -- Logger whose handlers are moved
+
+    Returns:
+        QueueListener -- The started listener
+    """
+    handlers = list(logger.handlers)
+    log_queue = queue.SimpleQueue()
+    listener = lh.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(LocalQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,363 @@
+"""
+Module:       panfw/metrics.py
+
+Description:
+Instrumentation of the fleet sweeps. The module level registry (metrics)
+collects latency histograms per firewall and per XML API command, error
+counters by type, the HA discovery time, the executor queue depth and the
+lag of the daemon schedule. MetricsExporter serves them in the Prometheus
+text format on a local /metrics endpoint and writes them to a JSON file once
+per cycle, so slow devices and commands show up before they drag out the
+sweep.
+
+Recording is a no-op until an exporter is configured (metrics_port or
+metrics_file in config.yml). Shard worker processes (execution_mode:
+processes) send their samples to the parent process, where they are served
+with a shard label.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import functools
+from xml.etree import ElementTree as et
+
+app_log = logging.getLogger('root')
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# name: (type, help)
+METRICS = {
+    'panfw_firewall_duration_seconds': (
+        'histogram', 'Duration of one task run on a firewall / HA pair'),
+    'panfw_errors_total': (
+        'counter', 'Failed task runs by task, firewall and error type'),
+    'panfw_op_duration_seconds': (
+        'histogram', 'Duration of one XML API request by command'),
+    'panfw_op_errors_total': (
+        'counter', 'Failed XML API requests by command and error type'),
+    'panfw_ha_discovery_seconds': (
+        'histogram', 'Duration of the discovery of the active member of an HA pair'),
+    'panfw_cycle_lag_seconds': (
+        'histogram', 'Delay between the scheduled and the actual start of a daemon job'),
+    'panfw_cycle_duration_seconds': (
+        'gauge', 'Duration of the last run of a task over the whole fleet'),
+    'panfw_queue_depth': (
+        'gauge', 'Per-firewall calls submitted to the executor and not finished yet'),
+    'panfw_scheduled_jobs': (
+        'gauge', 'Daemon jobs (task, firewall) on the schedule'),
+    'panfw_push_events_total': (
+        'counter', 'Pushed log events by result (matched, ignored, unknown_device)'),
+    'panfw_stretched_jobs': (
+        'gauge', 'Daemon jobs polled less often because of healthy results (adaptive_polling)'),
+    'panfw_actions_total': (
+        'counter', 'Planned disruptive actions by action and result (ok, failed, skipped, dry_run)'),
+}
+
+# FirewallResult.error prefixes of the executor's own errors: error type
+ERROR_TYPES = (('timed out', 'timeout'), ('busy', 'busy'),
+               ('worker of shard', 'worker_died'), ('not initialized', 'not_initialized'))
+
+# Entries in the slowest firewalls / commands lists of the JSON file
+TOP_N = 10
+
+
+def error_type(error):
+    """Returns a short type of a FirewallResult error: timeout, busy, ... or
+    the exception class of a repr(e) (e.g. PanURLError).
+    """
+    for prefix, kind in ERROR_TYPES:
+        if error.startswith(prefix):
+            return kind
+    match = re.match(r'(\w+)\(', error)
+    return match.group(1) if match else 'other'
+
+
+@functools.lru_cache(maxsize=1024)
+def command_name(cmd):
+    """Label of an XML op command: its element path without arguments, e.g.
+    'show global-protect-satellite current-gateway gateway'.
+    """
+    try:
+        node = et.fromstring(cmd)
+    except et.ParseError:
+        # CLI style command
+        return cmd.split()[0] if cmd.strip() else 'unknown'
+    names = [node.tag]
+    while len(node) == 1 and not (node.text or '').strip():
+        node = node[0]
+        names.append(node.tag)
+    return ' '.join(names)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels.items()) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(str(value))}"' for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metrics(object):
+    """Thread safe registry of counters, gauges and histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.enabled = False
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = dict()
+        self._histograms = dict()
+        self._callbacks = dict()
+        self._remote = dict()
+
+    def inc(self, name, amount=1, **labels):
+        """Adds amount to a counter."""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Sets a gauge."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        """Adds a value to a histogram."""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge_callback(self, name, func):
+        """Sets the gauge name to func() whenever the metrics are collected."""
+        with self._lock:
+            self._callbacks[name] = func
+
+    def merge(self, source, samples):
+        """Stores the samples of another process (see snapshot()), they replace
+        the previous samples of the same source.
+        """
+        with self._lock:
+            self._remote[source] = samples
+
+    def reset(self):
+        """Drops everything recorded, e.g. in a freshly forked worker process."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+            self._callbacks.clear()
+            self._remote.clear()
+
+    def snapshot(self):
+        """Returns the samples of this process as a list of dicts (picklable
+        and JSON serializable). Histograms hold per bucket counts, not
+        cumulative ones.
+        """
+        for name, func in list(self._callbacks.items()):
+            try:
+                self.set(name, func())
+            except Exception as e:
+                app_log.debug(f"Metric {name} could not be collected: {e}")
+        with self._lock:
+            samples = [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in self._values.items()]
+            samples.extend({'name': name, 'labels': dict(labels), 'buckets': list(histogram[0]),
+                            'sum': histogram[1], 'count': histogram[2]}
+                           for (name, labels), histogram in self._histograms.items())
+        return samples
+
+    def collect(self):
+        """Returns the samples of this process and of the merged sources, the
+        latter with a shard label.
+        """
+        samples = self.snapshot()
+        with self._lock:
+            remote = list(self._remote.items())
+        for source, source_samples in remote:
+            samples.extend(dict(sample, labels=dict(sample['labels'], shard=source))
+                           for sample in source_samples)
+        return samples
+
+    def render(self):
+        """Returns all samples in the Prometheus text exposition format."""
+        by_name = dict()
+        for sample in self.collect():
+            by_name.setdefault(sample['name'], list()).append(sample)
+        lines = list()
+        for name in sorted(by_name):
+            kind, help_text = METRICS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample in sorted(by_name[name], key=lambda sample: _label_key(sample['labels'])):
+                labels = sample['labels']
+                if 'buckets' not in sample:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(sample['value'])}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, sample['buckets']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {sample['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(sample['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {sample['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """Returns all samples as a dict for the JSON file, with the firewalls
+        and commands of the highest mean latency first.
+        """
+        samples = self.collect()
+
+        def slowest(name, label):
+            means = [{label: sample['labels'].get(label), 'task': sample['labels'].get('task'),
+                      'mean_seconds': round(sample['sum'] / sample['count'], 3),
+                      'count': sample['count']}
+                     for sample in samples
+                     if sample['name'] == name and 'buckets' in sample and sample['count']]
+            for mean in means:
+                if mean['task'] is None:
+                    del mean['task']
+            return sorted(means, key=lambda mean: mean['mean_seconds'], reverse=True)[:TOP_N]
+
+        return {'time': time.time(),
+                'buckets': list(self.buckets),
+                'slowest_firewalls': slowest('panfw_firewall_duration_seconds', 'firewall'),
+                'slowest_commands': slowest('panfw_op_duration_seconds', 'command'),
+                'metrics': samples}
+
+
+# Registry of this process
+metrics = Metrics()
+
+
+def observe_result(task, res):
+    """Records the duration and the error type of one FirewallResult."""
+    if not metrics.enabled:
+        return
+    if res.ok or not (res.error or '').startswith('busy'):
+        metrics.observe('panfw_firewall_duration_seconds', res.elapsed,
+                        task=task, firewall=res.hostname)
+    if not res.ok:
+        metrics.inc('panfw_errors_total', task=task, firewall=res.hostname,
+                    type=error_type(res.error or ''))
+
+
+class MetricsExporter(object):
+    """Serves the registry on a local HTTP endpoint and writes it to a JSON file."""
+
+    def __init__(self, registry, port=None, bind='127.0.0.1', path=None):
+        """
+        Arguments:
+            registry {Metrics} -- Registry to export
+
+        Keyword Arguments:
+            port {int} -- Port of the /metrics endpoint (None: no endpoint)
+            bind {str} -- Address the endpoint listens on
+            path {str} -- JSON file written by write() (None: no file)
+        """
+        self.registry = registry
+        self.port = port
+        self.bind = bind
+        self.path = path
+        self._server = None
+        registry.enabled = True
+
+    @classmethod
+    def from_config(cls, cfgdict, registry=metrics):
+        """Build the exporter from metrics_port / metrics_bind / metrics_file in config.yml.
+
+        Returns:
+            MetricsExporter -- or None when neither metrics_port nor metrics_file is set
+        """
+        port = cfgdict.get('metrics_port')
+        path = cfgdict.get('metrics_file')
+        if not port and not path:
+            return None
+        return cls(registry, port=port or None, bind=cfgdict.get('metrics_bind') or '127.0.0.1',
+                   path=path or None)
+
+    def start(self):
+        """Starts the /metrics endpoint on a background thread (if a port is configured)."""
+        if not self.port or self._server is not None:
+            return
+        # http.server is only imported when the endpoint is used
+        import http.server
+
+        registry = self.registry
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = registry.render().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path.split('?')[0] == '/metrics.json':
+                    body = json.dumps(registry.report()).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                app_log.debug(f"Metrics endpoint: {format % args}")
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((self.bind, int(self.port)), MetricsHandler)
+        except OSError as e:
+            app_log.error(f"Could not start the metrics endpoint on {self.bind}:{self.port}: {e}")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        app_log.info(f"Serving metrics on http://{self.bind}:{self.port}/metrics")
+
+    def write(self):
+        """Writes the registry to the JSON file (if one is configured)."""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as metrics_file:
+                json.dump(self.registry.report(), metrics_file, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            app_log.error(f"Could not write the metrics file {self.path}: {e}")
+
+    def stop(self):
+        """Stops the endpoint and writes the JSON file a last time."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.write()
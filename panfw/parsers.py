@@ -0,0 +1,227 @@
+"""
+Module:       panfw/parsers.py
+
+Description:
+Streaming parsers for PAN-OS XML API responses. Responses are read with
+ElementTree.iterparse and every top level <entry> is turned into a record and
+dropped from the tree as soon as it is complete, so memory stays flat for
+multi-MB outputs such as Panorama rulebases or large GP user tables.
+"""
+
+import io
+from collections import namedtuple
+from xml.etree import ElementTree as et
+
+SatelliteGateway = namedtuple(
+    'SatelliteGateway', ['gateway', 'satellite', 'tunnel_state', 'monitor_status', 'uptime', 'fields'])
+
+GPUser = namedtuple(
+    'GPUser', ['username', 'domain', 'computer', 'client', 'virtual_ip', 'public_ip', 'login_time', 'fields'])
+
+Rule = namedtuple(
+    'Rule', ['name', 'from_zones', 'to_zones', 'source', 'destination', 'application',
+             'service', 'action', 'tags', 'disabled', 'fields'])
+
+# Upper bound of loose text kept for responses that have no <entry> elements
+MAX_LOOSE_TEXT = 64 * 1024
+
+
+def _source(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return io.BytesIO(data)
+    return data
+
+
+def element_to_value(elem):
+    """Converts an element to a plain value.
+
+    A leaf becomes its stripped text, an element holding only <member>
+    children becomes a list of their texts, anything else a dict of its
+    children (attributes are added with a leading '@').
+    """
+    children = list(elem)
+    if not children:
+        return (elem.text or '').strip()
+    if all(child.tag == 'member' for child in children):
+        return [(child.text or '').strip() for child in children]
+    value = {'@' + k: v for k, v in elem.attrib.items()}
+    for child in children:
+        value[child.tag] = element_to_value(child)
+    return value
+
+
+def iter_entries(data, tag='entry'):
+    """Yields every outermost <entry> of an XML response as a dict.
+
+    Arguments:
+        data {bytes|str|file} -- XML API response or a file like object
+
+    Keyword Arguments:
+        tag {str} -- Element name of the records (default 'entry')
+
+    Yields:
+        dict -- Child element values of the entry, attributes as '@name'
+    """
+    stack = list()
+    depth = 0
+    for event, elem in et.iterparse(_source(data), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == tag:
+                depth += 1
+            continue
+        stack.pop()
+        if elem.tag != tag:
+            continue
+        depth -= 1
+        if depth:
+            continue
+        record = {'@' + k: v for k, v in elem.attrib.items()}
+        for child in elem:
+            record[child.tag] = element_to_value(child)
+        yield record
+        if stack:
+            stack[-1].remove(elem)
+        elem.clear()
+
+
+def response_text(data):
+    """Returns all text of a response outside of any <entry>, for
+    responses that report their result as plain text.
+    """
+    parts = list()
+    size = 0
+    depth = 0
+    for event, elem in et.iterparse(_source(data), events=('start', 'end')):
+        if elem.tag == 'entry':
+            depth += 1 if event == 'start' else -1
+            continue
+        if event == 'end' and not depth and elem.text and elem.text.strip():
+            if size < MAX_LOOSE_TEXT:
+                parts.append(elem.text.strip())
+                size += len(parts[-1])
+            elem.clear()
+    return '\n'.join(parts)
+
+
+def _find(fields, *names):
+    """Returns the first field whose name contains one of names."""
+    for name in names:
+        for key, value in fields.items():
+            if name in key and isinstance(value, str):
+                return value
+    return None
+
+
+def _texts(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            for text in _texts(item):
+                yield text
+    elif isinstance(value, list):
+        for item in value:
+            yield item
+    elif value:
+        yield value
+
+
+def parse_satellite_gateways(data):
+    """Parses 'show global-protect-satellite current-gateway'.
+
+    Arguments:
+        data {bytes|str|file} -- XML API response
+
+    Returns:
+        list -- SatelliteGateway per gateway. Responses without entries are
+                returned as a single record holding the response text.
+    """
+    records = list()
+    for fields in iter_entries(data):
+        records.append(SatelliteGateway(
+            gateway=_find(fields, 'gateway-address', 'gateway', 'gw'),
+            satellite=_find(fields, 'satellite'),
+            tunnel_state=_find(fields, 'tunnel-status', 'tunnel-state', 'state', 'status'),
+            monitor_status=_find(fields, 'monitor'),
+            uptime=_find(fields, 'uptime', 'up-time'),
+            fields=fields))
+    if not records:
+        text = response_text(data)
+        if text:
+            records.append(SatelliteGateway(None, None, None, None, None, {'text': text}))
+    return records
+
+
+def satellite_connected(gateways):
+    """True when tunnel monitoring reports the tunnel up and nothing is initializing.
+
+    Arguments:
+        gateways {list} -- SatelliteGateway records of one gateway
+
+    Returns:
+        Boolean -- Tunnel state
+    """
+    up = False
+    for gateway in gateways:
+        for text in _texts(gateway.fields):
+            if 'initializing' in text.lower():
+                return False
+            if 'Tunnel monitoring up' in text:
+                up = True
+    return up
+
+
+def group_by_gateway(gateways):
+    """Groups SatelliteGateway records by gateway address.
+
+    Returns:
+        dict -- gateway address: list of records. Records without an address
+                (plain text responses) are grouped under None.
+    """
+    grouped = dict()
+    for gateway in gateways:
+        grouped.setdefault(gateway.gateway, list()).append(gateway)
+    return grouped
+
+
+def iter_gp_users(data):
+    """Yields a GPUser per entry of 'show global-protect-gateway current-user'."""
+    for fields in iter_entries(data):
+        yield GPUser(
+            username=fields.get('username') or fields.get('primary-username'),
+            domain=fields.get('domain'),
+            computer=fields.get('computer'),
+            client=fields.get('client'),
+            virtual_ip=fields.get('virtual-ip'),
+            public_ip=fields.get('public-ip'),
+            login_time=fields.get('login-time'),
+            fields=fields)
+
+
+def _members(fields, name):
+    value = fields.get(name)
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, list):
+        return tuple(value)
+    return tuple(_texts(value))
+
+
+def iter_rules(data):
+    """Yields a Rule per entry of a security rulebase config 'get' response."""
+    for fields in iter_entries(data):
+        yield Rule(
+            name=fields.get('@name'),
+            from_zones=_members(fields, 'from'),
+            to_zones=_members(fields, 'to'),
+            source=_members(fields, 'source'),
+            destination=_members(fields, 'destination'),
+            application=_members(fields, 'application'),
+            service=_members(fields, 'service'),
+            action=fields.get('action'),
+            tags=_members(fields, 'tag'),
+            disabled=fields.get('disabled') == 'yes',
+            fields=fields)
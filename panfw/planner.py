@@ -0,0 +1,353 @@
+"""
+Module:       panfw/planner.py
+
+Description:
+Action planner of the disruptive operations (satellite reconnects, firewall
+restarts, rule moves). Tasks do not run them inline in the middle of a check
+but propose them to the planner, which collects the actions of one cycle -
+the whole sweep in a one-shot run, action_batch_window seconds in daemon
+mode - and then either logs the plan (dry_run: true) or runs it.
+
+Actions on the same HA pair are deduplicated, a restart of a pair replaces
+its reconnects. The plan is split into rollout waves of at most
+action_wave_size firewalls, the firewalls of one site (the site key of the
+firewall entry) stay in one wave where they fit. At most action_concurrency
+firewalls (and action_site_concurrency per site) are worked on at the same
+time, the actions of one firewall run one after the other. A large outage so
+causes one coordinated batch instead of hundreds of uncoordinated calls.
+"""
+
+import os
+import time
+import logging
+import threading
+import weakref
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from panfw.hacache import HAStateCache
+from panfw.logpipe import log_fields
+from panfw.metrics import metrics
+
+app_log = logging.getLogger('root')
+
+# A disruptive operation proposed by a task.
+#   kind -- 'reconnect', 'restart', 'reorder', ...
+#   fw -- Firewall object of the config entry
+#   task -- Name of the proposing task
+#   execute -- Runs the action, returns the detail recorded in the history (or None)
+#   gateway -- GP gateway the action is about (part of the dedup key)
+#   detail -- Text shown in the plan
+#   lease -- Take the cluster lease of the device first
+#   lease_ttl -- Seconds of that lease (default cluster_lease_ttl)
+Action = namedtuple('Action', ['kind', 'fw', 'task', 'execute', 'gateway', 'detail',
+                               'lease', 'lease_ttl'],
+                    defaults=(None, None, True, None))
+
+# Kinds that make the other actions on the same HA pair pointless
+SUPERSEDING = ('restart',)
+
+# Planners of this process, drained by drain_all() in a shard worker
+_planners = weakref.WeakSet()
+
+
+def drain_all():
+    """Runs the pending actions of every planner of this process.
+
+    Returns:
+        dict -- result: number of actions, summed over the planners
+    """
+    totals = dict()
+    for planner in list(_planners):
+        for result, count in planner.drain().items():
+            totals[result] = totals.get(result, 0) + count
+    return totals
+
+
+def _after_fork():
+    # A forked shard worker plans for its own firewalls only
+    for planner in list(_planners):
+        planner._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class ActionPlanner(object):
+    """Collects, deduplicates and runs (or only shows) the disruptive actions."""
+
+    def __init__(self, dry_run=False, concurrency=8, site_concurrency=0, wave_size=0,
+                 wave_pause=0, window=5, max_failures=0, site_of=None, cluster=None,
+                 history=None):
+        """
+        Keyword Arguments:
+            dry_run {bool} -- Log the plan instead of running it
+            concurrency {int} -- Firewalls worked on at the same time
+            site_concurrency {int} -- Firewalls per site worked on at the same time (0: no limit)
+            wave_size {int} -- Firewalls per rollout wave (0: one wave)
+            wave_pause {float} -- Seconds between two waves
+            window {float} -- Seconds proposals are collected before the plan
+                              runs, None runs it on drain() only
+            max_failures {int} -- Failed actions that stop the remaining waves (0: never)
+            site_of {callable} -- Returns the site of a firewall hostname
+            cluster {ClusterCoordinator} -- Device leases across daemon nodes
+            history {HealthHistory} -- Records the actions taken
+        """
+        self.dry_run = dry_run
+        self.concurrency = max(1, int(concurrency))
+        self.site_concurrency = max(0, int(site_concurrency))
+        self.wave_size = max(0, int(wave_size))
+        self.wave_pause = wave_pause
+        self.window = window
+        self.max_failures = max(0, int(max_failures))
+        self.site_of = site_of
+        self.cluster = cluster
+        self.history = history
+        self._reset()
+        _planners.add(self)
+
+    def _reset(self):
+        # _lock guards the proposals, _run_lock makes plans run one at a time
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._pending = list()
+        self._keys = set()
+        self._duplicates = 0
+        self._timer = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_config(cls, cfgdict, site_of=None, cluster=None, history=None):
+        """Build the planner from dry_run and the action_* keys of config.yml."""
+        window = cfgdict.get('action_batch_window')
+        return cls(dry_run=bool(cfgdict.get('dry_run')),
+                   concurrency=cfgdict.get('action_concurrency') or 8,
+                   site_concurrency=cfgdict.get('action_site_concurrency') or 0,
+                   wave_size=cfgdict.get('action_wave_size') or 0,
+                   wave_pause=cfgdict.get('action_wave_pause') or 0,
+                   window=5 if window is None else window,
+                   max_failures=cfgdict.get('action_max_failures') or 0,
+                   site_of=site_of, cluster=cluster, history=history)
+
+    @staticmethod
+    def key(action):
+        """Dedup key: the same kind of action on the same HA pair and gateway."""
+        return (HAStateCache.pair_key(action.fw), action.kind, action.gateway)
+
+    def propose(self, action):
+        """Adds an action to the plan of the current cycle.
+
+        Returns:
+            Boolean -- False when the same action is planned already
+        """
+        key = self.key(action)
+        with self._lock:
+            if key in self._keys:
+                app_log.debug(f"{action.kind} on {action.fw.hostname} is planned already")
+                self._duplicates += 1
+                return False
+            self._keys.add(key)
+            self._pending.append(action)
+            if self.window is not None and self._timer is None and not self._stop.is_set():
+                self._timer = threading.Timer(self.window, self._run_batch)
+                self._timer.name = 'action-planner'
+                self._timer.daemon = True
+                self._timer.start()
+        return True
+
+    def pending(self):
+        """Number of proposed actions not run yet."""
+        with self._lock:
+            return len(self._pending)
+
+    def _run_batch(self):
+        with self._lock:
+            self._timer = None
+        self.drain()
+
+    def plan(self, actions):
+        """Deduplicates actions across HA pairs and splits them into waves.
+
+        Arguments:
+            actions {list} -- Proposed actions
+
+        Returns:
+            list -- Waves, a wave is a list of (site, [actions of one HA pair])
+        """
+        pairs = OrderedDict()
+        for action in actions:
+            pairs.setdefault(HAStateCache.pair_key(action.fw), list()).append(action)
+        units = list()
+        for pair, pair_actions in pairs.items():
+            seen = set()
+            unique = list()
+            for action in pair_actions:
+                if (action.kind, action.gateway) not in seen:
+                    seen.add((action.kind, action.gateway))
+                    unique.append(action)
+            superseding = [action for action in unique if action.kind in SUPERSEDING]
+            if superseding:
+                dropped = len(unique) - 1
+                if dropped:
+                    app_log.info(f"{superseding[0].kind} of {pair} replaces {dropped} other action(s)")
+                unique = superseding[:1]
+            site = self.site_of(unique[0].fw.hostname) if self.site_of is not None else None
+            units.append((site or '', unique))
+        units.sort(key=lambda unit: (unit[0], unit[1][0].fw.hostname))
+
+        if not self.wave_size:
+            return [units] if units else []
+        waves = list()
+        wave = list()
+        for site in OrderedDict((unit[0], None) for unit in units):
+            site_units = [unit for unit in units if unit[0] == site]
+            # A site moves to the next wave as a whole when it fits there
+            if wave and len(wave) + len(site_units) > self.wave_size:
+                waves.append(wave)
+                wave = list()
+            for unit in site_units:
+                if len(wave) >= self.wave_size:
+                    waves.append(wave)
+                    wave = list()
+                wave.append(unit)
+        if wave:
+            waves.append(wave)
+        return waves
+
+    def describe(self, waves):
+        """Returns the plan as text lines."""
+        lines = list()
+        for number, wave in enumerate(waves, 1):
+            for site, actions in wave:
+                for action in actions:
+                    target = f" gateway {action.gateway}" if action.gateway else ''
+                    detail = f" ({action.detail})" if action.detail else ''
+                    where = f" [site {site}]" if site else ''
+                    lines.append(f"wave {number}{where}: {action.kind} on "
+                                 f"{action.fw.hostname}{target}{detail}")
+        return lines
+
+    def drain(self):
+        """Plans and runs (or logs with dry_run) the pending actions now.
+
+        Returns:
+            dict -- result: number of actions (ok, failed, skipped, dry_run)
+        """
+        with self._run_lock:
+            with self._lock:
+                actions, self._pending = self._pending, list()
+                duplicates, self._duplicates = self._duplicates, 0
+                self._keys = set()
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not actions:
+                return dict()
+            waves = self.plan(actions)
+            count = sum(len(unit[1]) for wave in waves for unit in wave)
+            firewalls = sum(len(wave) for wave in waves)
+            app_log.info(
+                f"Action plan{' (dry run)' if self.dry_run else ''}: {count} action(s) on "
+                f"{firewalls} firewall(s) in {len(waves)} wave(s), "
+                f"{duplicates + len(actions) - count} duplicate(s) dropped")
+            for line in self.describe(waves):
+                app_log.info(f"  {line}")
+            if self.dry_run:
+                for wave in waves:
+                    for _, unit in wave:
+                        for action in unit:
+                            self._record(action, 'dry_run', 'dry run')
+                return {'dry_run': count}
+            return self._execute(waves)
+
+    def _execute(self, waves):
+        totals = dict()
+        start_time = time.time()
+        sites = dict()
+        if self.site_concurrency:
+            sites = {site: threading.BoundedSemaphore(self.site_concurrency)
+                     for wave in waves for site, _ in wave}
+
+        def run_unit(unit):
+            site, actions = unit
+            semaphore = sites.get(site)
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                return [self._run(action) for action in actions]
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        for number, wave in enumerate(waves, 1):
+            if number > 1 and self.wave_pause:
+                if self._stop.wait(self.wave_pause):
+                    app_log.warning("Action plan stopped between two waves")
+            if self._stop.is_set() or (
+                    self.max_failures and totals.get('failed', 0) >= self.max_failures):
+                # Never attempted, reported as skipped and not as failed
+                skipped = [action for rest in waves[number - 1:] for _, actions in rest
+                           for action in actions]
+                reason = 'the action plan was stopped' if self._stop.is_set() else \
+                    f"{totals.get('failed', 0)} action(s) failed"
+                app_log.error(
+                    f"Skipping the {len(skipped)} action(s) of the remaining "
+                    f"{len(waves) - number + 1} wave(s), {reason}")
+                for action in skipped:
+                    app_log.warning(
+                        f"Skipped {action.kind} on {action.fw.hostname}"
+                        f"{f' for gateway {action.gateway}' if action.gateway else ''}",
+                        extra=log_fields(task=action.task, firewall=action.fw.hostname,
+                                         gateway=action.gateway, result='skipped'))
+                    metrics.inc('panfw_actions_total', action=action.kind, result='skipped')
+                totals['skipped'] = totals.get('skipped', 0) + len(skipped)
+                break
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(wave)),
+                                    thread_name_prefix='action') as pool:
+                for results in pool.map(run_unit, wave):
+                    for result in results:
+                        totals[result] = totals.get(result, 0) + 1
+        app_log.info(
+            f"Action plan done in {time.time() - start_time:.2f} seconds: " +
+            ', '.join(f'{count} {result}' for result, count in sorted(totals.items())))
+        return totals
+
+    def _run(self, action):
+        """Runs one action under the cluster lease of its device."""
+        hostname = action.fw.hostname
+        if action.lease and self.cluster is not None and \
+                not self.cluster.try_action(hostname, action.kind, action.lease_ttl):
+            metrics.inc('panfw_actions_total', action=action.kind, result='skipped')
+            return 'skipped'
+        fields = log_fields(task=action.task, firewall=hostname, gateway=action.gateway,
+                            result=action.kind)
+        app_log.info(f"Running {action.kind} on {hostname}"
+                     f"{f' for gateway {action.gateway}' if action.gateway else ''}", extra=fields)
+        try:
+            detail = action.execute()
+        except Exception as e:
+            app_log.error(f"{action.kind} on {hostname} failed: {e!r}",
+                          extra=log_fields(task=action.task, firewall=hostname,
+                                           gateway=action.gateway, error=repr(e)))
+            self._record(action, 'failed', f'failed: {e!r}')
+            return 'failed'
+        self._record(action, 'ok', detail)
+        return 'ok'
+
+    def _record(self, action, result, detail=None):
+        metrics.inc('panfw_actions_total', action=action.kind, result=result)
+        if self.history is not None:
+            self.history.record_action(action.task, action.fw.hostname, action.kind,
+                                       action.gateway, detail)
+
+    def close(self):
+        """Runs what is still pending (a daemon that is stopped does not drop
+        the actions it decided on), then stops the batch timer.
+        """
+        self.drain()
+        self._stop.set()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
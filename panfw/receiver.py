@@ -0,0 +1,409 @@
+"""
+Module:       panfw/receiver.py
+
+Description:
+Push receiver for daemon mode. The firewalls forward their system logs to
+the daemon (syslog over UDP / TCP or an HTTP log forwarding profile) and
+every GlobalProtect satellite or tunnel monitor event runs the status check
+of that firewall right away, through the usual satellite-reset flow
+(reconnect, restart). A tunnel that went down is then seen within seconds
+instead of at the next check_interval, and polling becomes a slow safety
+net.
+
+The receiver runs an asyncio event loop on a thread of its own. Lines are
+pre-filtered on the SYSTEM log type before they are split, the matching
+ones are mapped to a firewall of config.yml by the address of the sender,
+the HA peer address, the device_name of the firewall entry or the host name
+in the syslog header. A burst of events from one firewall triggers one
+check per push_debounce seconds.
+
+The receiver listens on 127.0.0.1 unless push_bind says otherwise. On any
+other address the HTTP endpoint needs push_http_token, or an explicit
+push_http_allow_anonymous: true.
+"""
+
+import re
+import csv
+import hmac
+import json
+import time
+import logging
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+
+from panfw.metrics import metrics
+from panfw.logpipe import log_fields
+
+app_log = logging.getLogger('root')
+
+# Events that trigger a satellite check: event id or description matching
+DEFAULT_EVENT_PATTERN = r'satellite|tunnel.?monitor|tunnel.?status|tunnel.*(down|up)'
+
+# Columns of a PAN-OS SYSTEM log (CSV part of the syslog message)
+SYSTEM_SERIAL, SYSTEM_TYPE, SYSTEM_SUBTYPE, SYSTEM_EVENT_ID, SYSTEM_DESCRIPTION, \
+    SYSTEM_DEVICE_NAME = 2, 3, 4, 8, 14, 22
+
+# <PRI>, then either 'Mmm dd hh:mm:ss host ' (BSD) or '1 timestamp host ' (IETF)
+SYSLOG_HEADER = re.compile(
+    r'^(?:<\d+>)?(?:(?:1 \S+)|(?:\w{3} +\d+ \d\d:\d\d:\d\d)) (?P<host>\S+) ')
+
+# Start of the CSV part: FUTURE_USE,receive time,serial,type
+CSV_START = re.compile(r'\d*,\d{4}/\d\d/\d\d \d\d:\d\d:\d\d,')
+
+# Longest TCP syslog frame that is buffered
+MAX_FRAME = 64 * 1024
+
+# Seconds an HTTP client gets to send its whole request, and the most header
+# lines read, a slow or idle client does not hold its connection open
+HTTP_READ_TIMEOUT = 10
+MAX_HTTP_HEADERS = 64
+
+# Address the receiver listens on without push_bind
+DEFAULT_BIND = '127.0.0.1'
+
+LogEvent = namedtuple('LogEvent', ['sender', 'host', 'device_name', 'serial', 'subtype',
+                                   'event_id', 'description'])
+
+
+def parse_system_log(line, sender=None):
+    """Parses one PAN-OS SYSTEM log line (syslog or bare CSV).
+
+    Arguments:
+        line {str} -- Log line
+
+    Keyword Arguments:
+        sender {str} -- Address the line came from
+
+    Returns:
+        LogEvent -- or None when the line is not a SYSTEM log
+    """
+    # Cheap pre-filter, most of the forwarded traffic is other log types
+    if ',SYSTEM,' not in line:
+        return None
+    header = SYSLOG_HEADER.match(line)
+    start = CSV_START.search(line, header.end() if header else 0)
+    if start is None:
+        return None
+    try:
+        fields = next(csv.reader([line[start.start():].strip()]))
+    except (csv.Error, StopIteration):
+        return None
+    if len(fields) <= SYSTEM_DESCRIPTION or fields[SYSTEM_TYPE] != 'SYSTEM':
+        return None
+    return LogEvent(sender=sender, host=header.group('host') if header else None,
+                    device_name=fields[SYSTEM_DEVICE_NAME] if len(fields) > SYSTEM_DEVICE_NAME else None,
+                    serial=fields[SYSTEM_SERIAL], subtype=fields[SYSTEM_SUBTYPE],
+                    event_id=fields[SYSTEM_EVENT_ID], description=fields[SYSTEM_DESCRIPTION])
+
+
+def event_from_json(entry, sender=None):
+    """Returns the LogEvent of an HTTP log forwarding payload: a raw log line
+    under 'log', or the fields firewall / device_name / serial / event_id /
+    description.
+    """
+    if not isinstance(entry, dict):
+        return None
+    if entry.get('log'):
+        return parse_system_log(str(entry['log']), sender)
+    return LogEvent(sender=sender,
+                    host=entry.get('firewall') or entry.get('host'),
+                    device_name=entry.get('device_name'),
+                    serial=entry.get('serial'),
+                    subtype=entry.get('subtype'),
+                    event_id=str(entry.get('event_id') or entry.get('eventid') or ''),
+                    description=str(entry.get('description') or entry.get('message') or ''))
+
+
+def is_loopback(address):
+    """True when the receiver bound to address is only reachable from this host."""
+    import ipaddress
+    if address == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def check_config(cfgdict):
+    """Raises ValueError when the HTTP endpoint would accept events from
+    anyone: bound to a non-loopback address without push_http_token and
+    without push_http_allow_anonymous.
+    """
+    bind = cfgdict.get('push_bind') or DEFAULT_BIND
+    if cfgdict.get('push_http_port') and not cfgdict.get('push_http_token') and \
+            not cfgdict.get('push_http_allow_anonymous') and not is_loopback(bind):
+        raise ValueError(
+            f"push_http_port on {bind} needs push_http_token (or push_http_allow_anonymous: "
+            f"true to accept unauthenticated events)")
+
+
+def fleet_index(cfgdict):
+    """Returns name: hostname for every address, HA peer address and
+    device_name of the firewalls in config.yml.
+    """
+    index = dict()
+    for hostname, fw_cfg in (cfgdict.get('firewalls') or dict()).items():
+        fw_cfg = fw_cfg or dict()
+        for name in (fw_cfg.get('device_name'), fw_cfg.get('ha_peer_ip'), hostname):
+            if name:
+                index[str(name).lower()] = hostname
+    return index
+
+
+class EventReceiver(object):
+    """Syslog (UDP and TCP) and HTTP receiver of the firewalls' system logs."""
+
+    def __init__(self, on_event, syslog_port=None, http_port=None, bind=DEFAULT_BIND,
+                 pattern=DEFAULT_EVENT_PATTERN, debounce=5, http_token=None):
+        """
+        Arguments:
+            on_event {callable} -- Called as on_event(hostname, event) for a
+                                   matching event, on the receiver thread
+
+        Keyword Arguments:
+            syslog_port {int} -- UDP and TCP syslog port (None: no syslog)
+            http_port {int} -- Port of the HTTP endpoint (None: no endpoint)
+            bind {str} -- Address the receiver listens on
+            pattern {str} -- Regular expression matched against the event id
+                             and description (case insensitive)
+            debounce {float} -- Seconds between two triggers for one firewall
+            http_token {str} -- Token the HTTP requests must carry (Authorization:
+                                Bearer <token> or ?token=)
+        """
+        self.on_event = on_event
+        self.syslog_port = syslog_port
+        self.http_port = http_port
+        self.bind = bind
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.debounce = debounce
+        self.http_token = http_token
+        self._index = dict()
+        self._triggered = dict()
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @classmethod
+    def from_config(cls, cfgdict, on_event):
+        """Build the receiver from the push_* keys of config.yml.
+
+        Raises:
+            ValueError -- see check_config()
+
+        Returns:
+            EventReceiver -- or None when neither push_syslog_port nor push_http_port is set
+        """
+        check_config(cfgdict)
+        syslog_port = cfgdict.get('push_syslog_port')
+        http_port = cfgdict.get('push_http_port')
+        if not syslog_port and not http_port:
+            return None
+        debounce = cfgdict.get('push_debounce')
+        receiver = cls(on_event, syslog_port=syslog_port or None, http_port=http_port or None,
+                       bind=cfgdict.get('push_bind') or DEFAULT_BIND,
+                       pattern=cfgdict.get('push_event_pattern') or DEFAULT_EVENT_PATTERN,
+                       debounce=5 if debounce is None else debounce,
+                       http_token=cfgdict.get('push_http_token'))
+        receiver.set_fleet(cfgdict)
+        return receiver
+
+    def set_fleet(self, cfgdict):
+        """Takes the firewalls of a (reloaded) config."""
+        self._index = fleet_index(cfgdict)
+
+    def resolve(self, event):
+        """Returns the hostname in config.yml of the firewall an event is about."""
+        for name in (event.sender, event.device_name, event.host):
+            if name:
+                hostname = self._index.get(str(name).lower())
+                if hostname is not None:
+                    return hostname
+        return None
+
+    def handle(self, event):
+        """Triggers a check for a matching event. Returns the firewall or None."""
+        if event is None:
+            return None
+        if not self.pattern.search(f'{event.event_id} {event.description}'):
+            metrics.inc('panfw_push_events_total', result='ignored')
+            return None
+        hostname = self.resolve(event)
+        if hostname is None:
+            metrics.inc('panfw_push_events_total', result='unknown_device')
+            app_log.debug(f"Event {event.event_id} from an unknown firewall "
+                          f"({event.sender}, {event.device_name or event.host}): {event.description}")
+            return None
+        metrics.inc('panfw_push_events_total', result='matched')
+        now = time.monotonic()
+        if now - self._triggered.get(hostname, -self.debounce) < self.debounce:
+            return hostname
+        self._triggered[hostname] = now
+        app_log.info(f"Event {event.event_id} on {hostname}: {event.description}",
+                     extra=log_fields(firewall=hostname, result=event.event_id))
+        try:
+            self.on_event(hostname, event)
+        except Exception:
+            app_log.exception(f"Could not handle the event of {hostname}")
+        return hostname
+
+    def handle_line(self, line, sender=None):
+        return self.handle(parse_system_log(line, sender))
+
+    # Network
+
+    def start(self, timeout=10):
+        """Starts the listeners on a background thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='push-receiver', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout)
+
+    def _run(self):
+        # asyncio is only imported when the receiver is used
+        import asyncio
+        loop = self._loop = asyncio.new_event_loop()
+        servers = list()
+        try:
+            if self.syslog_port:
+                transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+                    lambda: _SyslogProtocol(self), local_addr=(self.bind, int(self.syslog_port))))
+                servers.append(transport)
+                servers.append(loop.run_until_complete(asyncio.start_server(
+                    self._syslog_stream, self.bind, int(self.syslog_port))))
+                app_log.info(f"Receiving syslog on {self.bind}:{self.syslog_port} (UDP and TCP)")
+            if self.http_port:
+                servers.append(loop.run_until_complete(asyncio.start_server(
+                    self._http_connection, self.bind, int(self.http_port))))
+                app_log.info(f"Receiving log events on http://{self.bind}:{self.http_port}/events")
+        except OSError as e:
+            app_log.error(f"Could not start the push receiver: {e}")
+            for server in servers:
+                server.close()
+            self._ready.set()
+            loop.close()
+            return
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            for server in servers:
+                server.close()
+            loop.close()
+
+    async def _syslog_stream(self, reader, writer):
+        """TCP syslog: newline delimited or octet counted frames (RFC 6587)."""
+        sender = (writer.get_extra_info('peername') or (None,))[0]
+        buffer = b''
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                while buffer:
+                    length, space, rest = buffer.partition(b' ')
+                    if space and length.isdigit() and rest[:1] == b'<':
+                        if len(rest) < int(length):
+                            break
+                        frame, buffer = rest[:int(length)], rest[int(length):]
+                    elif b'\n' in buffer:
+                        frame, buffer = buffer.split(b'\n', 1)
+                    else:
+                        break
+                    self.handle_line(frame.decode('utf-8', 'replace'), sender)
+                if len(buffer) > MAX_FRAME:
+                    buffer = b''
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _http_connection(self, reader, writer):
+        """POST /events with raw log lines or JSON (an object or a list of objects)."""
+        import asyncio
+        sender = (writer.get_extra_info('peername') or (None,))[0]
+
+        async def read_request():
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(None, 2)
+            headers = dict()
+            for _ in range(MAX_HTTP_HEADERS + 1):
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            else:
+                return b'431 Request Header Fields Too Large'
+            length = int(headers.get('content-length') or 0)
+            if length > MAX_FRAME * 16:
+                return b'413 Payload Too Large'
+            body = await reader.readexactly(length)
+            return self._http_request(method, target, headers, body, sender)
+
+        try:
+            status = await asyncio.wait_for(read_request(), HTTP_READ_TIMEOUT)
+            writer.write(b'HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status)
+            await writer.drain()
+        except asyncio.TimeoutError:
+            app_log.debug(f"HTTP client {sender} did not send its request within "
+                          f"{HTTP_READ_TIMEOUT} seconds")
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _http_request(self, method, target, headers, body, sender):
+        url = urlsplit(target)
+        if url.path.rstrip('/') != '/events':
+            return b'404 Not Found'
+        if method != 'POST':
+            return b'405 Method Not Allowed'
+        if self.http_token:
+            token = headers.get('authorization', '').partition('Bearer ')[2] or \
+                (parse_qs(url.query).get('token') or [''])[0]
+            # Constant time, the comparison does not tell how much of a guess was right
+            if not hmac.compare_digest(token.encode('utf-8'), str(self.http_token).encode('utf-8')):
+                return b'401 Unauthorized'
+        text = body.decode('utf-8', 'replace')
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                payload = json.loads(text)
+            except ValueError:
+                return b'400 Bad Request'
+            for entry in payload if isinstance(payload, list) else [payload]:
+                self.handle(event_from_json(entry, sender))
+        else:
+            for line in text.splitlines():
+                self.handle_line(line, sender)
+        return b'202 Accepted'
+
+    def stop(self):
+        """Stops the listeners."""
+        if self._loop is not None and self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+        self._thread = None
+        self._loop = None
+
+
+class _SyslogProtocol(object):
+    """UDP syslog, one message per datagram."""
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.receiver.handle_line(data.decode('utf-8', 'replace'), addr[0])
+
+    def error_received(self, exc):
+        app_log.debug(f"Syslog receiver error: {exc}")
+
+    def connection_lost(self, exc):
+        pass
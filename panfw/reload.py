@@ -0,0 +1,182 @@
+"""
+Module:       panfw/reload.py
+
+Description:
+Hot reload of config.yml for daemon mode. The file is polled for changes
+(modification time and size, so it works on every file system), the new YAML
+is validated and compared with the running config, and only the firewalls
+that were added, removed or changed are touched. All other firewalls keep
+their connections, HA cache entries and failure counters.
+"""
+
+import os
+import time
+import logging
+from collections import namedtuple
+
+from panfw.config import read_config
+
+app_log = logging.getLogger('root')
+
+# Firewall keys that need new Firewall objects when they change
+REINIT_KEYS = ('api_key', 'ha_peer_ip', 'port')
+
+# Global keys read by components built at start-up, changes need a restart
+RESTART_KEYS = ('log_', 'daemon_mode', 'execution_mode', 'max_workers', 'shards',
+                'firewall_timeout', 'ha_cache_', 'pooled_transport', 'transport_',
+                'satellite_state_file', 'reconnect_threshold', 'restart_threshold',
+                'restart_cooldown', 'cluster_', 'device_guard', 'rate_limit', 'circuit_',
+                'tasks', 'metrics_', 'history_', 'push_', 'dry_run',
+                'action_')
+
+ConfigDiff = namedtuple('ConfigDiff', ['added', 'removed', 'reinit', 'updated', 'global_keys'])
+
+
+def diff_config(old, new):
+    """Compares two configs.
+
+    Returns:
+        ConfigDiff -- added, removed, reinit (connection settings changed),
+                      updated (other settings changed) firewall addresses and
+                      the changed global keys
+    """
+    old_fws = old.get('firewalls') or dict()
+    new_fws = new.get('firewalls') or dict()
+    reinit = list()
+    updated = list()
+    for hostname in new_fws:
+        if hostname not in old_fws:
+            continue
+        old_fw = old_fws[hostname] or dict()
+        new_fw = new_fws[hostname] or dict()
+        if any(old_fw.get(key) != new_fw.get(key) for key in REINIT_KEYS):
+            reinit.append(hostname)
+        elif old_fw != new_fw:
+            updated.append(hostname)
+    global_keys = sorted(key for key in set(old) | set(new)
+                         if key != 'firewalls' and old.get(key) != new.get(key))
+    return ConfigDiff(added=[hostname for hostname in new_fws if hostname not in old_fws],
+                      removed=[hostname for hostname in old_fws if hostname not in new_fws],
+                      reinit=reinit, updated=updated, global_keys=global_keys)
+
+
+class ConfigWatcher(object):
+    """Polls a config file and returns the new, validated config after a change."""
+
+    def __init__(self, path='config.yml', interval=5):
+        """
+        Arguments:
+            path {str} -- Config file to watch
+
+        Keyword Arguments:
+            interval {float} -- Seconds between two checks of the file
+        """
+        self.path = path
+        self.interval = interval
+        self._checked = time.monotonic()
+        self._signature = self._stat()
+
+    @classmethod
+    def from_config(cls, cfgdict, path='config.yml'):
+        """Build the watcher from config_reload / config_reload_interval in config.yml.
+
+        Returns:
+            ConfigWatcher -- or None when config_reload is not enabled
+        """
+        if not cfgdict.get('config_reload'):
+            return None
+        return cls(path, interval=cfgdict.get('config_reload_interval') or 5)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def poll(self):
+        """Returns the new config when the file changed and is valid, else None.
+
+        An invalid file is logged once and the running config is kept.
+        """
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return None
+        self._checked = now
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return None
+        self._signature = signature
+        try:
+            return read_config(self.path)
+        except (OSError, ValueError) as e:
+            app_log.error(f"Ignoring changed {self.path}, the running config is kept: {e}")
+            return None
+
+
+def apply_config(cfgdict, new_cfg, fw_objs, init_func, schedule, unschedule,
+                 on_remove=None, executor=None):
+    """Brings a running daemon to new_cfg, touching only the changed firewalls.
+
+    cfgdict is updated in place so every reference to it sees the new values.
+
+    Arguments:
+        cfgdict {dict} -- The running config
+        new_cfg {dict} -- The validated new config
+        fw_objs {dict} -- hostname: Firewall of the running daemon, updated in place
+        init_func {callable} -- Called with a list of hostnames, returns their
+                                Firewall objects
+        schedule {callable} -- Called with a hostname to add its daemon jobs or
+                               update their intervals
+        unschedule {callable} -- Called with a hostname to drop its daemon jobs
+
+    Keyword Arguments:
+        on_remove {callable} -- Called with every Firewall that is dropped
+                                (e.g. to forget its HA cache entry)
+        executor {FleetExecutor|ShardedExecutor} -- Worker pool, sharded
+                                workers of changed firewalls are restarted
+
+    Returns:
+        ConfigDiff -- What changed
+    """
+    # API keys generated at start-up are only in the running config when
+    # config.yml could not be written back
+    for hostname, fw_cfg in new_cfg['firewalls'].items():
+        old_cfg = cfgdict['firewalls'].get(hostname) or dict()
+        if fw_cfg is not None and old_cfg.get('api_key') and 'api_key' not in fw_cfg:
+            fw_cfg['api_key'] = old_cfg['api_key']
+    diff = diff_config(cfgdict, new_cfg)
+    if not any(diff):
+        app_log.debug("config.yml changed on disk, but not its content")
+        return diff
+    for key in diff.global_keys:
+        if key.startswith(RESTART_KEYS):
+            app_log.warning(f"Change of {key} in config.yml takes effect after a restart")
+
+    for hostname in diff.removed + diff.reinit:
+        unschedule(hostname)
+        fw = fw_objs.pop(hostname, None)
+        if fw is not None and on_remove is not None:
+            on_remove(fw)
+
+    cfgdict.clear()
+    cfgdict.update(new_cfg)
+
+    # Intervals may come from global keys, update the jobs of every firewall
+    for hostname in fw_objs:
+        schedule(hostname)
+
+    if executor is not None and hasattr(executor, 'restart_shards'):
+        executor.restart_shards(diff.removed + diff.reinit + diff.updated)
+
+    new_hostnames = diff.added + diff.reinit
+    if new_hostnames:
+        for fw in init_func(new_hostnames):
+            fw_objs[fw.hostname] = fw
+            schedule(fw.hostname)
+
+    app_log.info(
+        f"config.yml reloaded: {len(diff.added)} firewalls added, {len(diff.removed)} removed, "
+        f"{len(diff.reinit)} reinitialized, {len(diff.updated)} updated, "
+        f"{len(fw_objs) - len(new_hostnames) - len(diff.updated)} untouched")
+    return diff
@@ -0,0 +1,261 @@
+"""
+Module:       panfw/reorder.py
+
+Description:
+Bulk rule reorder engine. The rulebase is fetched once, the minimal set of
+moves that turns the current order into the target order is computed (every
+rule on a longest increasing subsequence of the current order stays where it
+is) and the moves are sent as batched multi-config requests, followed by a
+single commit. Moving 20k rules one 'move' call and one commit at a time
+takes hours; a few multi-config requests take seconds.
+"""
+
+import time
+import bisect
+import logging
+from collections import namedtuple
+from xml.sax.saxutils import quoteattr
+
+from panfw.parsers import iter_rules
+from panfw.rulebase import Rulebase, RuleRecord
+from panfw.transport import PooledTransport, TransportError
+
+app_log = logging.getLogger('root')
+
+Move = namedtuple('Move', ['name', 'where', 'dst'])
+
+DEVICE_XPATH = "/config/devices/entry[@name='localhost.localdomain']"
+
+
+def entry_xpath(name):
+    """Returns the entry[@name=...] step of an xpath that selects name.
+
+    pan-os-python puts names into single quotes as they are. XPath 1.0 has
+    no escape inside a literal, so a name with a single quote goes into
+    double quotes instead.
+
+    Raises:
+        ValueError -- The name contains both quote characters
+    """
+    name = str(name)
+    if "'" not in name:
+        return f"entry[@name='{name}']"
+    if '"' not in name:
+        return f'entry[@name="{name}"]'
+    raise ValueError(f"Name {name!r} contains both quote characters and cannot be "
+                     f"addressed in an xpath, rename it")
+
+
+def rulebase_xpath(device_group=None, vsys='vsys1', rulebase='pre-rulebase', rule_type='security'):
+    """Returns the xpath of a rulebase.
+
+    Keyword Arguments:
+        device_group {str} -- Panorama device group ('shared' for shared rules).
+                              When not set the firewall vsys rulebase is used.
+        vsys {str} -- Firewall vsys (default 'vsys1')
+        rulebase {str} -- 'pre-rulebase' or 'post-rulebase' (Panorama only)
+        rule_type {str} -- 'security', 'nat', 'decryption', ...
+
+    Raises:
+        ValueError -- see entry_xpath()
+
+    Returns:
+        str -- xpath of the <rules> element
+    """
+    if device_group == 'shared':
+        return f"/config/shared/{rulebase}/{rule_type}/rules"
+    if device_group:
+        return f"{DEVICE_XPATH}/device-group/{entry_xpath(device_group)}/{rulebase}/{rule_type}/rules"
+    return f"{DEVICE_XPATH}/vsys/{entry_xpath(vsys)}/rulebase/{rule_type}/rules"
+
+
+def longest_increasing_subsequence(seq):
+    """Returns the indexes into seq of one longest strictly increasing subsequence, O(n log n)."""
+    tails = list()
+    tail_idx = list()
+    parent = [-1] * len(seq)
+    for i, value in enumerate(seq):
+        pos = bisect.bisect_left(tails, value)
+        if pos:
+            parent[i] = tail_idx[pos - 1]
+        if pos == len(tails):
+            tails.append(value)
+            tail_idx.append(i)
+        else:
+            tails[pos] = value
+            tail_idx[pos] = i
+    result = list()
+    i = tail_idx[-1] if tail_idx else -1
+    while i != -1:
+        result.append(i)
+        i = parent[i]
+    result.reverse()
+    return result
+
+
+def plan_moves(current, target):
+    """Computes the moves that bring the rules of target into target order.
+
+    Rules of current that are not listed in target are left alone, so target
+    may name only the rules whose relative order matters. Rules listed in
+    target that do not exist are ignored.
+
+    Arguments:
+        current {list} -- Rule names in their current order
+        target {list} -- Rule names in the wanted order
+
+    Returns:
+        list -- Move records, to be applied in order
+    """
+    position = {name: i for i, name in enumerate(current)}
+    target = [name for name in dict.fromkeys(target) if name in position]
+    if not target:
+        return []
+    keep = set(target[i] for i in longest_increasing_subsequence(
+        [position[name] for name in target]))
+    first_kept = next(name for name in target if name in keep)
+    moves = list()
+    for i, name in enumerate(target):
+        if name in keep:
+            continue
+        if i == 0:
+            moves.append(Move(name, 'before', first_kept))
+        else:
+            moves.append(Move(name, 'after', target[i - 1]))
+    return moves
+
+
+def simulate_moves(current, moves):
+    """Applies moves to a list of rule names and returns the new order."""
+    rulebase = Rulebase(RuleRecord(name) for name in current)
+    rulebase.apply_moves(moves)
+    return rulebase.names()
+
+
+def multi_config_element(xpath, moves, first_id=1):
+    """Builds a <multi-configure-request> with one <move> per Move."""
+    parts = ['<multi-configure-request>']
+    for i, move in enumerate(moves, first_id):
+        move_xpath = f"{xpath}/{entry_xpath(move.name)}"
+        attrs = f'id="{i}" xpath={quoteattr(move_xpath)} where="{move.where}"'
+        if move.dst is not None:
+            attrs += f' dst={quoteattr(move.dst)}'
+        parts.append(f'<move {attrs}/>')
+    parts.append('</multi-configure-request>')
+    return ''.join(parts)
+
+
+class RuleReorderEngine(object):
+    """Fetches a rulebase once, plans the moves and applies them in batches."""
+
+    def __init__(self, device, xpath, transport=None, batch_size=500, snapshot=None):
+        """
+        Arguments:
+            device {Firewall} -- Panorama or firewall holding the rulebase
+            xpath {str} -- xpath of the rulebase, see rulebase_xpath()
+
+        Keyword Arguments:
+            transport {PooledTransport} -- Transport for the API calls, a
+                                           private one is used when not given
+            batch_size {int} -- Moves per multi-config request
+            snapshot {ConfigSnapshot} -- Read the rulebase from this snapshot
+                                         (subtree 'rulebase') instead of
+                                         fetching it on every run
+        """
+        self.device = device
+        self.xpath = xpath
+        self.transport = transport or PooledTransport(pool_size=1, timeout=300)
+        self.batch_size = max(1, int(batch_size))
+        self.snapshot = snapshot
+        # Indexed model of the rulebase, kept in sync with applied moves
+        self.rulebase = None
+
+    def fetch_rules(self):
+        """Fetches the rulebase with a single config 'get'.
+
+        Returns:
+            list -- parsers.Rule records in rulebase order
+        """
+        start_time = time.time()
+        if self.snapshot is not None:
+            # Candidate config as below, only downloaded again after a change
+            self.snapshot.refresh()
+            data = self.snapshot.get('rulebase')
+        else:
+            data = self.transport.api(
+                self.device, {'type': 'config', 'action': 'get', 'xpath': self.xpath})
+        rules = list(iter_rules(data))
+        app_log.info(
+            f"Fetched {len(rules)} rules ({len(data)} bytes) from {self.device.hostname} "
+            f"in {time.time() - start_time:.2f} seconds")
+        return rules
+
+    def plan(self, target):
+        """Fetches the rulebase and returns (current order, moves) for target.
+
+        Raises:
+            ValueError -- A rule to move cannot be addressed (see entry_xpath())
+        """
+        self.rulebase = Rulebase.from_rules(self.fetch_rules())
+        current = self.rulebase.names()
+        moves = plan_moves(current, target)
+        # Fail before the first batch is sent, not half way through
+        for move in moves:
+            entry_xpath(move.name)
+        app_log.info(
+            f"{len(moves)} moves needed to reorder {len(target)} rules on {self.device.hostname}")
+        return current, moves
+
+    def apply(self, moves):
+        """Sends the moves as multi-config batches.
+
+        Falls back to one 'move' request per rule when the device does not
+        support multi-config (PAN-OS before 9.0).
+        """
+        for start in range(0, len(moves), self.batch_size):
+            batch = moves[start:start + self.batch_size]
+            try:
+                self.transport.api(self.device, {
+                    'type': 'config', 'action': 'multi-config',
+                    'element': multi_config_element(self.xpath, batch, start + 1)})
+            except TransportError as e:
+                if start or 'multi-config' not in str(e):
+                    raise
+                app_log.warning(
+                    f"multi-config not supported by {self.device.hostname}, moving rules one by one")
+                return self._apply_single(moves)
+            if self.rulebase is not None:
+                self.rulebase.apply_moves(batch)
+            app_log.info(
+                f"Applied moves {start + 1}-{start + len(batch)} of {len(moves)} on {self.device.hostname}")
+
+    def _apply_single(self, moves):
+        for move in moves:
+            params = {'type': 'config', 'action': 'move',
+                      'xpath': f"{self.xpath}/{entry_xpath(move.name)}", 'where': move.where}
+            if move.dst is not None:
+                params['dst'] = move.dst
+            self.transport.api(self.device, params)
+            if self.rulebase is not None:
+                self.rulebase.move(move.name, move.where, move.dst)
+
+    def reorder(self, target, commit=True):
+        """Plans and applies a reorder, then commits once.
+
+        Arguments:
+            target {list} -- Rule names in the wanted order
+
+        Keyword Arguments:
+            commit {bool} -- Commit the candidate config when moves were applied
+
+        Returns:
+            list -- The applied moves
+        """
+        current, moves = self.plan(target)
+        if not moves:
+            return moves
+        self.apply(moves)
+        if commit:
+            app_log.info(f"Committing {len(moves)} rule moves on {self.device.hostname}")
+            self.device.commit(sync=True, exception=True)
+        return moves
@@ -0,0 +1,289 @@
+"""
+Module:       panfw/rulebase.py
+
+Description:
+Compact in-memory model of a security rulebase for reorder planning and
+shadow checks. Rules are __slots__ objects (no pan-os-python object tree)
+indexed by name, tag, zone pair and address object.
+
+Every rule owns a slot in a sparse array; slots grow with the rule order, so
+comparing the order of two rules is O(1). A Fenwick tree over the occupied
+slots turns a slot into its ordinal position (and back) in O(log n), and a
+move only takes a free slot between its new neighbours, which makes moves
+O(log n). When two neighbours have no free slot left the slots are spread out
+again, O(n) but rare (amortized).
+"""
+
+from collections import defaultdict
+
+# Free slots left between two rules when the slots are (re)spread
+SLOT_GAP = 32
+
+ANY = 'any'
+
+
+class RuleRecord(object):
+    """One security rule, the fields needed for ordering and shadow checks."""
+
+    __slots__ = ('name', 'from_zones', 'to_zones', 'source', 'destination',
+                 'application', 'service', 'action', 'tags', 'disabled', 'slot')
+
+    def __init__(self, name, from_zones=(ANY,), to_zones=(ANY,), source=(ANY,), destination=(ANY,),
+                 application=(ANY,), service=(ANY,), action='allow', tags=(), disabled=False):
+        self.name = name
+        self.from_zones = tuple(from_zones) or (ANY,)
+        self.to_zones = tuple(to_zones) or (ANY,)
+        self.source = tuple(source) or (ANY,)
+        self.destination = tuple(destination) or (ANY,)
+        self.application = tuple(application) or (ANY,)
+        self.service = tuple(service) or (ANY,)
+        self.action = action
+        self.tags = tuple(tags)
+        self.disabled = disabled
+        self.slot = None
+
+    @classmethod
+    def from_rule(cls, rule):
+        """Builds a RuleRecord from a parsers.Rule."""
+        return cls(rule.name, rule.from_zones, rule.to_zones, rule.source, rule.destination,
+                   rule.application, rule.service, rule.action, rule.tags, rule.disabled)
+
+    def __repr__(self):
+        return f'RuleRecord({self.name!r})'
+
+
+def _covers(wide, narrow):
+    """True when the member list wide matches everything narrow matches."""
+    return ANY in wide or set(narrow) <= set(wide)
+
+
+class Rulebase(object):
+    """Ordered, indexed set of RuleRecords."""
+
+    def __init__(self, rules=()):
+        self.by_name = dict()
+        self.by_tag = defaultdict(set)
+        self.by_zone_pair = defaultdict(set)
+        self.by_address = defaultdict(set)
+        rules = list(rules)
+        for rule in rules:
+            self._index(rule)
+        self._respread(rules, len(rules))
+
+    @classmethod
+    def from_rules(cls, rules):
+        """Builds a Rulebase from parsers.Rule records (e.g. parsers.iter_rules())."""
+        return cls(RuleRecord.from_rule(rule) for rule in rules)
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        for rule in self._slots:
+            if rule is not None:
+                yield rule
+
+    def names(self):
+        """Returns the rule names in rulebase order."""
+        return [rule.name for rule in self]
+
+    # Indexes
+
+    def _index(self, rule):
+        if rule.name in self.by_name:
+            raise ValueError(f"Duplicate rule name {rule.name}")
+        self.by_name[rule.name] = rule
+        for tag in rule.tags:
+            self.by_tag[tag].add(rule.name)
+        for from_zone in rule.from_zones:
+            for to_zone in rule.to_zones:
+                self.by_zone_pair[(from_zone, to_zone)].add(rule.name)
+        for address in rule.source + rule.destination:
+            self.by_address[address].add(rule.name)
+
+    def _unindex(self, rule):
+        del self.by_name[rule.name]
+        for tag in rule.tags:
+            self.by_tag[tag].discard(rule.name)
+        for from_zone in rule.from_zones:
+            for to_zone in rule.to_zones:
+                self.by_zone_pair[(from_zone, to_zone)].discard(rule.name)
+        for address in rule.source + rule.destination:
+            self.by_address[address].discard(rule.name)
+
+    # Slots and Fenwick tree
+
+    def _respread(self, rules, count):
+        capacity = max(count, 1) * SLOT_GAP + SLOT_GAP
+        self._slots = [None] * capacity
+        self._tree = [0] * (capacity + 1)
+        for i, rule in enumerate(rules):
+            rule.slot = (i + 1) * SLOT_GAP
+            self._slots[rule.slot] = rule
+        # O(n) Fenwick construction
+        for slot in range(1, capacity + 1):
+            self._tree[slot] += 1 if self._slots[slot - 1] is not None else 0
+            parent = slot + (slot & -slot)
+            if parent <= capacity:
+                self._tree[parent] += self._tree[slot]
+
+    def _update(self, slot, delta):
+        i = slot + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, slot):
+        """Number of rules in slots [0, slot]."""
+        i = slot + 1
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _slot_of_rank(self, rank):
+        """Slot of the rule at 0-based position rank."""
+        pos = 0
+        remaining = rank + 1
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] < remaining:
+                pos = nxt
+                remaining -= self._tree[nxt]
+            step >>= 1
+        return pos
+
+    def _place(self, rule, slot):
+        rule.slot = slot
+        self._slots[slot] = rule
+        self._update(slot, 1)
+
+    def _take(self, rule):
+        self._slots[rule.slot] = None
+        self._update(rule.slot, -1)
+        rule.slot = None
+
+    # Order queries
+
+    def position(self, name):
+        """0-based position of a rule, O(log n)."""
+        return self._prefix(self.by_name[name].slot) - 1
+
+    def rule_at(self, index):
+        """Rule at a 0-based position, O(log n)."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._slots[self._slot_of_rank(index)]
+
+    def precedes(self, name_a, name_b):
+        """True when rule name_a comes before rule name_b, O(1)."""
+        return self.by_name[name_a].slot < self.by_name[name_b].slot
+
+    # Changes
+
+    def _insert_between(self, rule, low, high):
+        """Places rule on a free slot between slots low and high (exclusive)."""
+        if high - low < 2:
+            order = list(self)
+            index = order.index(self._slots[high]) if high < len(self._slots) else len(order)
+            order.insert(index, rule)
+            self._respread(order, len(order))
+            return
+        self._place(rule, (low + high) // 2)
+
+    def _neighbours(self, where, dst):
+        if where == 'top':
+            low = -1
+            high = self._slot_of_rank(0) if len(self) else len(self._slots)
+        elif where == 'bottom':
+            low = self._slot_of_rank(len(self) - 1) if len(self) else -1
+            high = len(self._slots)
+        else:
+            target = self.by_name[dst]
+            index = self._prefix(target.slot) - 1
+            if where == 'before':
+                high = target.slot
+                low = self._slot_of_rank(index - 1) if index > 0 else -1
+            elif where == 'after':
+                low = target.slot
+                high = self._slot_of_rank(index + 1) if index + 1 < len(self) else len(self._slots)
+            else:
+                raise ValueError(f"Unknown move location {where}")
+        return low, high
+
+    def add(self, rule, where='bottom', dst=None):
+        """Adds a RuleRecord at top / bottom / before dst / after dst."""
+        low, high = self._neighbours(where, dst)
+        self._index(rule)
+        self._insert_between(rule, low, high)
+
+    def remove(self, name):
+        """Removes a rule and returns it."""
+        rule = self.by_name[name]
+        self._take(rule)
+        self._unindex(rule)
+        return rule
+
+    def move(self, name, where, dst=None):
+        """Moves a rule like the PAN-OS 'move' API (top, bottom, before, after)."""
+        rule = self.by_name[name]
+        if dst == name:
+            raise ValueError(f"Cannot move rule {name} relative to itself")
+        self._take(rule)
+        low, high = self._neighbours(where, dst)
+        self._insert_between(rule, low, high)
+
+    def apply_moves(self, moves):
+        """Applies reorder.Move records in order."""
+        for move in moves:
+            self.move(move.name, move.where, move.dst)
+
+    # Lookups
+
+    def with_tag(self, tag):
+        """Rules carrying tag, in rulebase order."""
+        return self._ordered(self.by_tag.get(tag, ()))
+
+    def for_zone_pair(self, from_zone, to_zone):
+        """Rules matching traffic from from_zone to to_zone (including 'any'), in order."""
+        names = set()
+        for pair in ((from_zone, to_zone), (from_zone, ANY), (ANY, to_zone), (ANY, ANY)):
+            names |= self.by_zone_pair.get(pair, set())
+        return self._ordered(names)
+
+    def using_address(self, address):
+        """Rules referencing an address object in source or destination, in order."""
+        return self._ordered(self.by_address.get(address, ()))
+
+    def _ordered(self, names):
+        return sorted((self.by_name[name] for name in names), key=lambda rule: rule.slot)
+
+    def shadowed_by(self, name):
+        """Returns the enabled rules above name that match everything it matches.
+
+        Only rules sharing a zone pair with the rule are looked at, so the
+        check stays cheap on large rulebases.
+        """
+        rule = self.by_name[name]
+        candidates = set()
+        for from_zone in rule.from_zones:
+            for to_zone in rule.to_zones:
+                candidates.update(r.name for r in self.for_zone_pair(from_zone, to_zone))
+        shadows = list()
+        for other in self._ordered(candidates):
+            if other.slot >= rule.slot:
+                break
+            if other.disabled:
+                continue
+            if all(_covers(getattr(other, field), getattr(rule, field))
+                   for field in ('from_zones', 'to_zones', 'source', 'destination',
+                                 'application', 'service')):
+                shadows.append(other)
+        return shadows
@@ -0,0 +1,169 @@
+"""
+Module:       panfw/satellite.py
+
+Description:
+Failure state machine for GlobalProtect satellite connections. Each
+(firewall, gateway) pair moves through
+
+    healthy -> degraded -> reconnecting -> restarting
+
+one observation per scheduler tick, instead of a thread sleeping in a loop
+until the tunnel comes back. The state is persisted to disk so a restarted
+daemon continues counting where it stopped.
+
+Checks triggered by pushed log events come on top of the scheduled ones. A
+failure only counts when min_gap seconds (about the polling interval) passed
+since the last counted one, so a flapping tunnel reaches the thresholds no
+faster than with plain polling.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from panfw.logpipe import log_fields
+
+app_log = logging.getLogger('root')
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+RECONNECTING = 'reconnecting'
+RESTARTING = 'restarting'
+
+ACTION_RECONNECT = 'reconnect'
+ACTION_RESTART = 'restart'
+
+
+class SatelliteStateMachine(object):
+    """Per (firewall, gateway) failure counters and the recovery action they call for."""
+
+    def __init__(self, path=None, reconnect_threshold=5, restart_threshold=10, restart_cooldown=900,
+                 history=None):
+        """
+        Arguments:
+            path {str} -- Optional JSON file the states are persisted to
+            reconnect_threshold {int} -- Consecutive failures before the satellite
+                                         connection is reset
+            restart_threshold {int} -- Consecutive failures before the firewall
+                                       is restarted
+            restart_cooldown {float} -- Seconds to wait for a restarted firewall
+                                        before counting failures again
+            history {HealthHistory} -- Optional history store, records every
+                                       observation and keeps the states without a file
+        """
+        self.path = path
+        self.reconnect_threshold = reconnect_threshold
+        self.restart_threshold = restart_threshold
+        self.restart_cooldown = restart_cooldown
+        self.history = history
+        self._lock = threading.Lock()
+        self._states = dict()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as state_file:
+                    self._states = json.load(state_file)
+            except (OSError, ValueError) as e:
+                app_log.warning(f"Ignoring unreadable satellite state file {path}: {e}")
+        elif not path and history is not None:
+            self._states = history.load_state('satellite')
+
+    @classmethod
+    def from_config(cls, cfgdict, history=None):
+        """Build the state machine from the satellite_* keys of config.yml."""
+        return cls(path=cfgdict.get('satellite_state_file'),
+                   reconnect_threshold=cfgdict.get('reconnect_threshold') or 5,
+                   restart_threshold=cfgdict.get('restart_threshold') or 10,
+                   restart_cooldown=cfgdict.get('restart_cooldown') or 900,
+                   history=history)
+
+    @staticmethod
+    def key(hostname, gp_gateway):
+        return f'{hostname}|{gp_gateway}'
+
+    def state(self, hostname, gp_gateway):
+        """Returns the current state record (state, failures, since) of a pair."""
+        with self._lock:
+            return dict(self._states.get(self.key(hostname, gp_gateway),
+                                         {'state': HEALTHY, 'failures': 0, 'since': None}))
+
+    def observe(self, hostname, gp_gateway, connected, now=None, min_gap=None, dry_run=False):
+        """Feeds one status check into the state machine.
+
+        Arguments:
+            hostname {str} -- Firewall as named in config.yml
+            gp_gateway {str} -- GP gateway address
+            connected {bool} -- Result of the status check
+
+        Keyword Arguments:
+            now {float} -- Time of the check (default: now)
+            min_gap {float} -- Seconds since the last counted failure before
+                               another failure counts (None: every one counts)
+            dry_run {bool} -- The action is only logged: the gateway stays
+                              degraded and keeps its failure count instead of
+                              moving to reconnecting / restarting
+
+        Returns:
+            str -- ACTION_RECONNECT, ACTION_RESTART or None
+        """
+        now = time.time() if now is None else now
+        key = self.key(hostname, gp_gateway)
+        with self._lock:
+            record = self._states.setdefault(
+                key, {'state': HEALTHY, 'failures': 0, 'since': now})
+            previous = record['state']
+            action = None
+            if connected:
+                record['state'], record['failures'] = HEALTHY, 0
+            elif previous == RESTARTING and now - record['since'] < self.restart_cooldown:
+                # The firewall is still coming back, do not count this one
+                pass
+            elif min_gap and record['failures'] and previous != RESTARTING and \
+                    record.get('counted') is not None and now - record['counted'] < min_gap:
+                # An extra (event triggered) check within the polling interval
+                app_log.debug(f"GP Gateway {gp_gateway} on {hostname}: failure not counted, "
+                              f"{now - record['counted']:.0f} seconds after the last one")
+            else:
+                if previous == RESTARTING:
+                    record['failures'] = 0
+                record['failures'] += 1
+                record['counted'] = now
+                if record['failures'] >= self.restart_threshold:
+                    action = ACTION_RESTART
+                elif record['failures'] == self.reconnect_threshold:
+                    action = ACTION_RECONNECT
+                if dry_run and action is not None:
+                    # Nothing is executed, nothing to wait for
+                    record['state'] = DEGRADED
+                elif action == ACTION_RESTART:
+                    record['state'], record['failures'] = RESTARTING, 0
+                elif action == ACTION_RECONNECT:
+                    record['state'] = RECONNECTING
+                elif record['failures'] < self.reconnect_threshold:
+                    record['state'] = DEGRADED
+            changed = record['state'] != previous or not connected
+            if record['state'] != previous:
+                record['since'] = now
+                app_log.info(
+                    f"GP Gateway {gp_gateway} on {hostname}: {previous} -> {record['state']}",
+                    extra=log_fields(firewall=hostname, gateway=gp_gateway, result=record['state']))
+            snapshot = dict(record)
+        if self.history is not None:
+            self.history.record_gateway(hostname, gp_gateway, connected,
+                                        snapshot['state'], snapshot['failures'])
+            if changed:
+                self.history.put_state('satellite', key, snapshot)
+        if changed:
+            self.save()
+        return action
+
+    def save(self):
+        """Writes all states to the state file (if one is configured)."""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as state_file:
+                json.dump(self._states, state_file)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,253 @@
+"""
+Module:       panfw/scheduler.py
+
+Description:
+Heap based scheduler for daemon mode. Every firewall has its own interval
+(check_interval in its firewalls: entry, falling back to the global one) and
+is scheduled at a fixed rate, so the duration of a check does not make the
+cycle drift. A random jitter spreads the load on the management planes and
+firewalls that keep failing are backed off exponentially.
+
+With adaptive polling a job whose task reports a healthy result (e.g. all
+satellite tunnels up) is polled less and less often, its interval grows by
+adaptive_growth per healthy run up to adaptive_max_interval. The first
+result that is not healthy puts it back on its normal (or the
+adaptive_fast_interval) interval right away.
+
+trigger() runs a job right away from any thread, e.g. when a pushed log
+event reports a problem on its firewall (see panfw/receiver.py).
+"""
+
+import time
+import heapq
+import queue
+import random
+import logging
+import itertools
+
+from panfw.metrics import metrics
+
+app_log = logging.getLogger('root')
+
+
+class Scheduler(object):
+    """Fixed-rate scheduler with per key intervals, jitter and failure back-off."""
+
+    def __init__(self, default_interval=30.0, jitter=0.1, max_backoff=8, clock=time.monotonic,
+                 adaptive=False, max_interval=600.0, growth=2.0, fast_interval=None):
+        """
+        Arguments:
+            default_interval {float} -- Interval of keys added without their own
+            jitter {float} -- Random offset as a fraction of the interval (0.1 = +/-10%)
+            max_backoff {int} -- Upper bound of the back-off multiplier for failing keys
+            clock {callable} -- Monotonic time source
+            adaptive {bool} -- Stretch the interval of keys with healthy results
+            max_interval {float} -- Upper bound of a stretched interval
+            growth {float} -- Stretch factor per healthy run
+            fast_interval {float} -- Interval after a result that is not healthy
+                                     (None: the key's own interval)
+        """
+        self.default_interval = float(default_interval)
+        self.jitter = jitter
+        self.max_backoff = max(1, max_backoff)
+        self.clock = clock
+        self.adaptive = adaptive
+        self.max_interval = float(max_interval)
+        self.growth = max(1.0, float(growth))
+        self.fast_interval = fast_interval
+        self._heap = list()
+        self._seq = itertools.count()
+        self._jobs = dict()
+        self._completed = queue.Queue()
+        self._triggered = queue.Queue()
+
+    @classmethod
+    def from_config(cls, cfgdict):
+        """Build a scheduler from check_interval / schedule_jitter / max_backoff_factor."""
+        scheduler = cls()
+        scheduler.configure(cfgdict)
+        return scheduler
+
+    def configure(self, cfgdict):
+        """Applies check_interval / schedule_jitter / max_backoff_factor and the
+        adaptive_* keys, also to a running scheduler (keys without their own
+        interval follow the new check_interval after set_interval(key, None)).
+        """
+        jitter = cfgdict.get('schedule_jitter')
+        self.default_interval = float(cfgdict.get('check_interval') or 30.0)
+        self.jitter = 0.1 if jitter is None else jitter
+        self.max_backoff = max(1, cfgdict.get('max_backoff_factor') or 8)
+        self.adaptive = bool(cfgdict.get('adaptive_polling'))
+        self.max_interval = float(cfgdict.get('adaptive_max_interval') or 600.0)
+        self.growth = max(1.0, float(cfgdict.get('adaptive_growth') or 2.0))
+        self.fast_interval = cfgdict.get('adaptive_fast_interval') or None
+        if not self.adaptive:
+            for job in self._jobs.values():
+                job['stretch'] = 1.0
+
+    def add(self, key, interval=None):
+        """Schedules key. The first run is spread randomly over one interval."""
+        interval = float(interval or self.default_interval)
+        job = {'interval': interval, 'failures': 0, 'running': False, 'anchor': None,
+               'stretch': 1.0}
+        self._jobs[key] = job
+        self._push(key, self.clock() + random.uniform(0, interval))
+
+    def remove(self, key):
+        """Stops scheduling key, a running check is not interrupted."""
+        self._jobs.pop(key, None)
+
+    def set_interval(self, key, interval):
+        """Changes the interval of key from its next run on."""
+        if key in self._jobs:
+            self._jobs[key]['interval'] = float(interval or self.default_interval)
+
+    def keys(self):
+        return list(self._jobs.keys())
+
+    def current_interval(self, key):
+        """Interval of key including the adaptive stretch, without back-off."""
+        job = self._jobs.get(key)
+        return None if job is None else job['interval'] * job['stretch']
+
+    def stretched(self):
+        """Number of keys polled less often because of healthy results."""
+        return sum(1 for job in list(self._jobs.values()) if job['stretch'] > 1.0)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def _push(self, key, due):
+        job = self._jobs[key]
+        job['anchor'] = due
+        job['token'] = next(self._seq)
+        heapq.heappush(self._heap, (due, job['token'], key))
+
+    def next_due(self):
+        """Returns the time of the next scheduled run (None when nothing is scheduled)."""
+        while self._heap:
+            due, token, key = self._heap[0]
+            job = self._jobs.get(key)
+            if job is not None and job['token'] == token and not job['running']:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now=None):
+        """Removes and returns the (key, lag) of every key that is due."""
+        now = self.clock() if now is None else now
+        due_keys = list()
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            due, token, key = heapq.heappop(self._heap)
+            self._jobs[key]['running'] = True
+            due_keys.append((key, now - due))
+        return due_keys
+
+    def complete(self, key, ok, healthy=None):
+        """Reschedules key after a run.
+
+        The next run is one interval after the previous *scheduled* time
+        (fixed rate); slots that were missed because the run took longer are
+        skipped instead of being run back to back. Consecutive failures
+        multiply the interval by 2, 4, ... up to max_backoff.
+
+        With adaptive polling a healthy result multiplies the interval by
+        growth (up to max_interval), any other result resets it to the
+        normal interval, or to fast_interval if that is shorter. healthy=None
+        (the task does not tell) leaves the interval as it is.
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            return
+        job['running'] = False
+        job['failures'] = 0 if ok else job['failures'] + 1
+        base = job['interval']
+        if self.adaptive and healthy is not None:
+            if ok and healthy:
+                job['stretch'] = min(job['stretch'] * self.growth,
+                                     max(self.max_interval / base, 1.0))
+            else:
+                if self.fast_interval:
+                    base = min(base, float(self.fast_interval))
+                if job['stretch'] > 1.0:
+                    app_log.info(f"{key} is not healthy, back to polling every {base:.0f} seconds")
+                job['stretch'] = 1.0
+        interval = base * job['stretch'] * min(2 ** job['failures'], self.max_backoff)
+        now = self.clock()
+        due = job['anchor'] + interval
+        if due < now:
+            due += interval * (int((now - due) // interval) + 1)
+        if job['failures']:
+            app_log.info(
+                f"{key} failed {job['failures']} time(s) in a row, next run in {due - now:.0f} seconds")
+        due += random.uniform(-self.jitter, self.jitter) * base * job['stretch']
+        self._push(key, max(due, now))
+
+    def trigger(self, key):
+        """Runs key as soon as possible, thread safe. A key that is running
+        already is not run a second time, and the stretch of adaptive polling
+        is dropped.
+        """
+        self._triggered.put(key)
+        # Wakes the run loop up
+        self._completed.put(None)
+
+    def _run_triggered(self):
+        now = self.clock()
+        while True:
+            try:
+                key = self._triggered.get_nowait()
+            except queue.Empty:
+                break
+            job = self._jobs.get(key)
+            if job is None or job['running']:
+                continue
+            job['stretch'] = 1.0
+            self._push(key, now)
+
+    def done_callback(self, key):
+        """Returns a thread safe callback done(result, healthy=None) that marks
+        key complete with result.ok (healthy: see complete()).
+        """
+        return lambda result, healthy=None: self._completed.put((key, result.ok, healthy))
+
+    def run(self, dispatch, stop=None, tick=None):
+        """Dispatches due keys until stop() returns True (or forever).
+
+        Arguments:
+            dispatch {callable} -- Called as dispatch(key, done) for every due
+                                   key. It must eventually call done(result)
+                                   with an object having an 'ok' attribute,
+                                   possibly from another thread, optionally
+                                   with healthy (see complete()).
+            stop {callable} -- Optional predicate checked between dispatches
+            tick {callable} -- Optional housekeeping (e.g. config reload),
+                               called about once a second between dispatches
+        """
+        while stop is None or not stop():
+            if tick is not None:
+                tick()
+            while True:
+                try:
+                    item = self._completed.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.complete(*item)
+            self._run_triggered()
+            for key, lag in self.pop_due():
+                metrics.observe('panfw_cycle_lag_seconds', lag)
+                if lag > 1.0:
+                    app_log.debug(f"{key} dispatched {lag:.2f} seconds late")
+                dispatch(key, self.done_callback(key))
+            next_due = self.next_due()
+            timeout = 1.0 if next_due is None else min(max(next_due - self.clock(), 0.0), 1.0)
+            try:
+                item = self._completed.get(timeout=timeout)
+                if item is not None:
+                    self.complete(*item)
+            except queue.Empty:
+                pass
@@ -0,0 +1,527 @@
+"""
+Module:       panfw/sharding.py
+
+Description:
+Sharded execution for very large fleets (execution_mode: processes). The
+firewalls are split into shards by consistent hashing of their address and
+every shard is served by its own worker process, which initializes its
+firewalls once and runs the usual per-firewall body on a thread pool
+(FleetExecutor). XML decoding and response parsing then use every CPU core
+instead of a single one under the GIL. Results and log records are sent back
+to the parent process.
+
+A firewall always hashes to the same shard, also across restarts, so its
+in-memory and on-disk state (failure counters, HA cache) stays with one
+worker. Changing the number of shards only moves about 1/N of the firewalls.
+
+The workers are forked from the running process (the 'fork' start method
+whatever the platform default is): they inherit the runtime and its config,
+the init function is a bound method of it and cannot be pickled. Platforms
+without fork (Windows) cannot use this mode. start() forks the workers of
+all configured firewalls before this module or the runtime start any thread,
+a lock held by another thread at the time of the fork would stay locked in
+the worker forever. Only workers restarted later (after a crash or a config
+reload) are forked from a process with threads.
+"""
+
+import os
+import math
+import time
+import bisect
+import pickle
+import hashlib
+import queue
+import logging
+import itertools
+import threading
+import multiprocessing
+import logging.handlers as lh
+
+from panfw.executor import QUEUE_POLL, FleetExecutor, FirewallResult
+from panfw.metrics import metrics
+from panfw.history import flush_all
+from panfw.planner import drain_all
+
+app_log = logging.getLogger('root')
+
+# config.yml keys of per-device state files, every shard keeps its own copy
+SHARD_PATH_KEYS = ('ha_cache_file', 'satellite_state_file')
+
+# Seconds between two metrics snapshots sent by a shard worker
+METRICS_PUSH_INTERVAL = 5
+
+# Task queue item (DRAIN, timeout): run the actions the worker planned, its
+# answer on the results queue is (DRAIN, (shard, totals))
+DRAIN = 'drain'
+
+# Results queue item (STARTED, (task_id, start_time)): a worker thread started
+# on the firewall, its firewall_timeout counts from start_time
+STARTED = 'started'
+
+
+def fork_context():
+    """Returns the multiprocessing context of the shard workers.
+
+    Raises:
+        RuntimeError -- The platform cannot fork
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise RuntimeError(
+            "execution_mode: processes needs the 'fork' start method, which this "
+            "platform does not have. Use execution_mode: threads instead.")
+    return multiprocessing.get_context('fork')
+
+
+def stable_hash(key):
+    """Stable 64 bit hash (the builtin hash() is salted per process)."""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping firewall addresses to shard numbers."""
+
+    def __init__(self, shards, replicas=64):
+        """
+        Arguments:
+            shards {int} -- Number of shards
+
+        Keyword Arguments:
+            replicas {int} -- Points per shard on the ring, more points give a
+                              more even split
+        """
+        self.shards = max(1, int(shards))
+        ring = sorted((stable_hash(f'shard-{shard}-{replica}'), shard)
+                      for shard in range(self.shards) for replica in range(replicas))
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def shard_of(self, key):
+        """Returns the shard number of a firewall address."""
+        i = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._owners[i]
+
+    def split(self, keys):
+        """Returns shard number: list of keys, for the shards that got any."""
+        shards = dict()
+        for key in keys:
+            shards.setdefault(self.shard_of(key), list()).append(key)
+        return shards
+
+
+def shard_config(cfgdict, shard, hostnames=None):
+    """Returns the config of one shard, for use in its worker process.
+
+    The state files in SHARD_PATH_KEYS get a '.shard<N>' suffix so workers
+    never write the same file, and credentials are never prompted for.
+
+    Arguments:
+        cfgdict {dict} -- Parsed config.yml
+        shard {int} -- Shard number
+
+    Keyword Arguments:
+        hostnames {list} -- Only keep these firewalls (default: all)
+
+    Returns:
+        dict -- Shallow copy of cfgdict
+    """
+    shard_cfg = dict(cfgdict)
+    if cfgdict.get('shard') != shard:
+        for key in SHARD_PATH_KEYS:
+            if shard_cfg.get(key):
+                root, ext = os.path.splitext(shard_cfg[key])
+                shard_cfg[key] = f'{root}.shard{shard}{ext}'
+    shard_cfg['shard'] = shard
+    shard_cfg['non_interactive'] = True
+    if hostnames is not None:
+        shard_cfg['firewalls'] = {
+            hostname: cfgdict['firewalls'][hostname]
+            for hostname in hostnames if hostname in cfgdict['firewalls']}
+    return shard_cfg
+
+
+def _portable(res):
+    """Makes sure a FirewallResult can be sent to the parent process."""
+    try:
+        pickle.dumps(res.result)
+        return res
+    except Exception:
+        return res._replace(result=repr(res.result))
+
+
+def _shard_main(shard, init_func, tasks, results, log_queue, max_workers, report_start=False):
+    """Worker process of one shard.
+
+    Receives (func, batch) with a batch of (task_id, hostname), initializes
+    firewalls it has not seen yet with init_func(shard, hostnames) and runs
+    func(fw) on a thread pool. Every result is put on the results queue as
+    (task_id, result), the metrics of the worker as (None, (shard, samples)),
+    and with report_start the start of every call as (STARTED, (task_id, time)).
+    (DRAIN, timeout) waits up to timeout seconds for the running calls and
+    then runs the actions planned in this worker (see panfw/planner.py).
+    """
+    for handler in list(app_log.handlers):
+        app_log.removeHandler(handler)
+
+    def tag_shard(record):
+        record.shard = shard
+        return True
+
+    handler = lh.QueueHandler(log_queue)
+    handler.addFilter(tag_shard)
+    app_log.addHandler(handler)
+    # Samples inherited from the parent are the parent's to report
+    metrics.reset()
+    executor = FleetExecutor('threads', max_workers)
+    metrics.gauge_callback('panfw_queue_depth', executor.pending)
+    fw_objs = dict()
+    parent_pid = os.getppid()
+    pushed = time.time()
+    while True:
+        if metrics.enabled and time.time() - pushed >= METRICS_PUSH_INTERVAL:
+            results.put((None, (shard, metrics.snapshot())))
+            pushed = time.time()
+        try:
+            item = tasks.get(timeout=METRICS_PUSH_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                # The parent was killed without shutting the shards down
+                break
+            continue
+        except KeyboardInterrupt:
+            # Ctrl+C reaches the whole process group, the parent shuts down
+            break
+        if item is None:
+            break
+        func, batch = item
+        if func == DRAIN:
+            deadline = time.time() + batch
+            while executor.pending() and time.time() < deadline:
+                time.sleep(0.05)
+            totals = drain_all()
+            flush_all()
+            results.put((DRAIN, (shard, totals)))
+            continue
+        missing = [hostname for _, hostname in batch if hostname not in fw_objs]
+        if missing:
+            try:
+                for fw in init_func(shard, missing):
+                    fw_objs[fw.hostname] = fw
+            except Exception:
+                app_log.exception(f"Shard {shard} could not initialize {', '.join(missing)}")
+        for task_id, hostname in batch:
+            fw = fw_objs.get(hostname)
+            if fw is None:
+                results.put((task_id, FirewallResult(
+                    hostname, False, None, 0.0, f'not initialized in shard {shard}')))
+                continue
+            on_start = None
+            if report_start:
+                def on_start(task_id=task_id):
+                    results.put((STARTED, (task_id, time.time())))
+            executor.submit(fw, func, lambda res, task_id=task_id: results.put(
+                (task_id, _portable(res))), on_start=on_start)
+    executor.shutdown()
+    # Actions proposed after the last drain (ShardedExecutor.shutdown drains first)
+    drain_all()
+    # History rows recorded in this worker (gateway states, actions)
+    flush_all()
+    if metrics.enabled:
+        results.put((None, (shard, metrics.snapshot())))
+
+
+class ShardedExecutor(object):
+    """Drop-in for FleetExecutor that runs every shard in a worker process.
+
+    The per-firewall functions are sent to the workers with every batch and
+    must be picklable (module level functions or e.g. panfw.core.TaskCall).
+    """
+
+    mode = 'processes'
+
+    def __init__(self, init_func, shards=None, max_workers=16, timeout=None, replicas=64):
+        """
+        Arguments:
+            init_func {callable} -- Called as init_func(shard, hostnames) in the
+                                    worker, returns the Firewall objects
+
+        Keyword Arguments:
+            shards {int} -- Number of worker processes (default: CPU count)
+            max_workers {int} -- Firewalls polled at the same time per shard
+            timeout {float} -- Seconds to wait for a single firewall, from
+                               the moment a worker thread starts on it
+            replicas {int} -- Points per shard on the hash ring
+        """
+        self.init_func = init_func
+        self._context = fork_context()
+        self.ring = HashRing(shards or os.cpu_count() or 1, replicas)
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self._workers = dict()
+        self._callbacks = dict()
+        self._started = dict()
+        self._task_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._drained = dict()
+        self._drain_event = threading.Event()
+        self._results = None
+        self._logs = None
+        self._listener = None
+        self._collector = None
+
+    @classmethod
+    def from_config(cls, cfgdict, init_func):
+        """Build a sharded executor from shards / max_workers / firewall_timeout in config.yml."""
+        return cls(init_func, shards=cfgdict.get('shards'),
+                   max_workers=cfgdict.get('max_workers') or 16,
+                   timeout=cfgdict.get('firewall_timeout'))
+
+    def start(self, hostnames=()):
+        """Forks the workers of the shards holding hostnames, then starts the
+        log and result threads. Called before anything else in the process
+        starts a thread; shards without a firewall yet are forked when they
+        get one.
+
+        Arguments:
+            hostnames {list} -- Firewall addresses of the fleet
+        """
+        with self._lock:
+            if self._collector is not None:
+                return
+            self._results = self._context.Queue()
+            self._logs = self._context.Queue()
+            for shard in sorted(self.ring.split(hostnames)):
+                self._worker(shard)
+            self._start_threads()
+
+    def _start_threads(self):
+        # Called with the lock held
+        if self._collector is not None:
+            return
+        if self._results is None:
+            self._results = self._context.Queue()
+            self._logs = self._context.Queue()
+        self._listener = lh.QueueListener(
+            self._logs, *app_log.handlers, respect_handler_level=True)
+        self._listener.start()
+        self._collector = threading.Thread(
+            target=self._collect, name='shard-results', daemon=True)
+        self._collector.start()
+
+    def _worker(self, shard):
+        """Returns the task queue of a shard, (re)starting its process if needed."""
+        worker = self._workers.get(shard)
+        if worker is not None and worker[0].is_alive():
+            return worker[1]
+        if worker is not None:
+            app_log.error(f"Worker of shard {shard} exited with code {worker[0].exitcode}, restarting it")
+        tasks = self._context.Queue()
+        proc = self._context.Process(
+            target=_shard_main, name=f'shard-{shard}', daemon=True,
+            args=(shard, self.init_func, tasks, self._results, self._logs,
+                  self.max_workers, self.timeout is not None))
+        proc.start()
+        self._workers[shard] = (proc, tasks)
+        return tasks
+
+    def _collect(self):
+        while True:
+            try:
+                item = self._results.get(timeout=1)
+            except queue.Empty:
+                self._reap()
+                continue
+            if item is None:
+                break
+            task_id, res = item
+            if task_id is None:
+                # Metrics snapshot of a shard worker
+                metrics.merge(*res)
+                continue
+            if task_id == STARTED:
+                with self._lock:
+                    if res[0] in self._callbacks:
+                        self._started[res[0]] = res[1]
+                continue
+            if task_id == DRAIN:
+                with self._lock:
+                    self._drained[res[0]] = res[1]
+                self._drain_event.set()
+                continue
+            with self._lock:
+                task = self._callbacks.pop(task_id, None)
+                self._started.pop(task_id, None)
+            if task is not None:
+                task[2](res)
+
+    def _reap(self):
+        """Fails the open tasks of shards whose worker process died, so the
+        daemon scheduler does not wait for them forever. The worker is
+        restarted by the next task sent to the shard.
+        """
+        with self._lock:
+            dead = set(shard for shard, (proc, _) in self._workers.items()
+                       if not proc.is_alive())
+            lost = [(task_id, task) for task_id, task in self._callbacks.items()
+                    if task[0] in dead]
+            for task_id, _ in lost:
+                del self._callbacks[task_id]
+                self._started.pop(task_id, None)
+        for _, (shard, hostname, callback) in lost:
+            callback(FirewallResult(hostname, False, None, 0.0, f'worker of shard {shard} died'))
+
+    def _dispatch(self, fw_objs, func, callback):
+        """Sends one batch per shard, callback(result) is called per firewall.
+
+        Returns:
+            list -- (task_id, shard) per firewall, in the order of fw_objs
+        """
+        with self._lock:
+            self._start_threads()
+            batches = dict()
+            tasks = list()
+            for fw in fw_objs:
+                task_id = next(self._task_ids)
+                shard = self.ring.shard_of(fw.hostname)
+                self._callbacks[task_id] = (shard, fw.hostname, callback)
+                batches.setdefault(shard, list()).append((task_id, fw.hostname))
+                tasks.append((task_id, shard))
+            for shard, batch in batches.items():
+                self._worker(shard).put((func, batch))
+        return tasks
+
+    def run(self, fw_objs, func):
+        """Run func(fw) for every firewall in its shard's worker and collect the results.
+
+        Returns:
+            list -- FirewallResult per firewall, in the order of fw_objs
+        """
+        done = dict()
+        all_done = threading.Event()
+        hostnames = [fw.hostname for fw in fw_objs]
+
+        def finish(res):
+            done[res.hostname] = res
+            if len(done) >= len(hostnames):
+                all_done.set()
+
+        if not hostnames:
+            return list()
+        start_time = time.time()
+        tasks = self._dispatch(fw_objs, func, finish)
+        if self.timeout is None:
+            all_done.wait()
+            return [done[hostname] for hostname in hostnames]
+        # A firewall that no worker thread started on by then waits for
+        # threads held by hung firewalls: one timeout to initialize the
+        # shard's firewalls, one per round of max_workers calls
+        sizes = dict()
+        for _, shard in tasks:
+            sizes[shard] = sizes.get(shard, 0) + 1
+        queue_deadlines = {shard: start_time + self.timeout * (1 + math.ceil(size / self.max_workers))
+                           for shard, size in sizes.items()}
+        timed_out = dict()
+        while not all_done.is_set():
+            now = time.time()
+            with self._lock:
+                started = {task_id: self._started.get(task_id) for task_id, _ in tasks}
+            waiting = list()
+            for hostname, (task_id, shard) in zip(hostnames, tasks):
+                if hostname in done or hostname in timed_out:
+                    continue
+                call_start = started[task_id]
+                deadline = queue_deadlines[shard] if call_start is None else call_start + self.timeout
+                if now < deadline:
+                    waiting.append((deadline, call_start))
+                elif call_start is None:
+                    timed_out[hostname] = FirewallResult(
+                        hostname, False, None, 0.0, 'timed out waiting for a free worker')
+                else:
+                    timed_out[hostname] = FirewallResult(
+                        hostname, False, None, now - call_start, 'timed out')
+            if not waiting:
+                break
+            # Until the next deadline, or a short while when a queued
+            # firewall may start (its deadline is not known before)
+            timeout = min(deadline for deadline, _ in waiting) - now
+            if any(call_start is None for _, call_start in waiting):
+                timeout = min(timeout, QUEUE_POLL)
+            all_done.wait(timeout)
+        return [timed_out.get(hostname) or done[hostname] for hostname in hostnames]
+
+    def pending(self):
+        """Number of per-firewall calls sent to the workers and not finished yet."""
+        with self._lock:
+            return len(self._callbacks)
+
+    def pids(self):
+        """Process ids of the running shard workers."""
+        with self._lock:
+            return [proc.pid for proc, _ in self._workers.values() if proc.is_alive()]
+
+    def submit(self, fw, func, callback):
+        """Run func(fw) in its shard's worker without waiting, used by the daemon scheduler."""
+        self._dispatch([fw], func, callback)
+
+    def restart_shards(self, hostnames):
+        """Replaces the workers of the shards holding hostnames, e.g. after a
+        config reload. The new workers are forked from the current state of
+        this process; the old ones finish their queued tasks and exit.
+        """
+        with self._lock:
+            for shard in set(self.ring.shard_of(hostname) for hostname in hostnames):
+                worker = self._workers.pop(shard, None)
+                if worker is not None:
+                    worker[1].put(None)
+                    app_log.info(f"Restarting the worker of shard {shard}")
+
+    def drain(self):
+        """Makes every worker run the actions its planner collected and waits
+        until they are done, without a deadline: a restart or a commit is not
+        cut off halfway. Workers that die meanwhile are not waited for.
+
+        Returns:
+            dict -- result: number of actions, summed over the shards
+        """
+        with self._lock:
+            workers = {shard: proc for shard, (proc, tasks) in self._workers.items()
+                       if proc.is_alive()}
+            self._drained = dict()
+            for shard in workers:
+                self._workers[shard][1].put((DRAIN, self.timeout or 30))
+        while True:
+            with self._lock:
+                waiting = [shard for shard, proc in workers.items()
+                           if shard not in self._drained and proc.is_alive()]
+                drained = dict(self._drained)
+            if not waiting:
+                break
+            self._drain_event.wait(1)
+            self._drain_event.clear()
+        totals = dict()
+        for shard_totals in drained.values():
+            for result, count in shard_totals.items():
+                totals[result] = totals.get(result, 0) + count
+        return totals
+
+    def shutdown(self):
+        """Runs the actions planned in the workers (see drain()), then stops the
+        worker processes and the log / result threads.
+        """
+        totals = self.drain()
+        if totals:
+            app_log.info("Actions of the shard workers: " +
+                         ', '.join(f'{count} {result}' for result, count in sorted(totals.items())))
+        for proc, tasks in self._workers.values():
+            tasks.put(None)
+        for proc, tasks in self._workers.values():
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+        self._workers.clear()
+        if self._collector is not None:
+            self._results.put(None)
+            self._collector.join(5)
+            self._collector = None
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
@@ -0,0 +1,514 @@
+"""
+Module:       panfw/simulator.py
+
+Description:
+Offline PAN-OS XML API simulator for load tests without real firewalls
+(python3 -m panfw simulate). Every virtual device listens on its own
+loopback address (127.1.0.1, 127.1.0.2, ...) so the scripts see a fleet of
+distinct firewalls, and answers the requests the scripts send:
+
+    keygen, show high-availability state, show system info,
+    show global-protect-satellite current-gateway,
+    test global-protect-satellite gateway-reconnect,
+    config get / show / move / multi-config of a rulebase,
+    commit and show jobs, config log queries (the rule moves)
+
+Latency (with jitter and a share of slow devices), API errors, satellite
+failures and HA pairs are configurable. The devices are served by a few
+asyncio worker processes, thousands of devices are fine as long as the open
+file limit allows one listening socket per device. Loopback addresses other
+than 127.0.0.1 need Linux.
+"""
+
+import os
+import re
+import ssl
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import ipaddress
+import subprocess
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from xml.etree import ElementTree as et
+from xml.sax.saxutils import escape, quoteattr
+
+from panfw.metrics import command_name
+from panfw.snapshot import xpath_words
+
+app_log = logging.getLogger('root')
+
+FIRST_ADDRESS = '127.1.0.1'
+DEFAULT_PORT = 8443
+SIM_USERNAME = 'sim-admin'
+SIM_PASSWORD = 'sim-password'
+SATELLITE_NAME = 'sim-satellite'
+
+SUCCESS = '<response status="success"><result>{}</result></response>'
+ERROR = '<response status="error" code="{code}"><msg><line>{msg}</line></msg></response>'
+
+
+def device_addresses(count, first=FIRST_ADDRESS):
+    """Returns count loopback addresses from first on, skipping .0 and .255."""
+    addresses = list()
+    address = ipaddress.IPv4Address(first)
+    while len(addresses) < count:
+        if str(address).split('.')[-1] not in ('0', '255'):
+            addresses.append(str(address))
+        address += 1
+    return addresses
+
+
+def raise_file_limit():
+    """Raises the soft open file limit to the hard limit, returns the new limit."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+def self_signed_cert(directory):
+    """Creates a self-signed certificate with the openssl command line tool.
+
+    Returns:
+        tuple -- (certificate file, key file)
+    """
+    if shutil.which('openssl') is None:
+        raise ValueError('The simulator needs the openssl command to create its '
+                         'certificate, or --cert and --key')
+    cert_file = os.path.join(directory, 'sim-cert.pem')
+    key_file = os.path.join(directory, 'sim-key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                    '-subj', '/CN=panfw-simulator', '-keyout', key_file, '-out', cert_file],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+class SimulatedDevice(object):
+    """State of one virtual firewall."""
+
+    def __init__(self, index, address, gateways, rules, ha_state=None, peer=None, slow=False):
+        self.index = index
+        self.address = address
+        self.api_key = f'SIM-{index}'
+        self.gateways = list(gateways)
+        self.rule_count = rules
+        self.ha_state = ha_state
+        self.peer = peer
+        self.slow = slow
+        self.last_commit = 1
+        self._rules = None
+        # (seqno, path) of the config changes and the results of log query jobs
+        self.config_log = list()
+        self.log_jobs = dict()
+        self.last_log_job = 0
+
+    @property
+    def rules(self):
+        # Created on first use, most load tests never fetch a rulebase
+        if self._rules is None:
+            self._rules = [f'rule-{i}' for i in range(self.rule_count)]
+        return self._rules
+
+    def move(self, name, where, dst=None):
+        rules = self.rules
+        if name not in rules or (dst is not None and dst not in rules):
+            raise ValueError(f'No such rule {name if name not in rules else dst}')
+        rules.remove(name)
+        if where == 'top':
+            rules.insert(0, name)
+        elif where == 'bottom':
+            rules.append(name)
+        else:
+            i = rules.index(dst)
+            rules.insert(i + 1 if where == 'after' else i, name)
+
+    def log_change(self, xpath):
+        seqno = self.config_log[-1][0] + 1 if self.config_log else 1
+        self.config_log.append((seqno, ' '.join(xpath_words(xpath))))
+
+    def query_log(self, nlogs, query=None, direction='backward'):
+        """Starts a config log query job, returns its id."""
+        match = re.search(r'seqno geq (\d+)', query or '')
+        entries = [entry for entry in self.config_log
+                   if match is None or entry[0] >= int(match.group(1))]
+        if direction != 'forward':
+            entries.reverse()
+        self.last_log_job += 1
+        self.log_jobs[self.last_log_job] = entries[:nlogs]
+        return self.last_log_job
+
+
+class Simulator(object):
+    """Fleet of virtual firewalls and the worker processes serving them."""
+
+    def __init__(self, devices=100, port=DEFAULT_PORT, latency=0.02, jitter=0.25,
+                 error_rate=0.0, satellite_failure_rate=0.0, ha_fraction=0.0,
+                 slow_fraction=0.0, slow_factor=10.0, gateways=1, rules=0, workers=2,
+                 first_address=FIRST_ADDRESS, cert_file=None, key_file=None, seed=1):
+        """
+        Keyword Arguments:
+            devices {int} -- Number of virtual firewalls (HA pairs count as two)
+            port {int} -- Port every device listens on
+            latency {float} -- Mean response time in seconds
+            jitter {float} -- Random +/- share of the latency
+            error_rate {float} -- Share of requests answered with an API error
+            satellite_failure_rate {float} -- Share of satellite tunnels reported down
+            ha_fraction {float} -- Share of the devices that are members of an HA pair
+            slow_fraction {float} -- Share of the devices answering slow_factor times slower
+            slow_factor {float} -- Latency multiplier of the slow devices
+            gateways {int} -- GP gateways per satellite
+            rules {int} -- Rules in the rulebase of every device
+            workers {int} -- Worker processes serving the devices
+            first_address {str} -- Loopback address of the first device
+            cert_file {str} -- TLS certificate (a self-signed one is created if None)
+            key_file {str} -- TLS key
+            seed {int} -- Seed of the fleet layout and of the random failures
+        """
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_factor = slow_factor
+        self.satellite_failure_rate = satellite_failure_rate
+        self.workers = max(1, int(workers))
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.seed = seed
+        rnd = random.Random(seed)
+        addresses = device_addresses(devices, first_address)
+        self.devices = list()
+        for i, address in enumerate(addresses):
+            gw = [f'198.18.{(i * gateways + g) // 250 % 250}.{(i * gateways + g) % 250 + 1}'
+                  for g in range(gateways)]
+            self.devices.append(SimulatedDevice(i, address, gw, rules,
+                                                slow=rnd.random() < slow_fraction))
+        # Consecutive devices form the HA pairs, the first member is active
+        pairs = int(devices * ha_fraction) // 2
+        for i in range(pairs):
+            active, passive = self.devices[2 * i], self.devices[2 * i + 1]
+            active.ha_state, passive.ha_state = 'active', 'passive'
+            active.peer, passive.peer = passive, active
+            passive.gateways = active.gateways
+            passive.api_key = active.api_key
+        self._procs = list()
+        self._tmpdir = None
+        # The workers inherit the fleet by forking, the bound _serve method
+        # and its devices are not pickled for a spawned process
+        self._context = multiprocessing.get_context('fork')
+        self.requests = self._context.Value('L', 0)
+        self.errors = self._context.Value('L', 0)
+
+    def firewalls(self, api_keys=True):
+        """Returns the firewalls: section of a config.yml for the fleet.
+
+        Keyword Arguments:
+            api_keys {bool} -- Include the API keys (False makes the scripts
+                               generate them with keygen)
+        """
+        fw_dict = dict()
+        for device in self.devices:
+            if device.ha_state == 'passive':
+                continue
+            entry = {'port': self.port, 'gp_gateways': device.gateways,
+                     'gp_satellite_name': SATELLITE_NAME}
+            if api_keys:
+                entry['api_key'] = device.api_key
+            if device.peer is not None:
+                entry['ha_peer_ip'] = device.peer.address
+            fw_dict[device.address] = entry
+        return fw_dict
+
+    def start(self, timeout=60):
+        """Starts the worker processes and waits until every device listens."""
+        raise_file_limit()
+        if self.cert_file is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='panfw-sim-')
+            self.cert_file, self.key_file = self_signed_cert(self._tmpdir)
+        ready = self._context.Queue()
+        for worker in range(self.workers):
+            proc = self._context.Process(target=self._serve, args=(worker, ready),
+                                           name=f'simulator-{worker}', daemon=True)
+            proc.start()
+            self._procs.append(proc)
+        for _ in range(self.workers):
+            worker, error = ready.get(timeout=timeout)
+            if error:
+                self.stop()
+                raise ValueError(f'Simulator worker {worker} could not start: {error}')
+        app_log.info(
+            f'Simulating {len(self.devices)} devices on {self.devices[0].address}-'
+            f'{self.devices[-1].address} port {self.port} ({self.workers} workers)')
+
+    def stop(self):
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            proc.join(5)
+        self._procs = list()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def stats(self):
+        """Returns (requests, errors) answered so far."""
+        return self.requests.value, self.errors.value
+
+    def _serve(self, worker, ready):
+        random.seed(self.seed * 1000 + worker)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        servers = list()
+        try:
+            context.load_cert_chain(self.cert_file, self.key_file)
+            for device in self.devices[worker::self.workers]:
+                servers.append(loop.run_until_complete(asyncio.start_server(
+                    lambda reader, writer, device=device: self._connection(device, reader, writer),
+                    device.address, self.port, ssl=context, backlog=64)))
+        except Exception as e:
+            ready.put((worker, repr(e)))
+            return
+        ready.put((worker, None))
+        try:
+            loop.run_forever()
+        finally:
+            for server in servers:
+                server.close()
+
+    async def _connection(self, device, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split(None, 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+                params = parse_qs(urlsplit(target).query)
+                params.update(parse_qs(body.decode('utf-8')))
+                params = {key: values[-1] for key, values in params.items()}
+                payload = (await self._respond(device, params)).encode('utf-8')
+                close = headers.get('connection', '').lower() == 'close' or \
+                    version.strip() == 'HTTP/1.0'
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/xml; charset=UTF-8\r\n'
+                             b'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+                             % (len(payload), b'close' if close else b'keep-alive') + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, device, params):
+        latency = self.latency * (1 + random.uniform(-self.jitter, self.jitter))
+        if device.slow:
+            latency *= self.slow_factor
+        if latency > 0:
+            await asyncio.sleep(latency)
+        with self.requests.get_lock():
+            self.requests.value += 1
+        if random.random() < self.error_rate:
+            with self.errors.get_lock():
+                self.errors.value += 1
+            return ERROR.format(code=13, msg='Simulated API error')
+        try:
+            return self.handle(device, params)
+        except (ValueError, KeyError, et.ParseError) as e:
+            return ERROR.format(code=14, msg=escape(str(e)))
+
+    def handle(self, device, params):
+        """Returns the XML response of one request to device."""
+        request_type = params.get('type')
+        if request_type == 'keygen':
+            if params.get('user') != SIM_USERNAME or params.get('password') != SIM_PASSWORD:
+                return ERROR.format(code=403, msg='Invalid credentials.')
+            return SUCCESS.format(f'<key>{device.api_key}</key>')
+        if params.get('key') != device.api_key:
+            return ERROR.format(code=403, msg='Invalid credentials.')
+        if request_type == 'op':
+            return self.handle_op(device, params.get('cmd', ''))
+        if request_type == 'commit':
+            device.last_commit += 1
+            return SUCCESS.format(
+                f'<msg><line>Commit job enqueued with jobid {device.last_commit}</line></msg>'
+                f'<job>{device.last_commit}</job>')
+        if request_type == 'config':
+            return self.handle_config(device, params)
+        if request_type == 'log':
+            return self.handle_log(device, params)
+        return SUCCESS.format('')
+
+    def handle_op(self, device, cmd):
+        command = command_name(cmd)
+        if command == 'show high-availability state':
+            if device.ha_state is None:
+                return SUCCESS.format('<enabled>no</enabled>')
+            return SUCCESS.format(
+                f'<enabled>yes</enabled><group><local-info><state>{device.ha_state}</state>'
+                f'</local-info><peer-info><state>{device.peer.ha_state}</state>'
+                f'<mgmt-ip>{device.peer.address}</mgmt-ip></peer-info></group>')
+        if command.startswith('show global-protect-satellite current-gateway'):
+            gateways = device.gateways
+            if command == 'show global-protect-satellite current-gateway gateway':
+                gateways = [et.fromstring(cmd).findtext('.//gateway')]
+            entries = ''.join(
+                f'<entry><satellite>{SATELLITE_NAME}</satellite><gateway-address>{gw}</gateway-address>'
+                f'<tunnel-monitor>Tunnel monitoring '
+                f'{"down" if random.random() < self.satellite_failure_rate else "up"}</tunnel-monitor>'
+                f'<uptime>3600</uptime></entry>' for gw in gateways)
+            return SUCCESS.format(entries)
+        if command.startswith('test global-protect-satellite gateway-reconnect'):
+            return SUCCESS.format('Gateway reconnect initiated')
+        if command == 'show system info':
+            return SUCCESS.format(
+                f'<system><hostname>sim-{device.index}</hostname><ip-address>{device.address}</ip-address>'
+                f'<model>PA-VM</model><serial>0000{device.index:08d}</serial>'
+                f'<sw-version>10.2.0</sw-version><app-version>8700-8000</app-version>'
+                f'<multi-vsys>off</multi-vsys></system>')
+        if command.startswith('show jobs'):
+            job_id = device.last_commit
+            if command == 'show jobs id':
+                job_id = int(et.fromstring(cmd).findtext('.//id') or job_id)
+            return SUCCESS.format(
+                f'<job><id>{job_id}</id><type>Commit</type><user>{SIM_USERNAME}</user>'
+                f'<tenq>2024/01/01 00:00:00</tenq><tfin>2024/01/01 00:00:01</tfin>'
+                f'<status>FIN</status><result>OK</result>'
+                f'<progress>100</progress><details><line>Configuration committed successfully</line>'
+                f'</details><warnings/></job>')
+        return SUCCESS.format('')
+
+    def handle_config(self, device, params):
+        action = params.get('action')
+        xpath = params.get('xpath', '')
+        if action in ('get', 'show'):
+            if '/rulebase/' not in xpath:
+                return SUCCESS.format('')
+            entries = ''.join(f'<entry name={quoteattr(name)}><action>allow</action></entry>'
+                              for name in device.rules)
+            return SUCCESS.format(f'<rules>{entries}</rules>')
+        if action == 'move':
+            device.move(entry_name(xpath), params.get('where'), params.get('dst'))
+            device.log_change(xpath)
+            return SUCCESS.format('')
+        if action == 'multi-config':
+            for move in et.fromstring(params['element']).iter('move'):
+                device.move(entry_name(move.get('xpath')), move.get('where'), move.get('dst'))
+                device.log_change(move.get('xpath'))
+            return SUCCESS.format('')
+        return SUCCESS.format('')
+
+    def handle_log(self, device, params):
+        if params.get('action') == 'get':
+            entries = device.log_jobs.pop(int(params.get('job-id', 0)), [])
+            logs = ''.join(f'<entry logid="{seqno}"><seqno>{seqno}</seqno><cmd>move</cmd>'
+                           f'<admin>{SIM_USERNAME}</admin><path>{escape(path)}</path></entry>'
+                           for seqno, path in entries)
+            return SUCCESS.format(
+                f'<job><status>FIN</status></job>'
+                f'<log><logs count="{len(entries)}" progress="100">{logs}</logs></log>')
+        if params.get('log-type') != 'config':
+            return ERROR.format(code=12, msg='Only config log queries are simulated')
+        job_id = device.query_log(int(params.get('nlogs', 20)), params.get('query'),
+                                  params.get('dir', 'backward'))
+        return SUCCESS.format(
+            f'<msg><line>query job enqueued with jobid {job_id}</line></msg><job>{job_id}</job>')
+
+
+def entry_name(xpath):
+    """Returns the name of the entry[@name='...'] an xpath ends with."""
+    # Quoted with ' or " (see panfw.reorder.entry_xpath)
+    return xpath.rsplit("[@name=", 1)[1][1:-2]
+
+
+def add_fleet_arguments(parser):
+    """Adds the simulator options to an argparse parser (also used by the benchmark)."""
+    parser.add_argument('--devices', type=int, default=100, help='Virtual firewalls (default 100)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port of every device')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Mean response time in milliseconds (default 20)')
+    parser.add_argument('--jitter', type=float, default=0.25,
+                        help='Random +/- share of the latency (default 0.25)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests answered with an API error')
+    parser.add_argument('--satellite-failure-rate', type=float, default=0.0,
+                        help='Share of satellite tunnels reported down')
+    parser.add_argument('--ha-fraction', type=float, default=0.0,
+                        help='Share of the devices in HA pairs')
+    parser.add_argument('--slow-fraction', type=float, default=0.0,
+                        help='Share of the devices answering --slow-factor times slower')
+    parser.add_argument('--slow-factor', type=float, default=10.0)
+    parser.add_argument('--gateways', type=int, default=1, help='GP gateways per satellite')
+    parser.add_argument('--rules', type=int, default=0, help='Rules in every rulebase')
+    parser.add_argument('--sim-workers', type=int, default=2,
+                        help='Simulator worker processes (default 2)')
+    parser.add_argument('--cert', help='TLS certificate of the devices (default: self-signed)')
+    parser.add_argument('--key', help='TLS key of the devices')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def simulator_from_args(args):
+    return Simulator(devices=args.devices, port=args.port, latency=args.latency / 1000.0,
+                     jitter=args.jitter, error_rate=args.error_rate,
+                     satellite_failure_rate=args.satellite_failure_rate,
+                     ha_fraction=args.ha_fraction, slow_fraction=args.slow_fraction,
+                     slow_factor=args.slow_factor, gateways=args.gateways, rules=args.rules,
+                     workers=args.sim_workers, cert_file=args.cert, key_file=args.key,
+                     seed=args.seed)
+
+
+def main(argv=None):
+    """python3 -m panfw simulate: serves a virtual fleet until Ctrl+C."""
+    parser = argparse.ArgumentParser(prog='python3 -m panfw simulate',
+                                     description='Offline PAN-OS XML API simulator')
+    add_fleet_arguments(parser)
+    parser.add_argument('--write-config', metavar='FILE',
+                        help='Write a config.yml for the simulated fleet to FILE')
+    parser.add_argument('--no-api-keys', action='store_true',
+                        help='Leave the API keys out of the written config (tests keygen)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    sim = simulator_from_args(args)
+    if args.write_config:
+        import yaml
+        cfg = {'log_path': './logs', 'non_interactive': True, 'parallel_init': True,
+               'firewalls': sim.firewalls(api_keys=not args.no_api_keys)}
+        if args.no_api_keys:
+            cfg['credentials_file'] = os.path.splitext(args.write_config)[0] + '-credentials.yml'
+            with open(cfg['credentials_file'], 'w') as cred_file:
+                yaml.safe_dump({'default': {'username': SIM_USERNAME, 'password': SIM_PASSWORD}},
+                               cred_file)
+        with open(args.write_config, 'w') as cfg_file:
+            yaml.safe_dump(cfg, cfg_file, default_flow_style=False)
+        print(f'Config for the simulated fleet written to {args.write_config}')
+    try:
+        sim.start()
+    except (ValueError, OSError) as e:
+        print(f'Could not start the simulator: {e}')
+        return 1
+    try:
+        while True:
+            time.sleep(10)
+            requests, errors = sim.stats()
+            app_log.info(f'{requests} requests answered, {errors} simulated errors')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+    return 0
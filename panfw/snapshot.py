@@ -0,0 +1,260 @@
+"""
+Module:       panfw/snapshot.py
+
+Description:
+On-disk snapshot of selected parts of a Panorama / firewall configuration
+(rulebase, address objects, GP gateway definitions, ...). Every refresh first
+asks the device for the config log entries newer than the last one it has
+seen; every change to the candidate config (set, edit, move, delete, ...) is
+logged there with the path it touched. Only the subtrees such a path falls
+into are downloaded again; a subtree whose content did not change keeps its
+digest and is not reported as changed, so consumers only reprocess what moved.
+
+The subtrees are read with config 'get', the candidate config, like the
+callers that fetch them without a snapshot: changes that are not committed
+yet (e.g. rule moves with commit: false) are in the snapshot as well.
+"""
+
+import os
+import re
+import json
+import time
+import shlex
+import hashlib
+import logging
+import threading
+from xml.etree import ElementTree as et
+
+from panfw.parsers import iter_entries
+from panfw.transport import PooledTransport, TransportError
+
+app_log = logging.getLogger('root')
+
+# Config log entries read per refresh, with more the log cannot tell what changed
+CONFIG_LOG_LIMIT = 5000
+
+# Seconds to wait for a config log query job
+LOG_JOB_TIMEOUT = 60
+
+# xpath steps that have no word in the path of a config log entry
+IGNORED_STEPS = ('config', 'devices', 'localhost.localdomain')
+
+XPATH_STEP = re.compile(r"""\[@name=(?:'([^']*)'|"([^"]*)")\]|([^/\[]+)""")
+
+
+def default_subtrees(device_group=None, vsys='vsys1', rulebase='pre-rulebase', rule_type='security'):
+    """Returns the subtrees snapshotted by default: the rulebase, address
+    objects and GlobalProtect gateway definitions.
+    """
+    from panfw.reorder import DEVICE_XPATH, entry_xpath, rulebase_xpath
+    if device_group == 'shared':
+        base = '/config/shared'
+    elif device_group:
+        base = f"{DEVICE_XPATH}/device-group/{entry_xpath(device_group)}"
+    else:
+        base = f"{DEVICE_XPATH}/vsys/{entry_xpath(vsys)}"
+    subtrees = {
+        'rulebase': rulebase_xpath(device_group, vsys, rulebase, rule_type),
+        'address': f'{base}/address',
+        'address-group': f'{base}/address-group',
+    }
+    if not device_group:
+        subtrees['gp-gateways'] = f'{base}/global-protect/global-protect-gateway'
+    return subtrees
+
+
+def _strip(words):
+    while words and words[0] in IGNORED_STEPS:
+        words = words[1:]
+    return words
+
+
+def xpath_words(xpath):
+    """Returns an xpath as the words of a config log path, e.g.
+    /config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/address
+    becomes ['vsys', 'vsys1', 'address'].
+    """
+    words = list()
+    for match in XPATH_STEP.finditer(xpath):
+        name = match.group(1) if match.group(1) is not None else match.group(2)
+        if name is not None:
+            words.append(name)
+        elif match.group(3) != 'entry':
+            words.append(match.group(3))
+    return _strip(words)
+
+
+def path_words(path):
+    """Returns the words of the path of a config log entry."""
+    try:
+        words = shlex.split(path or '')
+    except ValueError:
+        words = (path or '').split()
+    return _strip(words)
+
+
+def overlaps(path, xpath):
+    """True when a config change at path (config log) can touch the subtree
+    at xpath: one lies inside the other. An empty path matches everything.
+    """
+    changed = path_words(path)
+    subtree = xpath_words(xpath)
+    size = min(len(changed), len(subtree))
+    return changed[:size] == subtree[:size]
+
+
+class ConfigSnapshot(object):
+    """Locally cached config subtrees of one device, refreshed on change."""
+
+    def __init__(self, device, directory, subtrees, transport=None, max_age=None):
+        """
+        Arguments:
+            device {Firewall} -- Panorama or firewall the config is read from
+            directory {str} -- Snapshot directory, one sub directory per device
+            subtrees {dict} -- name: xpath of every subtree to keep
+
+        Keyword Arguments:
+            transport {PooledTransport} -- Transport for the API calls
+            max_age {float} -- Re-download a subtree after this many seconds
+                               even without a change (None: never)
+        """
+        self.device = device
+        self.subtrees = dict(subtrees)
+        self.transport = transport or PooledTransport(pool_size=1, timeout=300)
+        self.max_age = max_age
+        self.path = os.path.join(directory, device.hostname.replace(os.sep, '_'))
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.meta = self._load_meta()
+
+    def _meta_file(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def _subtree_file(self, name):
+        return os.path.join(self.path, f'{name}.xml')
+
+    def _load_meta(self):
+        try:
+            with open(self._meta_file(), 'r') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {'seqno': None, 'subtrees': {}}
+
+    def _write(self, path, data, mode='w'):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode) as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+
+    def config_log(self, nlogs, after=None):
+        """Reads config log entries with a log query job.
+
+        Arguments:
+            nlogs {int} -- Maximum number of entries
+
+        Keyword Arguments:
+            after {int} -- Oldest first starting after this seqno (default:
+                           the newest entries)
+
+        Returns:
+            list -- (seqno, path) of every entry
+        """
+        params = {'type': 'log', 'log-type': 'config', 'nlogs': str(nlogs)}
+        if after is not None:
+            params.update({'query': f'(seqno geq {after + 1})', 'dir': 'forward'})
+        job_id = et.fromstring(self.transport.api(self.device, params)).findtext('.//job')
+        if not job_id:
+            raise TransportError(f"{self.device.hostname}: no config log query job")
+        deadline = time.time() + LOG_JOB_TIMEOUT
+        while True:
+            data = self.transport.api(
+                self.device, {'type': 'log', 'action': 'get', 'job-id': job_id.strip()})
+            if et.fromstring(data).findtext('.//job/status') == 'FIN':
+                break
+            if time.time() > deadline:
+                raise TransportError(f"{self.device.hostname}: config log query job {job_id} "
+                                     f"did not finish within {LOG_JOB_TIMEOUT} seconds")
+            time.sleep(0.5)
+        entries = list()
+        for entry in iter_entries(data):
+            try:
+                entries.append((int(entry.get('seqno')), entry.get('path') or ''))
+            except (TypeError, ValueError):
+                continue
+        return entries
+
+    def config_version(self):
+        """Asks the device for its current config version (newest config log seqno)."""
+        entries = self.config_log(1)
+        return max(seqno for seqno, _ in entries) if entries else 0
+
+    def changes(self, seqno):
+        """Returns (newest seqno, paths changed after seqno), the paths are
+        None when the config log cannot tell (too many changes).
+        """
+        entries = self.config_log(CONFIG_LOG_LIMIT, after=seqno)
+        newest = max([seqno] + [number for number, _ in entries])
+        if len(entries) >= CONFIG_LOG_LIMIT:
+            return newest, None
+        return newest, [path for _, path in entries]
+
+    def _stale(self, name):
+        entry = self.meta['subtrees'].get(name)
+        if entry is None or entry.get('xpath') != self.subtrees[name]:
+            return True
+        if not os.path.exists(self._subtree_file(name)):
+            return True
+        return self.max_age is not None and time.time() - entry['fetched'] > self.max_age
+
+    def refresh(self, force=False):
+        """Brings the snapshot up to date.
+
+        Keyword Arguments:
+            force {bool} -- Download every subtree regardless of the config log
+
+        Returns:
+            list -- Names of the subtrees whose content changed
+        """
+        with self._lock:
+            start_time = time.time()
+            seqno = self.meta.get('seqno')
+            paths = None
+            try:
+                if seqno is None:
+                    seqno = self.config_version()
+                else:
+                    seqno, paths = self.changes(seqno)
+            except TransportError as e:
+                # Without the config log every subtree may have changed
+                app_log.warning(f"Config log of {self.device.hostname} not readable, "
+                                f"fetching all subtrees: {e}")
+                seqno = None
+            stale = [name for name in self.subtrees
+                     if force or paths is None or self._stale(name) or
+                     any(overlaps(path, self.subtrees[name]) for path in paths)]
+            changed = list()
+            for name in stale:
+                data = self.transport.api(self.device, {
+                    'type': 'config', 'action': 'get', 'xpath': self.subtrees[name]})
+                digest = hashlib.sha256(data).hexdigest()
+                entry = self.meta['subtrees'].get(name) or dict()
+                if entry.get('sha256') != digest or not os.path.exists(self._subtree_file(name)):
+                    self._write(self._subtree_file(name), data, 'wb')
+                    changed.append(name)
+                self.meta['subtrees'][name] = {
+                    'xpath': self.subtrees[name], 'sha256': digest, 'fetched': time.time()}
+            self.meta['seqno'] = seqno
+            self._write(self._meta_file(), json.dumps(self.meta))
+            app_log.info(
+                f"Config snapshot of {self.device.hostname} at config log seqno {seqno}: "
+                f"{len(stale)} subtrees fetched, {len(changed)} changed "
+                f"({time.time() - start_time:.2f} seconds)")
+            return changed
+
+    def get(self, name):
+        """Returns the stored XML of a subtree (bytes), None when not fetched yet."""
+        try:
+            with open(self._subtree_file(name), 'rb') as infile:
+                return infile.read()
+        except OSError:
+            return None
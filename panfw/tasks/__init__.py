@@ -0,0 +1,9 @@
+"""
+Package:      panfw/tasks
+
+Description:
+Built-in tasks of the core runtime (see panfw/core.py). Every module holds
+one Task subclass with the per-firewall logic of one of the scripts; own
+tasks can live in any importable module and are referenced in config.yml as
+'package.module:ClassName'.
+"""
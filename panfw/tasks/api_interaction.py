@@ -0,0 +1,44 @@
+"""
+Module:       panfw/tasks/api_interaction.py
+
+Description:
+Generic example of doing something via API on every firewall / HA pair.
+Copy this module to start a task of your own: set a new name, put the logic
+in run() and list the task in config.yml as 'your.module:YourTask'.
+"""
+
+import logging
+
+from panfw.core import Task
+
+app_log = logging.getLogger('root')
+
+
+class ApiInteractionTask(Task):
+    """This is a generic example of cycling through HA firewalls and doing something via API."""
+
+    name = 'api-interaction'
+
+    def run(self, fw):
+        """This is a generic example of doing something via API on one firewall / HA pair.
+
+        Arguments:
+            fw {Firewall} -- Firewall object as returned by Runtime.initialize()
+
+        Returns:
+            Boolean: Returns True on succesful completion.
+        """
+        fw_active = self.runtime.ha_cache.active(fw)
+
+        app_log.info(
+            f'Doing something -- UPDATE THIS MESSAGE OBVIOUSLY -- on Firewall {fw.hostname}')
+
+        # Execute your logic here.
+
+        # Write more logic here (Pending)
+        # --------
+        # Write some actual logic using the fw_active instance to execute stuff on the active FW.
+        # ##
+        app_log.info(
+            f'Process completed on firewall {fw_active.hostname}.')
+        return True
@@ -0,0 +1,135 @@
+"""
+Module:       panfw/tasks/rule_reorder.py
+
+Description:
+Brings the rules of a Panorama device group (or firewall vsys) rulebase into
+a wanted order with a minimal number of moves and a single commit (see
+panfw/reorder.py). The rulebase is configured under rule_reorder in
+config.yml, globally or per device. The moves are planned during the check
+and applied by the action planner (panfw/planner.py), only shown with
+dry_run.
+"""
+
+import logging
+
+from panfw.core import Task, get_config_param
+from panfw.transport import PooledTransport
+from panfw.planner import Action
+from panfw.reorder import RuleReorderEngine, rulebase_xpath
+from panfw.snapshot import ConfigSnapshot, default_subtrees
+
+app_log = logging.getLogger('root')
+
+
+def load_target_order(order_file):
+    """Reads the wanted rule order, one rule name per line.
+
+    Empty lines and lines starting with '#' are ignored.
+
+    Arguments:
+        order_file {str} -- Path of the target order file
+
+    Returns:
+        list -- Rule names in the wanted order
+    """
+    with open(order_file, 'r') as infile:
+        return [line.strip() for line in infile
+                if line.strip() and not line.strip().startswith('#')]
+
+
+class RuleReorderTask(Task):
+    """Reorders the configured rulebase on Panorama / firewalls."""
+
+    name = 'rule-reorder'
+
+    def __init__(self, runtime):
+        # The engine always talks through a pooled transport, a private one
+        # with a long timeout (commits) when pooled_transport is off
+        self.own_transport = None
+        if runtime.transport is None:
+            self.own_transport = PooledTransport(
+                pool_size=1, timeout=300, guard=runtime.device_guard)
+        super().__init__(runtime)
+
+    def setup(self):
+        # ConfigSnapshot per device, kept across daemon-mode cycles (see snapshot_dir)
+        self.config_snapshots = dict()
+
+    @property
+    def transport(self):
+        return self.runtime.transport or self.own_transport
+
+    def reorder_config(self, hostname):
+        """A rule_reorder block in the device entry overrides the global one."""
+        return get_config_param(self.runtime.firewall_config(hostname), 'rule_reorder') or \
+            get_config_param(self.runtime.cfgdict, 'rule_reorder')
+
+    def applies_to(self, hostname):
+        return super().applies_to(hostname) and bool(self.reorder_config(hostname))
+
+    def run(self, fw):
+        """Plans the reorder of the rulebase configured under rule_reorder on one
+        Panorama / firewall (or HA pair). The moves and the single commit are
+        run by the action planner.
+
+        Arguments:
+            fw {Firewall} -- Firewall object as returned by Runtime.initialize()
+
+        Returns:
+            int: Number of rule moves planned.
+        """
+        cfgdict = self.runtime.cfgdict
+        fw_active = self.runtime.ha_cache.active(fw)
+
+        reorder_cfg = self.reorder_config(fw.hostname)
+        if not reorder_cfg:
+            app_log.warning(f'No rule_reorder configuration for {fw.hostname}, skipping it')
+            return 0
+
+        location = dict(device_group=reorder_cfg.get('device_group'),
+                        vsys=reorder_cfg.get('vsys') or 'vsys1',
+                        rulebase=reorder_cfg.get('rulebase') or 'pre-rulebase',
+                        rule_type=reorder_cfg.get('rule_type') or 'security')
+        xpath = rulebase_xpath(**location)
+        target = load_target_order(reorder_cfg['target_order_file'])
+        app_log.info(
+            f'Reordering {len(target)} rules at {xpath} on {fw_active.hostname}')
+
+        snapshot = None
+        if get_config_param(cfgdict, 'snapshot_dir'):
+            if fw.hostname not in self.config_snapshots:
+                subtrees = default_subtrees(**location)
+                subtrees.update(get_config_param(cfgdict, 'snapshot_subtrees') or {})
+                self.config_snapshots[fw.hostname] = ConfigSnapshot(
+                    fw_active, cfgdict['snapshot_dir'], subtrees, transport=self.transport,
+                    max_age=get_config_param(cfgdict, 'snapshot_max_age'))
+            snapshot = self.config_snapshots[fw.hostname]
+            snapshot.device = fw_active
+
+        commit = reorder_cfg.get('commit', True)
+        engine = RuleReorderEngine(fw_active, xpath, transport=self.transport,
+                                   batch_size=reorder_cfg.get('batch_size') or 500,
+                                   snapshot=snapshot)
+        _, moves = engine.plan(target)
+        if not moves:
+            app_log.info(f'Rules on firewall {fw_active.hostname} are in order already.')
+            return 0
+
+        def reorder():
+            engine.apply(moves)
+            if commit:
+                app_log.info(f"Committing {len(moves)} rule moves on {fw_active.hostname}")
+                fw_active.commit(sync=True, exception=True)
+            app_log.info(
+                f'Process completed on firewall {fw_active.hostname}, {len(moves)} rules moved.')
+            return f"{len(moves)} moves{', committed' if commit else ''}"
+
+        # Only a commit needs the device lease across daemon nodes
+        self.runtime.planner.propose(Action(
+            'reorder', fw, self.name, reorder, detail=f'{len(moves)} rule moves at {xpath}',
+            lease=commit))
+        return len(moves)
+
+    def close(self):
+        if self.own_transport is not None:
+            self.own_transport.close()
@@ -0,0 +1,353 @@
+"""
+Module:       panfw/tasks/satellite_reset.py
+
+Description:
+Resets GP Satellite connections for LSVPN in case tunnel monitoring shows a
+failure. This was created for a specific use case of a customer where LSVPN
+tunnels would require a manual restart on firewalls in remote locations with
+no remote management connectivity without the VPN itself being up.
+
+Every check moves the (firewall, gateway) pair through the satellite state
+machine (panfw/satellite.py): the satellite connection is reset after
+reconnect_threshold failures and the firewall is restarted after
+restart_threshold failures. Both actions go through the action planner
+(panfw/planner.py), which batches them per cycle and honors dry_run.
+"""
+
+import time
+import logging
+
+from panfw.core import Task, get_config_param
+from panfw.logpipe import log_fields
+from panfw.metrics import command_name
+from panfw.executor import FirewallResult
+from panfw.planner import Action
+from panfw.transport import xml_op
+from panfw.parsers import parse_satellite_gateways, satellite_connected, group_by_gateway
+from panfw.satellite import SatelliteStateMachine, HEALTHY, ACTION_RECONNECT, ACTION_RESTART
+
+app_log = logging.getLogger('root')
+
+# Current gateways of the satellite, all gateways in one response
+SATELLITE_GATEWAYS_CMD = '<show><global-protect-satellite><current-gateway/></global-protect-satellite></show>'
+
+
+def get_gp_sattelite_status(fw_obj, gp_gateway, transport=None):
+    """Tests to see the status of GP Satellite gateway with provided IP
+
+    Arguments:
+        fw_obj {Firewall} -- Active firewall of the satellite
+        gp_gateway {str} -- IP address of GP Gateway as string
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+
+    Returns:
+        Boolean -- True when tunnel monitoring is up and nothing is initializing
+    """
+    try:
+        r = xml_op(fw_obj,
+                   f'<show><global-protect-satellite><current-gateway><gateway>{gp_gateway}</gateway></current-gateway></global-protect-satellite></show>', transport)
+        gateways = parse_satellite_gateways(r)
+        for gw in gateways:
+            app_log.debug(
+                f'{fw_obj.hostname}: gateway {gw.gateway} tunnel {gw.tunnel_state} '
+                f'monitor {gw.monitor_status} uptime {gw.uptime}')
+        return satellite_connected(gateways)
+
+    except BaseException as e:
+        app_log.error(f'Failed to run query on firewall - {fw_obj}')
+        app_log.exception(e)
+        raise
+
+
+def get_gp_sattelite_statuses(fw_obj, gp_gateways, transport=None):
+    """Tests the status of several GP Satellite gateways with one op command.
+
+    The current gateways of the satellite are fetched without a gateway filter
+    and the parsed records are fanned out to the configured gateways. When the
+    firewall answers in plain text the gateways are queried one by one.
+
+    Arguments:
+        fw_obj {Firewall} -- Active firewall of the satellite
+        gp_gateways {list} -- IP addresses of the GP Gateways
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+
+    Returns:
+        dict -- gateway address: True when the tunnel is up
+    """
+    if len(gp_gateways) == 1:
+        return {gp_gateways[0]: get_gp_sattelite_status(fw_obj, gp_gateways[0], transport)}
+    try:
+        r = xml_op(fw_obj, SATELLITE_GATEWAYS_CMD, transport)
+    except BaseException as e:
+        app_log.error(f'Failed to run query on firewall - {fw_obj}')
+        app_log.exception(e)
+        raise
+    return satellite_statuses_from_response(fw_obj, r, gp_gateways, transport)
+
+
+def satellite_statuses_from_response(fw_obj, r, gp_gateways, transport=None):
+    """Fans a 'show global-protect-satellite current-gateway' response out to
+    the configured gateways. When the firewall answered in plain text the
+    gateways are queried one by one.
+
+    Arguments:
+        fw_obj {Firewall} -- Active firewall of the satellite
+        r {bytes} -- Response of SATELLITE_GATEWAYS_CMD
+        gp_gateways {list} -- IP addresses of the GP Gateways
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+
+    Returns:
+        dict -- gateway address: True when the tunnel is up
+    """
+    grouped = group_by_gateway(parse_satellite_gateways(r))
+    if None in grouped:
+        return {gw: get_gp_sattelite_status(fw_obj, gw, transport) for gw in gp_gateways}
+    return {gw: satellite_connected(grouped.get(gw, [])) for gw in gp_gateways}
+
+
+def get_gp_gateways(fw_cfg):
+    """Returns the configured GP gateways of a firewall entry as a list
+    (gp_gateways list or gp_gateway string / list).
+    """
+    gp_gateways = get_config_param(fw_cfg, 'gp_gateways') or get_config_param(fw_cfg, 'gp_gateway')
+    if not gp_gateways:
+        return []
+    if isinstance(gp_gateways, str):
+        return [gp_gateways]
+    return list(gp_gateways)
+
+
+def reset_gp_sattelite_session(fw_obj, gp_gateway, gp_satellite_name, transport=None):
+    """[summary] Resets the GP Satellite connection
+    Arguments:
+        fw_obj {pan} -- [description]
+        gp_gateway {str} -- [description] IP address of GP Gateway as string
+        gp_satellite_name {str} -- [description] GP Satellite Name
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+    """
+    cmd_xml_str = f'<test><global-protect-satellite><gateway-reconnect><satellite>{gp_satellite_name}</satellite><gateway-address>{gp_gateway}</gateway-address><method>activation</method></gateway-reconnect></global-protect-satellite></test>'
+
+    try:
+        result = xml_op(fw_obj, cmd_xml_str, transport)
+    except BaseException:
+        raise
+    return result.decode('utf-8')
+
+
+class SatelliteResetTask(Task):
+    """Checks the GP Satellite connections of the firewalls with GP gateways."""
+
+    name = 'satellite-reset'
+    # A pushed satellite / tunnel monitor event checks the firewall right away
+    event_triggered = True
+
+    def setup(self):
+        # Failure counters per (firewall, gateway), kept between checks
+        self.states = SatelliteStateMachine.from_config(self.runtime.cfgdict, self.runtime.history)
+
+    def applies_to(self, hostname):
+        return super().applies_to(hostname) and \
+            bool(get_gp_gateways(self.runtime.firewall_config(hostname)))
+
+    def count_interval(self, hostname):
+        """Seconds between two failures of a firewall that both count (see
+        SatelliteStateMachine.observe): its polling interval (or the shorter
+        adaptive_fast_interval) less the scheduler jitter. Only daemon mode,
+        where pushed events trigger extra checks, has one.
+        """
+        cfgdict = self.runtime.cfgdict
+        if not cfgdict.get('daemon_mode'):
+            return None
+        interval = float(self.interval(hostname) or cfgdict.get('check_interval') or 30.0)
+        if cfgdict.get('adaptive_polling') and cfgdict.get('adaptive_fast_interval'):
+            interval = min(interval, float(cfgdict['adaptive_fast_interval']))
+        jitter = cfgdict.get('schedule_jitter')
+        # Two scheduled runs are at least interval * (1 - 2 * jitter) apart
+        return interval * max(0.0, 1 - 2 * (0.1 if jitter is None else jitter))
+
+    def healthy(self, res):
+        """Healthy when every gateway is up (a tunnel that is initializing or
+        down, or a failed check, puts the firewall back on the fast interval).
+        """
+        return bool(res.ok and isinstance(res.result, dict) and res.result and
+                    all(state == HEALTHY for state in res.result.values()))
+
+    def run(self, fw):
+        """Checks the GP Satellite connections of a single firewall / HA pair once
+        and plans the recovery action the satellite state machine calls for.
+
+        Arguments:
+            fw {Firewall} -- Firewall object as returned by Runtime.initialize()
+
+        Returns:
+            dict: State of the satellite connection per GP gateway after this check.
+        """
+        app_log.info(
+            f'Checking for GP Satellite connection status on Firewall {fw.hostname}')
+
+        gp_gateways = get_gp_gateways(self.runtime.firewall_config(fw.hostname))
+        transport = self.runtime.transport
+
+        # One op command for all gateways, runs on the cached active member and
+        # follows an HA failover on error
+        gpstatuses = self.runtime.ha_cache.call(
+            fw, lambda fw_active: get_gp_sattelite_statuses(fw_active, gp_gateways, transport))
+        return self.handle_statuses(fw, gpstatuses)
+
+    def handle_statuses(self, fw, gpstatuses):
+        """Feeds the result of one check into the satellite state machine and
+        proposes the recovery actions it calls for to the action planner.
+
+        Arguments:
+            fw {Firewall} -- Firewall object as returned by Runtime.initialize()
+            gpstatuses {dict} -- gateway address: True when the tunnel is up
+
+        Returns:
+            dict: State of the satellite connection per GP gateway after this check.
+        """
+        ha_cache = self.runtime.ha_cache
+        planner = self.runtime.planner
+        transport = self.runtime.transport
+        gp_satellite_name = get_config_param(
+            self.runtime.firewall_config(fw.hostname), 'gp_satellite_name')
+        if not all(gpstatuses.values()):
+            # A down tunnel may mean the cached member went passive, re-check HA
+            ha_cache.invalidate(fw)
+
+        def reconnect(gp_gateway):
+            ha_cache.call(fw, lambda fw_active: reset_gp_sattelite_session(
+                fw_active, gp_gateway, gp_satellite_name, transport))
+
+        def restart():
+            fw_active = ha_cache.active(fw)
+            fw_active.restart()
+            return fw_active.hostname
+
+        min_gap = self.count_interval(fw.hostname)
+        restart_needed = False
+        for gp_gateway, gpstatus in gpstatuses.items():
+            fields = log_fields(task=self.name, firewall=fw.hostname, gateway=gp_gateway,
+                                result='connected' if gpstatus else 'disconnected')
+            if gpstatus:
+                app_log.info(f'GP Gateway: {gp_gateway} seems to be connected', extra=fields)
+            else:
+                app_log.info(
+                    f'GP Gateway: {gp_gateway} does not seem to be connected.', extra=fields)
+            action = self.states.observe(fw.hostname, gp_gateway, gpstatus, min_gap=min_gap,
+                                         dry_run=planner.dry_run)
+            if action == ACTION_RECONNECT:
+                app_log.info(
+                    f'{self.states.reconnect_threshold} failures. Planning a reset of the GP Satellite connection to {gp_gateway}',
+                    extra=log_fields(task=self.name, firewall=fw.hostname, gateway=gp_gateway,
+                                     result=ACTION_RECONNECT))
+                planner.propose(Action(ACTION_RECONNECT, fw, self.name,
+                                       lambda gp_gateway=gp_gateway: reconnect(gp_gateway),
+                                       gateway=gp_gateway, detail=f'satellite {gp_satellite_name}'))
+            elif action == ACTION_RESTART:
+                restart_needed = True
+        if restart_needed:
+            app_log.info(
+                f'{self.states.restart_threshold} failures. Planning a restart of the firewall',
+                extra=log_fields(task=self.name, firewall=fw.hostname, result=ACTION_RESTART))
+            # The lease of a restart lasts the restart cooldown, no other node
+            # restarts the firewall again while it is booting
+            planner.propose(Action(ACTION_RESTART, fw, self.name, restart,
+                                   lease_ttl=self.states.restart_cooldown))
+        return {gp_gateway: self.states.state(fw.hostname, gp_gateway)['state']
+                for gp_gateway in gpstatuses}
+
+    async def sweep(self, fw_objs):
+        """asyncio sweep of the fleet: the current-gateway query is fanned out to
+        the active member of every firewall (fan_out_limit queries in flight,
+        per_device_limit per firewall, op_timeout seconds each) and every answer is
+        handled as soon as it arrives, so a slow or unreachable branch does not
+        hold back the recovery of the others.
+
+        Arguments:
+            fw_objs {list} -- Firewall objects as returned by Runtime.initialize()
+
+        Returns:
+            list: FirewallResult (hostname, ok, result, elapsed, error) per firewall.
+        """
+        import asyncio
+        from panfw.aio import fan_out
+
+        cfgdict = self.runtime.cfgdict
+        ha_cache = self.runtime.ha_cache
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        # HA discovery blocks, resolve the active members off the event loop.
+        # A pair that cannot be discovered fails alone, like in threads mode
+        fw_actives = await asyncio.gather(
+            *[loop.run_in_executor(None, ha_cache.active, fw) for fw in fw_objs],
+            return_exceptions=True)
+        results = list()
+        active = dict()
+        for fw, fw_active in zip(fw_objs, fw_actives):
+            if isinstance(fw_active, Exception):
+                app_log.error(f'Could not find the active member of {fw.hostname}: {fw_active!r}',
+                              extra=log_fields(task=self.name, firewall=fw.hostname,
+                                               error=repr(fw_active)))
+                results.append(FirewallResult(fw.hostname, False, None,
+                                              time.time() - start_time, repr(fw_active)))
+                continue
+            active[fw_active.hostname] = fw
+        op_results = fan_out(SATELLITE_GATEWAYS_CMD,
+                             [fw_active for fw_active in fw_actives
+                              if not isinstance(fw_active, Exception)],
+                             limit=get_config_param(cfgdict, 'fan_out_limit') or 64,
+                             per_device_limit=get_config_param(cfgdict, 'per_device_limit') or 1,
+                             timeout=get_config_param(cfgdict, 'op_timeout') or 30,
+                             transport=self.runtime.transport)
+        # Closed at once also when the sweep is cancelled or fails
+        try:
+            async for op_result in op_results:
+                fw = active[op_result.fw.hostname]
+                if not op_result.ok:
+                    app_log.error(f'Failed to run query on firewall {fw.hostname}: {op_result.error}',
+                                  extra=log_fields(task=self.name, firewall=fw.hostname,
+                                                   command=command_name(op_result.cmd),
+                                                   latency=round(op_result.elapsed, 3),
+                                                   error=op_result.error))
+                    ha_cache.invalidate(fw)
+                    results.append(FirewallResult(
+                        fw.hostname, False, None, op_result.elapsed, op_result.error))
+                    continue
+                gp_gateways = get_gp_gateways(self.runtime.firewall_config(fw.hostname))
+                try:
+                    # Parsing and recovery actions block, keep them off the event loop
+                    states = await loop.run_in_executor(None, lambda: self.handle_statuses(
+                        fw, satellite_statuses_from_response(
+                            op_result.fw, op_result.response, gp_gateways, self.runtime.transport)))
+                except Exception as e:
+                    app_log.exception(e)
+                    results.append(FirewallResult(
+                        fw.hostname, False, None, op_result.elapsed, repr(e)))
+                    continue
+                results.append(FirewallResult(fw.hostname, True, states, op_result.elapsed, None))
+        finally:
+            await op_results.aclose()
+        return results
+
+    def run_all(self, fw_objs):
+        """Every firewall is checked on its own worker (see execution_mode in
+        config.yml) so a flapping satellite does not stall the firewalls after
+        it; in asyncio mode the fleet is swept with one fanned out query.
+        """
+        if self.runtime.executor.mode == 'asyncio':
+            # asyncio is only imported when this mode is used
+            import asyncio
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(self.sweep(fw_objs))
+            finally:
+                loop.close()
+        return super().run_all(fw_objs)
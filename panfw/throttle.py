@@ -0,0 +1,302 @@
+"""
+Module:       panfw/throttle.py
+
+Description:
+Protection of the firewall management planes. Every API call to a device
+first takes a token from the device's token bucket (a steady request rate
+with short bursts) and passes its circuit breaker. After failure_threshold
+connection failures in a row the breaker opens and calls fail right away
+with CircuitOpenError instead of waiting for a timeout; after reset_timeout
+seconds a single probe call is let through (half-open). A successful probe
+closes the breaker, a failed one opens it again for twice as long, up to
+max_reset_timeout. A sweep over a fleet with unreachable devices thus stays
+short, and an overloaded device is not hammered.
+"""
+
+import time
+import logging
+import threading
+
+app_log = logging.getLogger('root')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# pan-os-python exceptions for an unreachable management plane, by name so
+# this module does not depend on pan-os-python
+CONNECTION_ERRORS = ('PanURLError', 'PanConnectionTimeout', 'PanOutdatedSslError',
+                     'PanSessionTimedOut')
+
+# PanXapi methods that send a request to the device
+XAPI_METHODS = ('op', 'show', 'get', 'set', 'edit', 'delete', 'move', 'rename', 'clone',
+                'override', 'commit', 'keygen', 'user_id', 'log', 'report', 'export', 'ad_hoc')
+
+
+class ThrottleError(Exception):
+    """Base class of the errors raised instead of calling a device."""
+
+
+class CircuitOpenError(ThrottleError):
+    """The circuit breaker of the device is open."""
+
+
+class RateLimitError(ThrottleError):
+    """No token became available within max_wait seconds."""
+
+
+def is_connection_error(e):
+    """True when an exception means the device did not answer (properly)."""
+    # Imported here, http.client pulls in ssl (loaded by then anyway)
+    import http.client
+    if isinstance(e, (OSError, http.client.HTTPException)):
+        return True
+    return any(cls.__name__ in CONNECTION_ERRORS for cls in type(e).__mro__)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second, holding up to burst tokens."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before using it."""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def cancel(self):
+        """Returns a reserved token that will not be used."""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class CircuitBreaker(object):
+    """Closed / open / half-open breaker with exponential backoff."""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30, max_reset_timeout=600,
+                 clock=time.monotonic):
+        """
+        Arguments:
+            name {str} -- Device the breaker protects, for the log
+
+        Keyword Arguments:
+            failure_threshold {int} -- Consecutive failures that open the breaker
+            reset_timeout {float} -- Seconds the breaker stays open the first time
+            max_reset_timeout {float} -- Upper bound of the doubled open time
+        """
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.open_timeout = reset_timeout
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True when a call may go to the device now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.clock() - self.opened_at >= self.open_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+                app_log.info(f"Circuit of {self.name} half-open, sending a probe")
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self):
+        """Seconds until the next probe is let through."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.open_timeout - self.clock())
+
+    def release_probe(self):
+        """Hands back the probe slot of a half-open breaker when nothing was sent."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                app_log.info(f"Circuit of {self.name} closed, the device answers again")
+            self.state = CLOSED
+            self.failures = 0
+            self.open_timeout = self.reset_timeout
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # Failed probe, stay away twice as long
+                self.open_timeout = min(self.open_timeout * 2, self.max_reset_timeout)
+            elif self.state == CLOSED and self.failures < self.failure_threshold:
+                return
+            elif self.state == OPEN:
+                return
+            self.state = OPEN
+            self.opened_at = self.clock()
+            self._probing = False
+            app_log.warning(
+                f"Circuit of {self.name} opened after {self.failures} failures, "
+                f"next attempt in {self.open_timeout:.0f} seconds")
+
+
+class DeviceGuard(object):
+    """Token bucket and circuit breaker per device."""
+
+    def __init__(self, rate=5, burst=10, max_wait=10, failure_threshold=3,
+                 reset_timeout=30, max_reset_timeout=600):
+        """
+        Keyword Arguments:
+            rate {float} -- API calls per second per device
+            burst {int} -- Calls a device may get at once after being idle
+            max_wait {float} -- Longest wait for a token before RateLimitError
+            failure_threshold {int} -- Connection failures in a row that open the breaker
+            reset_timeout {float} -- Seconds before the first probe of an open breaker
+            max_reset_timeout {float} -- Upper bound of the doubled open time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._buckets = dict()
+        self._breakers = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfgdict):
+        """Build the guard from the rate_limit_* / circuit_* keys of config.yml.
+
+        Returns:
+            DeviceGuard -- or None unless device_guard is set to true
+        """
+        if not cfgdict.get('device_guard'):
+            return None
+        return cls(rate=cfgdict.get('rate_limit') or 5,
+                   burst=cfgdict.get('rate_limit_burst') or 10,
+                   max_wait=cfgdict.get('rate_limit_max_wait') or 10,
+                   failure_threshold=cfgdict.get('circuit_failure_threshold') or 3,
+                   reset_timeout=cfgdict.get('circuit_reset_timeout') or 30,
+                   max_reset_timeout=cfgdict.get('circuit_max_reset_timeout') or 600)
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def breaker(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(
+                    host, self.failure_threshold, self.reset_timeout, self.max_reset_timeout)
+            return self._breakers[host]
+
+    def state(self, host):
+        """Breaker state of a device: closed, open or half-open."""
+        return self.breaker(host).state
+
+    def call(self, host, func, *args, is_failure=is_connection_error, **kwargs):
+        """Runs func(*args, **kwargs) as an API call to host.
+
+        Arguments:
+            host {str} -- Device the call goes to
+            func {callable} -- The call
+
+        Keyword Arguments:
+            is_failure {callable} -- Decides which exceptions count against the
+                                     breaker (API errors of a device that
+                                     answered do not)
+
+        Returns:
+            The return value of func
+        """
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(
+                f"{host} is not reachable, circuit open for another {breaker.retry_in():.0f} seconds")
+        bucket = self.bucket(host)
+        delay = bucket.reserve()
+        if delay > self.max_wait:
+            bucket.cancel()
+            breaker.release_probe()
+            raise RateLimitError(f"{host} rate limit of {self.rate}/s exceeded")
+        if delay:
+            time.sleep(delay)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+    def wrap(self, host, func, **call_kwargs):
+        """Returns func guarded as calls to host."""
+        def guarded(*args, **kwargs):
+            return self.call(host, func, *args, **call_kwargs, **kwargs)
+        guarded.__wrapped__ = func
+        return guarded
+
+    def install(self, fw):
+        """Guards every API call of a pan-os-python Firewall and its HA peer.
+
+        The API methods of the device's PanXapi object are wrapped as soon as
+        pan-os-python creates it (again after an API key change).
+        """
+        for member in (fw, getattr(fw, 'ha_peer', None)):
+            if member is None or '_panfw_guarded' in vars(member):
+                continue
+            generate_xapi = getattr(member, 'generate_xapi', None)
+            if generate_xapi is None:
+                # Not a pan-os-python device
+                continue
+
+            def guarded_xapi(member=member, generate_xapi=generate_xapi):
+                xapi = generate_xapi()
+                for name in XAPI_METHODS:
+                    method = getattr(xapi, name, None)
+                    if method is not None:
+                        setattr(xapi, name, self.wrap(member.hostname, method))
+                return xapi
+
+            member.generate_xapi = guarded_xapi
+            member._panfw_guarded = True
+            # Drop an API object created before the guard was installed
+            member._xapi_private = None
+        return fw
+
+
+def guard_firewalls(fw_objs, guard):
+    """Installs guard on every firewall of fw_objs (no-op when guard is None)."""
+    if guard is not None:
+        for fw in fw_objs:
+            guard.install(fw)
+    return fw_objs
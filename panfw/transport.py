@@ -0,0 +1,286 @@
+"""
+Module:       panfw/transport.py
+
+Description:
+Opt-in HTTPS transport for PAN-OS XML API calls. pan-os-python opens a new
+connection (and TLS handshake) for every request; on WAN connected branch
+firewalls that handshake dominates the latency of short op commands. The
+PooledTransport keeps a small pool of keep-alive connections per firewall
+(HA peers get their own pool), closes connections that were idle for too long
+and resumes TLS sessions when a connection has to be re-established.
+
+xml_op() is used by every task, ssl and http.client are only imported once a
+PooledTransport is built (pan-os-python loads them with the first firewall).
+"""
+
+import socket
+import time
+import logging
+import threading
+import functools
+from collections import deque
+from urllib.parse import urlencode
+from xml.etree import ElementTree as et
+
+from panfw.metrics import metrics, command_name
+from panfw.throttle import is_connection_error
+
+app_log = logging.getLogger('root')
+
+
+class TransportError(Exception):
+    """Raised when the XML API returns an error or an unexpected HTTP status."""
+
+
+@functools.lru_cache(maxsize=None)
+def resuming_connection_class():
+    """Returns ResumingHTTPSConnection, defined on first use so http.client
+    (and ssl) are not imported with this module.
+    """
+    import http.client
+
+    class ResumingHTTPSConnection(http.client.HTTPSConnection):
+        """HTTPSConnection that offers a previous TLS session when connecting."""
+
+        def __init__(self, *args, tls_session=None, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.tls_session = tls_session
+
+        def connect(self):
+            http.client.HTTPConnection.connect(self)
+            # Small request bodies, do not let Nagle hold them back on a kept-alive socket
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=self.host, session=self.tls_session)
+
+        @property
+        def session_reused(self):
+            return self.sock is not None and self.sock.session_reused
+
+    return ResumingHTTPSConnection
+
+
+class HostPool(object):
+    """Keep-alive connections to a single management interface."""
+
+    def __init__(self, host, port, context, pool_size, idle_timeout, timeout, tls_resumption):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.tls_resumption = tls_resumption
+        self.tls_session = None
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def acquire(self):
+        """Returns an idle connection or a new one, waiting for a free slot."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TransportError(f"No free connection to {self.host} within {self.timeout} seconds")
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return resuming_connection_class()(
+            self.host, self.port, timeout=self.timeout, context=self.context,
+            tls_session=self.tls_session if self.tls_resumption else None)
+
+    def release(self, conn, reusable=True):
+        """Returns a connection to the pool (or closes it)."""
+        if reusable and conn.sock is not None:
+            if self.tls_resumption:
+                # Read after a response so TLS 1.3 session tickets are included
+                self.tls_session = conn.sock.session
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class PooledTransport(object):
+    """Persistent HTTPS sessions for XML API requests, one pool per firewall."""
+
+    def __init__(self, pool_size=2, idle_timeout=60, timeout=5, tls_resumption=True, verify_tls=False,
+                 guard=None):
+        """
+        Arguments:
+            pool_size {int} -- Maximum open connections per firewall
+            idle_timeout {float} -- Seconds after which an unused connection is closed
+            timeout {float} -- Socket timeout of a single request
+            tls_resumption {bool} -- Resume TLS sessions on reconnect
+            verify_tls {bool} -- Verify the management certificate. pan-os-python
+                                 does not verify by default, neither do we.
+            guard {DeviceGuard} -- Rate limiter / circuit breaker every request
+                                   goes through (optional)
+        """
+        self.pool_size = max(1, int(pool_size))
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.tls_resumption = tls_resumption
+        self.guard = guard
+        import ssl
+        if verify_tls:
+            self.context = ssl.create_default_context()
+        else:
+            self.context = ssl._create_unverified_context()
+        self._pools = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfgdict, guard=None):
+        """Returns a PooledTransport when pooled_transport is enabled in config.yml, else None."""
+        if not cfgdict.get('pooled_transport'):
+            return None
+        return cls(pool_size=cfgdict.get('transport_pool_size') or 2,
+                   idle_timeout=cfgdict.get('transport_idle_timeout') or 60,
+                   timeout=cfgdict.get('transport_timeout') or 5,
+                   tls_resumption=cfgdict.get('transport_tls_resumption', True),
+                   verify_tls=cfgdict.get('transport_verify_tls', False),
+                   guard=guard)
+
+    def _pool(self, host, port):
+        key = (host, port)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = HostPool(host, port, self.context, self.pool_size,
+                                            self.idle_timeout, self.timeout, self.tls_resumption)
+            return self._pools[key]
+
+    def request(self, host, params, port=None):
+        """POSTs params to https://host/api/ and returns the raw response body.
+
+        A keep-alive connection closed by the firewall in the meantime is
+        retried once on a fresh connection.
+
+        Arguments:
+            host {str} -- Management address of the firewall
+            params {dict} -- XML API query parameters (type, cmd, key, ...)
+
+        Returns:
+            bytes -- The XML response
+        """
+        if self.guard is not None:
+            # Only connection failures and timeouts count against the
+            # breaker, not an HTTP error status of a device that answered
+            return self.guard.call(host, self._request, host, params, port,
+                                   is_failure=is_connection_error)
+        return self._request(host, params, port)
+
+    def _request(self, host, params, port):
+        import ssl
+        import http.client
+        pool = self._pool(host, port or 443)
+        body = urlencode(params)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        for attempt in (1, 2):
+            conn = pool.acquire()
+            reused = conn.sock is not None
+            try:
+                conn.request('POST', '/api/', body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError, ssl.SSLEOFError):
+                pool.release(conn, reusable=False)
+                if reused and attempt == 1:
+                    continue
+                raise
+            except BaseException:
+                pool.release(conn, reusable=False)
+                raise
+            pool.release(conn, reusable=not response.will_close)
+            if response.status != 200:
+                raise TransportError(f"HTTP {response.status} {response.reason} from {host}")
+            return data
+
+    def api(self, fw_obj, params):
+        """Runs any XML API request on fw_obj and checks the response status.
+
+        Arguments:
+            fw_obj {Firewall} -- Target firewall (hostname, port and api_key are used)
+            params {dict} -- Query parameters without the key (type, action, cmd, ...)
+
+        Returns:
+            bytes -- The XML response
+        """
+        command = request_name(params)
+        params = dict(params, key=fw_obj.api_key)
+        start_time = time.time()
+        try:
+            data = self.request(fw_obj.hostname, params, port=getattr(fw_obj, 'port', None))
+            root = et.fromstring(data)
+            if root.get('status') == 'error':
+                msg = ' '.join(text.strip() for text in root.itertext() if text.strip())
+                raise TransportError(f"{fw_obj.hostname}: {msg or 'API error'}")
+        except Exception as e:
+            metrics.inc('panfw_op_errors_total', command=command, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('panfw_op_duration_seconds', time.time() - start_time, command=command)
+        return data
+
+    def op(self, fw_obj, cmd):
+        """Runs an XML op command, same result as fw_obj.op(cmd, cmd_xml=False, xml=True).
+
+        Arguments:
+            fw_obj {Firewall} -- Target firewall
+            cmd {str} -- Op command as XML
+
+        Returns:
+            bytes -- The XML response
+        """
+        return self.api(fw_obj, {'type': 'op', 'cmd': cmd})
+
+    def close(self):
+        """Closes every pooled connection."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+def xml_op(fw_obj, cmd, transport=None):
+    """Runs an XML op command through the pooled transport when one is
+    configured, otherwise through pan-os-python.
+
+    Arguments:
+        fw_obj {Firewall} -- Target firewall
+        cmd {str} -- Op command as XML
+
+    Keyword Arguments:
+        transport {PooledTransport} -- Optional pooled transport
+
+    Returns:
+        bytes -- The XML response
+    """
+    if transport is not None:
+        return transport.op(fw_obj, cmd)
+    command = command_name(cmd)
+    start_time = time.time()
+    try:
+        return fw_obj.op(cmd, cmd_xml=False, xml=True)
+    except Exception as e:
+        metrics.inc('panfw_op_errors_total', command=command, type=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('panfw_op_duration_seconds', time.time() - start_time, command=command)
+
+
+def request_name(params):
+    """Metrics label of an XML API request: the op command (see
+    panfw.metrics.command_name) or its type and action, e.g. 'config get'.
+    """
+    if params.get('type') == 'op' and params.get('cmd'):
+        return command_name(params['cmd'])
+    return ' '.join(str(params[key]) for key in ('type', 'action') if params.get(key))
@@ -0,0 +1,71 @@
+"""
+Module:       tests/test_aio.py
+
+Description:
+fan_out() with a fake op call: a command waiting for its busy firewall does
+not hold a fleet slot, and closing the generator cancels what has not
+started yet.
+"""
+
+import time
+import asyncio
+import threading
+
+import panfw.aio
+from panfw.aio import fan_out
+
+
+class FakeFirewall(object):
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+def fake_op(calls):
+    lock = threading.Lock()
+
+    def xml_op(fw, cmd, transport=None):
+        with lock:
+            calls.append((fw.hostname, cmd, time.time()))
+        time.sleep(0.2)
+        return cmd
+    return xml_op
+
+
+def collect(results):
+    async def consume():
+        return [result async for result in results]
+    return asyncio.new_event_loop().run_until_complete(consume())
+
+
+def test_device_slot_before_fleet_slot(monkeypatch):
+    calls = list()
+    monkeypatch.setattr(panfw.aio, 'xml_op', fake_op(calls))
+    fws = [FakeFirewall('busy'), FakeFirewall('busy'), FakeFirewall('other')]
+    results = collect(fan_out(['<a/>'], fws, limit=2, per_device_limit=1))
+    assert all(result.ok for result in results)
+    first = min(start for _, _, start in calls)
+    other = [start for hostname, _, start in calls if hostname == 'other']
+    # The other firewall does not wait behind the second command of the busy one
+    assert other[0] - first < 0.1
+
+
+def test_aclose_cancels_what_has_not_started(monkeypatch):
+    calls = list()
+    monkeypatch.setattr(panfw.aio, 'xml_op', fake_op(calls))
+    fws = [FakeFirewall(f'fw{i}') for i in range(6)]
+
+    async def first():
+        results = fan_out(['<a/>'], fws, limit=2)
+        try:
+            async for result in results:
+                return result
+        finally:
+            await results.aclose()
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(first()).ok
+    loop.run_until_complete(asyncio.sleep(0.5))
+    loop.close()
+    # The first two calls and at most the two that took over their slots
+    assert len(calls) <= 4
@@ -0,0 +1,23 @@
+"""
+Module:       tests/test_cli.py
+
+Description:
+Command line of python3 -m panfw: compile-config takes the first argument
+that is not a flag as the path of config.yml.
+"""
+
+import os
+
+import yaml
+
+from panfw.cli import main
+from panfw.config import cache_path
+
+
+def test_compile_config_skips_flags(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('fleet.yml', 'w') as cfg_file:
+        yaml.safe_dump({'firewalls': {'10.0.0.1': {'api_key': 'key'}}}, cfg_file)
+    assert main(['compile-config', '-debug', 'fleet.yml']) == 0
+    assert os.path.exists(cache_path('fleet.yml'))
+    assert not os.path.exists(cache_path('-debug'))
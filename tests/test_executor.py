@@ -0,0 +1,56 @@
+"""
+Module:       tests/test_executor.py
+
+Description:
+Per-firewall timeouts of the fleet executor: a firewall's clock starts when
+a worker picks it up, so more firewalls than workers are not reported as
+timed out while they wait for a worker, and a hung firewall still is.
+"""
+
+import time
+
+import pytest
+
+from panfw.executor import FleetExecutor
+
+
+class FakeFirewall(object):
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+def sleeper(seconds):
+    def func(fw):
+        time.sleep(seconds.get(fw.hostname, 0.2))
+        return fw.hostname
+    return func
+
+
+@pytest.mark.parametrize('mode', ['threads', 'asyncio'])
+def test_queued_firewalls_do_not_time_out(mode):
+    fw_objs = [FakeFirewall(f'fw{i}') for i in range(6)]
+    executor = FleetExecutor(mode=mode, max_workers=2, timeout=0.3)
+    try:
+        results = executor.run(fw_objs, sleeper({}))
+    finally:
+        executor.shutdown()
+    assert [res.error for res in results] == [None] * 6
+    assert [res.result for res in results] == [fw.hostname for fw in fw_objs]
+
+
+@pytest.mark.parametrize('mode', ['threads', 'asyncio'])
+def test_hung_firewalls_time_out_and_hold_their_worker(mode):
+    fw_objs = [FakeFirewall(f'fw{i}') for i in range(4)]
+    func = sleeper({'fw0': 1.5, 'fw1': 1.5})
+    executor = FleetExecutor(mode=mode, max_workers=2, timeout=0.3)
+    try:
+        results = executor.run(fw_objs, func)
+        assert [res.error for res in results] == [
+            'timed out', 'timed out',
+            'timed out waiting for a free worker', 'timed out waiting for a free worker']
+        # Only the hung firewalls are still busy on the next sweep
+        assert [res.error for res in executor.run(fw_objs, func)][:2] == \
+            ['busy with previous cycle'] * 2
+    finally:
+        executor.shutdown()
@@ -0,0 +1,157 @@
+"""
+Module:       tests/test_planner.py
+
+Description:
+Action planner: deduplication across the members of an HA pair, restarts
+replacing reconnects, rollout waves by site, dry run, the failure limit,
+cluster leases and the batch window.
+"""
+
+import threading
+
+from panfw.planner import Action, ActionPlanner
+
+
+class FakeFirewall(object):
+    """Just what the planner uses of a pan-os-python Firewall."""
+
+    def __init__(self, hostname, peer=None):
+        self.hostname = hostname
+        self.peer = peer
+
+    def ha_pair(self):
+        return [self] if self.peer is None else [self, self.peer]
+
+
+def ha_pair(first, second):
+    fw = FakeFirewall(first)
+    peer = FakeFirewall(second, fw)
+    fw.peer = peer
+    return fw, peer
+
+
+class Recorder(object):
+    """Execute callbacks and history store in one."""
+
+    def __init__(self):
+        self.calls = list()
+        self.recorded = list()
+        self._lock = threading.Lock()
+
+    def execute(self, name, error=None):
+        def run():
+            with self._lock:
+                self.calls.append(name)
+            if error is not None:
+                raise error
+            return name
+        return run
+
+    def record_action(self, task, hostname, action, gateway, detail):
+        with self._lock:
+            self.recorded.append((hostname, action, gateway, detail))
+
+
+def test_dedup_across_the_ha_pair():
+    recorder = Recorder()
+    planner = ActionPlanner(window=None, history=recorder)
+    fw, peer = ha_pair('10.0.0.1', '10.0.0.2')
+    assert planner.propose(Action('reconnect', fw, 'task', recorder.execute('a'), gateway='gw1'))
+    # Seen from the other member of the pair
+    assert not planner.propose(Action('reconnect', peer, 'task', recorder.execute('b'), gateway='gw1'))
+    assert planner.propose(Action('reconnect', fw, 'task', recorder.execute('c'), gateway='gw2'))
+    assert planner.pending() == 2
+    assert planner.drain() == {'ok': 2}
+    assert sorted(recorder.calls) == ['a', 'c']
+    assert planner.pending() == 0 and planner.drain() == {}
+    # A new cycle plans the same action again
+    assert planner.propose(Action('reconnect', fw, 'task', recorder.execute('d'), gateway='gw1'))
+
+
+def test_restart_replaces_the_reconnects_of_its_pair():
+    recorder = Recorder()
+    planner = ActionPlanner(window=None, history=recorder)
+    fw, peer = ha_pair('10.0.0.1', '10.0.0.2')
+    other = FakeFirewall('10.0.0.3')
+    planner.propose(Action('reconnect', fw, 'task', recorder.execute('reconnect'), gateway='gw1'))
+    planner.propose(Action('restart', peer, 'task', recorder.execute('restart')))
+    planner.propose(Action('reconnect', other, 'task', recorder.execute('other'), gateway='gw1'))
+    assert planner.drain() == {'ok': 2}
+    assert sorted(recorder.calls) == ['other', 'restart']
+    assert [(hostname, action) for hostname, action, _, _ in sorted(recorder.recorded)] == \
+        [('10.0.0.2', 'restart'), ('10.0.0.3', 'reconnect')]
+
+
+def test_waves_keep_a_site_together():
+    sites = {'a1': 'a', 'a2': 'a', 'b1': 'b', 'b2': 'b', 'b3': 'b', 'c1': 'c'}
+    planner = ActionPlanner(window=None, wave_size=3, site_of=sites.get)
+    actions = [Action('restart', FakeFirewall(hostname), 'task', None) for hostname in sites]
+    waves = planner.plan(actions)
+    assert [[(site, [a.fw.hostname for a in unit]) for site, unit in wave] for wave in waves] == [
+        [('a', ['a1']), ('a', ['a2'])],
+        [('b', ['b1']), ('b', ['b2']), ('b', ['b3'])],
+        [('c', ['c1'])]]
+    lines = planner.describe(waves)
+    assert lines[0] == 'wave 1 [site a]: restart on a1'
+    assert ActionPlanner(window=None).plan(actions)[0][0][0] == ''
+
+
+def test_dry_run_records_without_running():
+    recorder = Recorder()
+    planner = ActionPlanner(dry_run=True, window=None, history=recorder)
+    planner.propose(Action('restart', FakeFirewall('fw'), 'task', recorder.execute('restart')))
+    assert planner.drain() == {'dry_run': 1}
+    assert recorder.calls == []
+    assert recorder.recorded == [('fw', 'restart', None, 'dry run')]
+
+
+def test_failures_stop_the_remaining_waves():
+    recorder = Recorder()
+    planner = ActionPlanner(window=None, wave_size=1, max_failures=1, history=recorder)
+    planner.propose(Action('restart', FakeFirewall('a'), 'task',
+                           recorder.execute('a', RuntimeError('boom'))))
+    planner.propose(Action('restart', FakeFirewall('b'), 'task', recorder.execute('b')))
+    planner.propose(Action('restart', FakeFirewall('c'), 'task', recorder.execute('c')))
+    assert planner.drain() == {'failed': 1, 'skipped': 2}
+    assert recorder.calls == ['a']
+    assert recorder.recorded[0][3] == "failed: RuntimeError('boom')"
+
+
+def test_cluster_lease_skips_actions():
+    class Cluster(object):
+        def __init__(self):
+            self.leases = list()
+
+        def try_action(self, hostname, action, ttl=None):
+            self.leases.append((hostname, action, ttl))
+            return hostname != 'busy'
+
+    recorder = Recorder()
+    cluster = Cluster()
+    planner = ActionPlanner(window=None, cluster=cluster)
+    planner.propose(Action('restart', FakeFirewall('busy'), 'task', recorder.execute('busy'),
+                           lease_ttl=900))
+    planner.propose(Action('restart', FakeFirewall('free'), 'task', recorder.execute('free')))
+    planner.propose(Action('reorder', FakeFirewall('local'), 'task', recorder.execute('local'),
+                           lease=False))
+    assert planner.drain() == {'ok': 2, 'skipped': 1}
+    assert sorted(recorder.calls) == ['free', 'local']
+    assert ('busy', 'restart', 900) in cluster.leases
+
+
+def test_batch_window_runs_the_plan():
+    recorder = Recorder()
+    done = threading.Event()
+    planner = ActionPlanner(window=0.05)
+
+    def execute():
+        recorder.execute('restart')()
+        done.set()
+
+    planner.propose(Action('restart', FakeFirewall('fw'), 'task', execute))
+    assert done.wait(5)
+    assert recorder.calls == ['restart'] and planner.pending() == 0
+    planner.close()
+    # Stopped planners run what is left on close() only
+    planner.propose(Action('restart', FakeFirewall('fw'), 'task', execute))
+    assert planner._timer is None and planner.pending() == 1
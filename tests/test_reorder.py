@@ -0,0 +1,63 @@
+"""
+Module:       tests/test_reorder.py
+
+Description:
+Move planning of the rule reorder engine: the rules on a longest increasing
+subsequence stay, every other listed rule is moved once, and the xpaths of
+the moves address names with quotes.
+"""
+
+import random
+
+import pytest
+
+from panfw.reorder import (Move, entry_xpath, longest_increasing_subsequence, multi_config_element,
+                           plan_moves, rulebase_xpath, simulate_moves)
+
+
+def test_longest_increasing_subsequence():
+    seq = [3, 1, 4, 1, 5, 9, 2, 6]
+    indexes = longest_increasing_subsequence(seq)
+    values = [seq[i] for i in indexes]
+    assert len(values) == 4
+    assert values == sorted(set(values))
+    assert indexes == sorted(indexes)
+    assert longest_increasing_subsequence([]) == []
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_moves_reaches_target_with_minimal_moves(seed):
+    rnd = random.Random(seed)
+    current = [f'rule-{i}' for i in range(rnd.randint(1, 200))]
+    target = list(current)
+    rnd.shuffle(target)
+    moves = plan_moves(current, target)
+    assert simulate_moves(current, moves) == target
+    positions = [target.index(name) for name in current]
+    assert len(moves) == len(current) - len(longest_increasing_subsequence(positions))
+
+
+def test_plan_moves_keeps_unlisted_and_ignores_unknown_rules():
+    current = ['a', 'x', 'b', 'y', 'c']
+    moves = plan_moves(current, ['c', 'b', 'a', 'missing'])
+    order = simulate_moves(current, moves)
+    assert [name for name in order if name in 'abc'] == ['c', 'b', 'a']
+    assert len(moves) == 2
+    assert plan_moves(current, ['a', 'b', 'c']) == []
+
+
+def test_entry_xpath_quotes_names():
+    assert entry_xpath('web') == "entry[@name='web']"
+    assert entry_xpath("it's") == 'entry[@name="it\'s"]'
+    with pytest.raises(ValueError):
+        entry_xpath('both \' and "')
+    with pytest.raises(ValueError):
+        rulebase_xpath(device_group='dg \' "')
+
+
+def test_multi_config_element():
+    xpath = rulebase_xpath(vsys='vsys1', rulebase='rulebase')
+    element = multi_config_element(xpath, [Move("it's", 'top', None), Move('b', 'after', 'a')], 5)
+    assert element.startswith('<multi-configure-request><move id="5" ')
+    assert '/rules/entry[@name=&quot;it\'s&quot;]" where="top"/>' in element
+    assert 'id="6"' in element and 'dst="a"' in element
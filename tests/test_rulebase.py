@@ -0,0 +1,78 @@
+"""
+Module:       tests/test_rulebase.py
+
+Description:
+The Fenwick tree indexed rulebase against a plain list: positions, ranks
+and moves stay right through random moves, inserts and removals, also when
+a gap of free slots fills up and the rules are spread out again.
+"""
+
+import random
+
+import pytest
+
+from panfw.reorder import Move
+from panfw.rulebase import Rulebase, RuleRecord
+
+
+def check(rulebase, model):
+    assert rulebase.names() == model
+    assert len(rulebase) == len(model)
+    for i, name in enumerate(model):
+        assert rulebase.position(name) == i
+        assert rulebase.rule_at(i).name == name
+
+
+def list_move(model, name, where, dst=None):
+    model.remove(name)
+    if where == 'top':
+        model.insert(0, name)
+    elif where == 'bottom':
+        model.append(name)
+    else:
+        i = model.index(dst)
+        model.insert(i + 1 if where == 'after' else i, name)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_moves_match_a_list(seed):
+    rnd = random.Random(seed)
+    model = [f'r{i}' for i in range(50)]
+    rulebase = Rulebase(RuleRecord(name) for name in model)
+    check(rulebase, model)
+    for _ in range(300):
+        name = rnd.choice(model)
+        where = rnd.choice(('top', 'bottom', 'before', 'after'))
+        dst = None
+        if where in ('before', 'after'):
+            dst = rnd.choice([other for other in model if other != name])
+        rulebase.move(name, where, dst)
+        list_move(model, name, where, dst)
+    check(rulebase, model)
+
+
+def test_respread_after_many_inserts_at_one_place():
+    model = ['first', 'last']
+    rulebase = Rulebase(RuleRecord(name) for name in model)
+    # Every insert halves the same gap until it is used up
+    for i in range(40):
+        rulebase.add(RuleRecord(f'n{i}'), 'before', 'last')
+        model.insert(len(model) - 1, f'n{i}')
+    check(rulebase, model)
+    rulebase.remove('n7')
+    model.remove('n7')
+    check(rulebase, model)
+
+
+def test_order_queries_and_errors():
+    rulebase = Rulebase(RuleRecord(name) for name in 'abcd')
+    rulebase.apply_moves([Move('d', 'top', None), Move('a', 'after', 'b')])
+    assert rulebase.names() == ['d', 'b', 'a', 'c']
+    assert rulebase.precedes('b', 'a') and not rulebase.precedes('c', 'd')
+    assert rulebase.rule_at(-1).name == 'c'
+    with pytest.raises(IndexError):
+        rulebase.rule_at(4)
+    with pytest.raises(ValueError):
+        rulebase.move('a', 'after', 'a')
+    with pytest.raises(ValueError):
+        rulebase.add(RuleRecord('a'))
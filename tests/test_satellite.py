@@ -0,0 +1,62 @@
+"""
+Module:       tests/test_satellite.py
+
+Description:
+Satellite failure state machine: thresholds, the restart cooldown, failures
+of extra (event triggered) checks within the polling interval, and the
+state file.
+"""
+
+from panfw.satellite import (ACTION_RECONNECT, ACTION_RESTART, DEGRADED, HEALTHY, RECONNECTING,
+                             RESTARTING, SatelliteStateMachine)
+
+
+def observe_all(states, results, start=0, step=30, min_gap=None):
+    return [states.observe('fw', 'gw', connected, now=start + i * step, min_gap=min_gap)
+            for i, connected in enumerate(results)]
+
+
+def test_thresholds_and_cooldown():
+    states = SatelliteStateMachine(reconnect_threshold=2, restart_threshold=4, restart_cooldown=100)
+    assert observe_all(states, [False] * 4) == [None, ACTION_RECONNECT, None, ACTION_RESTART]
+    assert states.state('fw', 'gw')['state'] == RESTARTING
+    # Not counted while the firewall restarts
+    assert observe_all(states, [False] * 3, start=120) == [None, None, None]
+    assert states.state('fw', 'gw')['failures'] == 0
+    # Counting again after the cooldown
+    assert observe_all(states, [False], start=300) == [None]
+    assert states.state('fw', 'gw')['state'] == DEGRADED
+    observe_all(states, [True], start=330)
+    state = states.state('fw', 'gw')
+    assert (state['state'], state['failures']) == (HEALTHY, 0)
+
+
+def test_triggered_failures_within_the_interval_do_not_count():
+    states = SatelliteStateMachine(reconnect_threshold=3, restart_threshold=5)
+    # A flapping tunnel reported every 5 seconds, polling interval 30 (gap 24)
+    actions = observe_all(states, [False] * 13, step=5, min_gap=24)
+    assert actions.index(ACTION_RECONNECT) == 10
+    assert states.state('fw', 'gw')['failures'] == 3
+    # A check that finds the tunnel up still resets the streak at once
+    observe_all(states, [True], start=61, min_gap=24)
+    assert states.state('fw', 'gw')['state'] == HEALTHY
+    # The first failure of a new streak counts right away
+    observe_all(states, [False, False], start=62, step=1, min_gap=24)
+    assert states.state('fw', 'gw')['failures'] == 1
+
+
+def test_dry_run_keeps_counting():
+    states = SatelliteStateMachine(reconnect_threshold=2, restart_threshold=3)
+    actions = [states.observe('fw', 'gw', False, now=i * 30, dry_run=True) for i in range(4)]
+    assert actions == [None, ACTION_RECONNECT, ACTION_RESTART, ACTION_RESTART]
+    state = states.state('fw', 'gw')
+    assert (state['state'], state['failures']) == (DEGRADED, 4)
+
+
+def test_state_file(tmp_path):
+    path = str(tmp_path / 'satellite.json')
+    states = SatelliteStateMachine(path=path, reconnect_threshold=2)
+    observe_all(states, [False, False])
+    restored = SatelliteStateMachine(path=path, reconnect_threshold=2)
+    assert restored.state('fw', 'gw')['state'] == RECONNECTING
+    assert restored.state('fw', 'other')['state'] == HEALTHY
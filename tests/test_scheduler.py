@@ -0,0 +1,98 @@
+"""
+Module:       tests/test_scheduler.py
+
+Description:
+Rescheduling of the daemon mode scheduler on a fake clock without jitter:
+fixed rate, failure back-off, the adaptive stretch of healthy jobs and
+triggered runs.
+"""
+
+import pytest
+
+from panfw.scheduler import Scheduler
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def run(scheduler, clock, key='fw', at=None):
+    """Moves the clock to the next due time and pops key."""
+    clock.now = scheduler.next_due() if at is None else at
+    assert [key for key, _ in scheduler.pop_due()] == [key]
+    return clock.now
+
+
+def test_fixed_rate_and_missed_slots(clock):
+    scheduler = Scheduler(default_interval=10, jitter=0, clock=clock)
+    scheduler.add('fw')
+    start = run(scheduler, clock)
+    assert 0 <= start <= 10
+    scheduler.complete('fw', True)
+    assert scheduler.next_due() == start + 10
+    # A run taking 25 seconds skips the slots it missed
+    run(scheduler, clock)
+    clock.now = start + 35
+    scheduler.complete('fw', True)
+    assert scheduler.next_due() == pytest.approx(start + 40)
+
+
+def test_failure_backoff(clock):
+    scheduler = Scheduler(default_interval=10, jitter=0, max_backoff=8, clock=clock)
+    scheduler.add('fw')
+    due = run(scheduler, clock)
+    for factor in (2, 4, 8, 8):
+        scheduler.complete('fw', False)
+        assert scheduler.next_due() == due + 10 * factor
+        due = run(scheduler, clock)
+    scheduler.complete('fw', True)
+    assert scheduler.next_due() == due + 10
+
+
+def test_adaptive_stretch_and_reset(clock):
+    scheduler = Scheduler(default_interval=10, jitter=0, clock=clock, adaptive=True,
+                          max_interval=40, growth=2, fast_interval=5)
+    scheduler.add('fw')
+    due = run(scheduler, clock)
+    for interval in (20, 40, 40):
+        scheduler.complete('fw', True, healthy=True)
+        assert scheduler.current_interval('fw') == interval
+        assert scheduler.next_due() == due + interval
+        due = run(scheduler, clock)
+    assert scheduler.stretched() == 1
+    scheduler.complete('fw', True, healthy=None)
+    assert scheduler.current_interval('fw') == 40
+    due = run(scheduler, clock)
+    scheduler.complete('fw', True, healthy=False)
+    assert scheduler.current_interval('fw') == 10
+    assert scheduler.next_due() == due + 5
+    scheduler.configure({'check_interval': 10, 'schedule_jitter': 0})
+    assert scheduler.adaptive is False
+
+
+def test_trigger_runs_now_and_drops_the_stretch(clock):
+    scheduler = Scheduler(default_interval=10, jitter=0, clock=clock, adaptive=True, max_interval=80)
+    scheduler.add('fw')
+    run(scheduler, clock)
+    scheduler.complete('fw', True, healthy=True)
+    assert scheduler.stretched() == 1
+    clock.now += 3
+    scheduler.trigger('fw')
+    scheduler._run_triggered()
+    assert scheduler.next_due() == clock.now
+    assert scheduler.stretched() == 0
+    # A running job is not triggered a second time
+    run(scheduler, clock)
+    scheduler.trigger('fw')
+    scheduler._run_triggered()
+    assert scheduler.next_due() is None
@@ -0,0 +1,87 @@
+"""
+Module:       tests/test_sharding.py
+
+Description:
+Consistent hash ring of the shard workers: every firewall lands on exactly
+one shard, the split is stable across processes and fairly even, and adding
+a shard only moves the firewalls the new shard takes over. The sharded
+executor times every firewall from the start of its call in the worker.
+"""
+
+import sys
+import time
+
+import pytest
+
+from panfw.sharding import HashRing, ShardedExecutor, shard_config, stable_hash
+
+HOSTS = [f'10.{i // 250}.{i % 250}.1' for i in range(4000)]
+
+
+def test_split_covers_every_host_once():
+    ring = HashRing(4)
+    shards = ring.split(HOSTS)
+    assert sorted(host for hosts in shards.values() for host in hosts) == sorted(HOSTS)
+    assert set(shards) == {0, 1, 2, 3}
+    for shard, hosts in shards.items():
+        assert all(ring.shard_of(host) == shard for host in hosts)
+
+
+def test_split_is_stable_and_even():
+    assert stable_hash('10.0.0.1') == stable_hash('10.0.0.1')
+    assert HashRing(4).split(HOSTS) == HashRing(4).split(HOSTS)
+    sizes = [len(hosts) for hosts in HashRing(4).split(HOSTS).values()]
+    # 64 points per shard keep every shard within +/- 35% of the mean
+    assert max(sizes) < 1000 * 1.35 and min(sizes) > 1000 * 0.65
+
+
+def test_adding_a_shard_moves_only_its_hosts():
+    before = HashRing(4)
+    after = HashRing(5)
+    moved = [host for host in HOSTS if before.shard_of(host) != after.shard_of(host)]
+    assert all(after.shard_of(host) == 4 for host in moved)
+    assert len(moved) < len(HOSTS) / 3
+
+
+def test_single_shard():
+    assert HashRing(0).split(HOSTS[:10]) == {0: HOSTS[:10]}
+
+
+def test_shard_config():
+    cfgdict = {'firewalls': {'a': {}, 'b': {}}, 'ha_cache_file': 'state/ha.json'}
+    shard_cfg = shard_config(cfgdict, 2, ['b', 'unknown'])
+    assert shard_cfg['ha_cache_file'] == 'state/ha.shard2.json'
+    assert shard_cfg['firewalls'] == {'b': {}}
+    assert shard_cfg['shard'] == 2 and shard_cfg['non_interactive']
+    assert cfgdict['ha_cache_file'] == 'state/ha.json'
+
+
+class FakeFirewall(object):
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+def init_fake(shard, hostnames):
+    return [FakeFirewall(hostname) for hostname in hostnames]
+
+
+def slow_call(fw):
+    time.sleep(1.5 if fw.hostname == 'hung' else 0.2)
+    return fw.hostname
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='forks the shard workers')
+def test_sharded_executor_times_every_firewall_on_its_own():
+    executor = ShardedExecutor(init_fake, shards=1, max_workers=2, timeout=0.4)
+    fw_objs = [FakeFirewall(f'fw{i}') for i in range(6)]
+    executor.start([fw.hostname for fw in fw_objs])
+    try:
+        assert len(executor.pids()) == 1
+        # Three rounds of two calls, longer than one timeout
+        results = executor.run(fw_objs, slow_call)
+        assert [res.error for res in results] == [None] * 6
+        results = executor.run([FakeFirewall('hung')] + fw_objs[:2], slow_call)
+        assert [res.error for res in results] == ['timed out', None, None]
+    finally:
+        executor.shutdown()
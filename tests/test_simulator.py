@@ -0,0 +1,74 @@
+"""
+Module:       tests/test_simulator.py
+
+Description:
+The offline XML API simulator and the benchmark on top of it: the layout of
+the simulated fleet, API answers over the pooled transport, and a short
+benchmark run with its report and the regression check against a baseline.
+The simulator needs loopback addresses other than 127.0.0.1 (Linux).
+"""
+
+import sys
+import json
+
+import pytest
+
+if not sys.platform.startswith('linux'):
+    pytest.skip('the simulator needs Linux loopback addresses', allow_module_level=True)
+
+from panfw.benchmark import compare, main as benchmark
+from panfw.simulator import Simulator
+from panfw.transport import PooledTransport, TransportError
+
+
+def test_fleet_layout():
+    simulator = Simulator(devices=6, ha_fraction=0.5, gateways=2)
+    firewalls = simulator.firewalls()
+    # One HA pair listed by its active member and four standalone firewalls
+    assert len(firewalls) == 5
+    active, passive = simulator.devices[:2]
+    assert firewalls[active.address]['ha_peer_ip'] == passive.address
+    assert passive.address not in firewalls
+    assert all(len(entry['gp_gateways']) == 2 for entry in firewalls.values())
+    assert all('api_key' not in entry for entry in simulator.firewalls(api_keys=False).values())
+
+
+def test_api_answers():
+    simulator = Simulator(devices=2, port=18611, latency=0.001, workers=1, error_rate=0.0)
+    simulator.start()
+    transport = PooledTransport()
+    try:
+        device = simulator.devices[0]
+
+        class Device(object):
+            hostname = device.address
+            port = simulator.port
+            api_key = device.api_key
+
+        response = transport.op(Device, '<show><system><info></info></system></show>')
+        assert b'status="success"' in response
+        Device.api_key = 'wrong'
+        with pytest.raises(TransportError):
+            transport.op(Device, '<show><system><info></info></system></show>')
+        assert simulator.stats()[0] == 2
+    finally:
+        transport.close()
+        simulator.stop()
+
+
+def test_benchmark_report_and_baseline(tmp_path, capsys):
+    pytest.importorskip('panos')
+    report_file = str(tmp_path / 'report.json')
+    args = ['--devices', '4', '--port', '18612', '--latency', '1', '--sweeps', '1',
+            '--sim-workers', '1', '--json', report_file]
+    assert benchmark(args) == 0
+    with open(report_file) as infile:
+        report = json.load(infile)
+    assert report['sweep']['failed'] == 0
+    assert [phase['phase'] for phase in report['phases']] == \
+        ['initialize', 'sweep 1 (satellite-reset)']
+    # A run half as fast is a regression
+    slower = dict(report, sweep=dict(report['sweep'],
+                                     requests_per_second=report['sweep']['requests_per_second'] / 2))
+    assert compare(slower, report, 0.2)
+    assert compare(report, report, 0.2) == []
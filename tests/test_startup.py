@@ -0,0 +1,55 @@
+"""
+Module:       tests/test_startup.py
+
+Description:
+Start-up cost of the runtime: a plain one-shot run with the settings of
+config.yml.example does not import the modules of the optional components.
+Run in a fresh interpreter, the test process has imported them already.
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by sharding, the cluster / history databases and the pooled transport
+OPTIONAL_MODULES = ('multiprocessing', 'sqlite3', 'ssl')
+
+# Prints the optional modules loaded after building the runtime, then the
+# ones loaded after the run
+SCRIPT = """
+import sys
+from panfw.core import Runtime
+runtime = Runtime.from_config(config_file=sys.argv[1], argv=[])
+print(' '.join(name for name in sys.argv[2:] if name in sys.modules))
+runtime.run_once()
+runtime.close()
+print(' '.join(name for name in sys.argv[2:] if name in sys.modules))
+"""
+
+
+def test_one_shot_run_does_not_load_optional_modules(tmp_path):
+    pytest.importorskip('panos')
+    with open(os.path.join(ROOT, 'config.yml.example')) as infile:
+        cfgdict = yaml.safe_load(infile)
+    # Nothing listens on port 9, the check fails right away
+    cfgdict.update(daemon_mode=False, log_path=str(tmp_path / 'logs'),
+                   ha_cache_file=None, satellite_state_file=None,
+                   firewalls={'127.0.0.1': {'api_key': 'key', 'port': 9,
+                                            'gp_gateway': '192.0.2.1'}})
+    config_file = tmp_path / 'config.yml'
+    config_file.write_text(yaml.safe_dump(cfgdict))
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    out = subprocess.run([sys.executable, '-c', SCRIPT, str(config_file), *OPTIONAL_MODULES],
+                         env=env, cwd=str(tmp_path), capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    after_start, after_run = out.stdout.splitlines()
+    assert after_start.split() == []
+    # pan-os-python brings ssl with the first firewall
+    assert after_run.split() == ['ssl']
@@ -0,0 +1,146 @@
+"""
+Module:       tests/test_tasks.py
+
+Description:
+The tasks end to end against the offline XML API simulator: satellite
+checks and their recovery actions in the threads, asyncio and processes
+execution modes, and the rule reorder engine reading the rulebase from a
+config snapshot. Needs pan-os-python and loopback addresses other than
+127.0.0.1 (Linux).
+"""
+
+import os
+import sys
+import time
+import sqlite3
+
+import pytest
+
+pytest.importorskip('panos')
+if not sys.platform.startswith('linux'):
+    pytest.skip('the simulator needs Linux loopback addresses', allow_module_level=True)
+
+from panfw.core import Runtime
+from panfw.reorder import RuleReorderEngine, rulebase_xpath
+from panfw.satellite import HEALTHY, RECONNECTING, RESTARTING
+from panfw.simulator import Simulator
+from panfw.snapshot import ConfigSnapshot, default_subtrees
+from panfw.transport import PooledTransport
+
+
+@pytest.fixture
+def start_simulator():
+    """Returns a function starting a simulator, stopped after the test."""
+    started = list()
+
+    def start(**kwargs):
+        sim = Simulator(**dict(dict(devices=4, latency=0.001, workers=1), **kwargs))
+        sim.start()
+        started.append(sim)
+        return sim
+
+    yield start
+    for sim in started:
+        sim.stop()
+
+
+def make_runtime(tmp_path, sim, **cfg):
+    cfgdict = {'log_path': str(tmp_path / 'logs'), 'firewalls': sim.firewalls(),
+               'history_db': str(tmp_path / 'history.db'), 'history_flush_interval': 0.1}
+    cfgdict.update(cfg)
+    return Runtime(cfgdict, ['satellite-reset'])
+
+
+def actions(tmp_path):
+    with sqlite3.connect(str(tmp_path / 'history.db')) as db:
+        return sorted(db.execute('SELECT firewall, action FROM actions').fetchall())
+
+
+def test_threads_reconnect_then_restart(tmp_path, start_simulator):
+    simulator = start_simulator(port=18601, satellite_failure_rate=1.0, ha_fraction=1.0)
+    runtime = make_runtime(tmp_path, simulator, reconnect_threshold=1, restart_threshold=2,
+                           restart_cooldown=0)
+    try:
+        results = runtime.run_once()['satellite-reset']
+        # Two HA pairs, each checked once
+        assert len(results) == 2 and all(res.ok for res in results)
+        assert all(set(res.result.values()) == {RECONNECTING} for res in results)
+        results = runtime.run_once()['satellite-reset']
+        assert all(set(res.result.values()) == {RESTARTING} for res in results)
+    finally:
+        runtime.close()
+    active = sorted(device.address for device in simulator.devices if device.ha_state == 'active')
+    assert actions(tmp_path) == sorted([(host, 'reconnect') for host in active] +
+                                       [(host, 'restart') for host in active])
+
+
+def test_asyncio_sweep_with_an_unreachable_pair(tmp_path, start_simulator):
+    simulator = start_simulator(port=18602, ha_fraction=1.0)
+    firewalls = simulator.firewalls()
+    # Nothing listens on port 9, the HA discovery of this pair fails
+    firewalls['127.0.0.1'] = dict(next(iter(firewalls.values())), port=9, ha_peer_ip='127.0.0.2')
+    runtime = make_runtime(tmp_path, simulator, execution_mode='asyncio', firewalls=firewalls,
+                           firewall_timeout=5)
+    try:
+        results = {res.hostname: res for res in runtime.run_once()['satellite-reset']}
+    finally:
+        runtime.close()
+    assert len(results) == 3
+    assert not results['127.0.0.1'].ok and results['127.0.0.1'].error
+    others = [res for hostname, res in results.items() if hostname != '127.0.0.1']
+    assert all(res.ok and set(res.result.values()) == {HEALTHY} for res in others)
+
+
+def test_processes_shutdown_runs_pending_actions(tmp_path, start_simulator, monkeypatch):
+    simulator = start_simulator(port=18603, satellite_failure_rate=1.0)
+    import panos.firewall
+    restarted = tmp_path / 'restarted'
+    restarted.mkdir()
+
+    def slow_restart(fw):
+        # Longer than the shutdown waits for a worker that was told to stop
+        time.sleep(6)
+        (restarted / fw.hostname).touch()
+
+    # Patched before the shard workers are forked
+    monkeypatch.setattr(panos.firewall.Firewall, 'restart', slow_restart)
+    runtime = make_runtime(tmp_path, simulator, execution_mode='processes', shards=2,
+                           restart_threshold=1, action_batch_window=60)
+    try:
+        fw_objs = runtime.initialize()
+        results = runtime.tasks['satellite-reset'].run_all(fw_objs)
+        assert all(set(res.result.values()) == {RESTARTING} for res in results)
+    finally:
+        # The restarts are still waiting for the batch window in the shards
+        runtime.close()
+    hostnames = sorted(device.address for device in simulator.devices)
+    assert sorted(os.listdir(str(restarted))) == hostnames
+    assert actions(tmp_path) == [(host, 'restart') for host in hostnames]
+
+
+def test_rule_reorder_from_a_snapshot(tmp_path, start_simulator):
+    simulator = start_simulator(port=18604, devices=1, rules=30)
+    device = simulator.devices[0]
+
+    class Device(object):
+        hostname = device.address
+        port = simulator.port
+        api_key = device.api_key
+
+    transport = PooledTransport()
+    subtrees = default_subtrees(rulebase='rulebase')
+    snapshot = ConfigSnapshot(Device, str(tmp_path / 'snapshots'), subtrees, transport=transport)
+    engine = RuleReorderEngine(Device, rulebase_xpath(rulebase='rulebase'), transport=transport,
+                               batch_size=7, snapshot=snapshot)
+    target = [f'rule-{i}' for i in reversed(range(30))]
+    try:
+        assert len(engine.reorder(target, commit=False)) == 29
+        assert engine.rulebase.names() == target
+        # The moves are in the candidate config and in the config log, only
+        # the rulebase is fetched again and nothing is planned a second time
+        assert snapshot.refresh() == ['rulebase']
+        assert snapshot.meta['seqno'] == 29
+        assert engine.plan(target)[1] == []
+        assert snapshot.refresh() == []
+    finally:
+        transport.close()
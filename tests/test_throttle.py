@@ -0,0 +1,99 @@
+"""
+Module:       tests/test_throttle.py
+
+Description:
+Per-device token bucket and circuit breaker on a fake clock, and the
+DeviceGuard that combines them around API calls.
+"""
+
+import pytest
+
+from panfw.throttle import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, DeviceGuard,
+                            RateLimitError, TokenBucket, is_connection_error)
+from panfw.transport import TransportError
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst_and_refill():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Every further token is half a second further away
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    bucket.cancel()
+    clock.now += 10
+    # Refilled up to the burst, not beyond
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() > 0
+
+
+def test_circuit_breaker_opens_probes_and_backs_off():
+    clock = Clock()
+    breaker = CircuitBreaker('fw', failure_threshold=3, reset_timeout=10, max_reset_timeout=30,
+                             clock=clock)
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+    assert breaker.retry_in() == 10
+
+    clock.now += 10
+    # One probe at a time while half-open
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.retry_in() == 20
+
+    clock.now += 20
+    assert breaker.allow()
+    breaker.record_failure()
+    # Doubled up to max_reset_timeout
+    assert breaker.retry_in() == 30
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.open_timeout == 10 and breaker.failures == 0
+
+
+def test_device_guard():
+    guard = DeviceGuard(rate=1000, burst=5, max_wait=0.001, failure_threshold=2, reset_timeout=60)
+
+    def fail(exc):
+        raise exc
+
+    assert guard.call('fw', lambda: 'ok') == 'ok'
+    # API errors of a device that answered do not count
+    with pytest.raises(ValueError):
+        guard.call('fw', fail, ValueError('API error'), is_failure=lambda e: False)
+    for _ in range(2):
+        with pytest.raises(ConnectionRefusedError):
+            guard.call('fw', fail, ConnectionRefusedError())
+    assert guard.state('fw') == OPEN
+    with pytest.raises(CircuitOpenError):
+        guard.call('fw', lambda: 'ok')
+    assert guard.state('other') == CLOSED
+    # What the pooled transport counts: no answer, not an HTTP error status
+    assert is_connection_error(TimeoutError()) and is_connection_error(ConnectionResetError())
+    assert not is_connection_error(TransportError('HTTP 403 Forbidden from fw'))
+
+    guard = DeviceGuard(rate=0.01, burst=1, max_wait=1)
+    assert guard.call('fw', lambda: 'ok') == 'ok'
+    with pytest.raises(RateLimitError):
+        guard.call('fw', lambda: 'ok')
+    assert DeviceGuard.from_config({'device_guard': False}) is None
+    # Opt-in
+    assert DeviceGuard.from_config({}) is None
+    assert DeviceGuard.from_config({'device_guard': True}).rate == 5